@@ -32,16 +32,13 @@ from past.builtins import basestring
 import collections
 import csv
 from datetime import datetime
-from dicom.dataset import Dataset, FileDataset
-import dicom
-import dicom.UID
 import fnmatch
 import getpass
 import glob
-import gzip
-from lxml import etree
-import nibabel as nib
-import numpy as np
+import hashlib
+import io
+import json
+from multiprocessing.pool import ThreadPool
 from pyxnat import Interface
 from pyxnat.core.errors import DatabaseError
 import os
@@ -51,13 +48,21 @@ import shutil
 import subprocess
 import tempfile
 import time
-import xlrd
 import xml.etree.cElementTree as ET
 import yaml
 import zipfile
+try:
+    from urllib.parse import quote, unquote
+except ImportError:
+    from urllib import quote, unquote
 
 from .task import (JOB_FAILED, JOB_RUNNING, JOB_PENDING, READY_TO_UPLOAD,
                    NEEDS_QA, RERUN, REPROC, FAILED_NEEDS_REPROC, BAD_QA_STATUS)
+from . import compression
+from . import profiling
+from . import resource_usage
+from .input_cache import get_input_cache
+from .staging import check_staging, stage_file, stage_path
 from .errors import (XnatUtilsError, XnatAccessError,
                      XnatAuthentificationError)
 from .dax_settings import (DAX_Settings, DAX_Netrc, DEFAULT_DATATYPE,
@@ -155,15 +160,39 @@ label,URI,xsiType,project,xnat:imagesessiondata/subject_id,subject_label,\
 xnat:imagesessiondata/id,xnat:imagesessiondata/label,URI,{fstype}/procstatus,\
 {fstype}/validation/status,{fstype}/procversion,{fstype}/jobstartdate,\
 {fstype}/memused,{fstype}/walltimeused,{fstype}/jobid,{fstype}/jobnode,\
-{fstype}/out/file/label'''
+{fstype}/date,{fstype}/out/file/label'''
 ASSESSOR_PR_PROJ_POST_URI = '''?project={project}&xsiType={pstype}&columns=ID,\
 label,URI,xsiType,project,xnat:imagesessiondata/subject_id,\
 xnat:imagesessiondata/id,xnat:imagesessiondata/label,{pstype}/procstatus,\
 {pstype}/proctype,{pstype}/validation/status,{pstype}/procversion,\
 {pstype}/jobstartdate,{pstype}/memused,{pstype}/walltimeused,\
-{pstype}/jobid,{pstype}/jobnode,{pstype}/out/file/label'''
+{pstype}/jobid,{pstype}/jobnode,{pstype}/date,{pstype}/out/file/label'''
 EXPERIMENT_POST_URI = '''?columns=ID,URI,subject_label,subject_ID,modality,\
 project,date,xsiType,label,xnat:subjectdata/meta/last_modified'''
+# Change feed: search of the sessions modified since a date
+MODIFIED_SESSION_ROW = 'xnat:imageSessionData'
+MODIFIED_SESSION_COLUMNS = ['xnat:imageSessionData/SESSION_ID']
+MODIFIED_SESSION_FIELD = 'xnat:imageSessionData/meta/last_modified'
+MODIFIED_SESSION_PROJECT = 'xnat:imageSessionData/project'
+# Maximum number of IDs in a filter of a REST listing (length of the URI)
+MAX_IDS_PER_QUERY = 100
+
+# Compiled matchers for scan types / proctypes:
+GLOB_CHARS_RE = re.compile(r'[*?\[]')
+TYPES_MATCHERS = dict()
+# Zip archives for upload are kept in memory when the files to zip are
+# smaller than this size (bytes), written to a temporary file otherwise
+ZIP_SPOOL_SIZE = 64 * 1024 ** 2
+# Files already compressed are stored in the zip without recompression
+ZIP_STORED_EXTENSIONS = ('.gz', '.tgz', '.bz2', '.xz', '.zip', '.mgz',
+                         '.png', '.jpg', '.jpeg', '.gif')
+# Resumable transfers: chunk size and retries
+TRANSFER_CHUNK_SIZE = 1024 ** 2
+TRANSFER_RETRIES = 5
+# HTTP statuses of the transient errors retried by the transfers
+TRANSFER_RETRY_STATUSES = [408, 429, 500, 502, 503, 504]
+# Number of files of a resource downloaded at the same time
+DOWNLOAD_WORKERS = 8
 
 
 ###############################################################################
@@ -221,10 +250,17 @@ class InterfaceTemp(Interface):
 
     def connect(self):
         """Connect to XNAT."""
-        super(InterfaceTemp, self).__init__(server=self.host,
-                                            user=self.user,
-                                            password=self.pwd,
-                                            cachedir=self.temp_dir)
+        try:
+            super(InterfaceTemp, self).__init__(server=self.host,
+                                                user=self.user,
+                                                password=self.pwd,
+                                                cachedir=self.temp_dir)
+        except TypeError:
+            # pyxnat >= 1.1 has no cache
+            super(InterfaceTemp, self).__init__(server=self.host,
+                                                user=self.user,
+                                                password=self.pwd)
+        profiling.instrument_interface(self)
 
     def disconnect(self):
         """Disconnect the JSESSION and blow away the cache.
@@ -364,7 +400,7 @@ class SpiderProcessHandler(object):
     def __init__(self, script_name, suffix, project=None, subject=None,
                  experiment=None, scan=None, alabel=None,
                  assessor_handler=None, time_writer=None,
-                 host=os.environ.get('XNAT_HOST', None)):
+                 host=os.environ.get('XNAT_HOST', None), staging='link'):
         """
         Entry point to the SpiderProcessHandler Class.
         You can generate a SpiderProcessHandler by giving:
@@ -386,6 +422,8 @@ class SpiderProcessHandler(object):
         :param experiment: Session on XNAT
         :param scan: Scan (if needed) On Xnat
         :param time_writer: TimedWriter object if wanted
+        :param staging: how to put the outputs in the upload directory
+                        (move/link/reflink/copy, see dax.staging)
         :return: None
 
         """
@@ -394,6 +432,8 @@ class SpiderProcessHandler(object):
         self.has_pdf = 0
         self.time_writer = time_writer
         self.host = host
+        check_staging(staging)
+        self.staging = staging
         proctype, self.version = get_proctype(script_name, suffix)
 
         # Create the assessor handler
@@ -555,12 +595,15 @@ Wrong label.'
                 os.mkdir(respath)
             # mv the file
             self.print_copying_statement(resource, filepath, respath)
-            shutil.copy(filepath, respath)
+            ifile = os.path.join(respath, os.path.basename(filepath))
             # if it's a nii or a rec file, gzip it:
             if filepath.lower().endswith('.nii') or \
                filepath.lower().endswith('.rec'):
-                ifile = os.path.join(respath, os.path.basename(filepath))
-                os.system('gzip %s' % ifile)
+                compression.compress_file(filepath, '%s.gz' % ifile)
+            else:
+                if os.path.lexists(ifile):
+                    os.remove(ifile)
+                stage_file(filepath, ifile, self.staging)
 
     def add_folder(self, folderpath, resource_name=None):
         """
@@ -581,7 +624,9 @@ Wrong label.'
             dest = os.path.join(self.directory, res)
 
             try:
-                shutil.copytree(folderpath, dest)
+                if os.path.exists(dest):
+                    raise OSError('%s already exists' % dest)
+                stage_path(folderpath, dest, self.staging)
                 self.print_copying_statement(res, folderpath, dest)
             # Directories are the same
             except shutil.Error as excep:
@@ -627,6 +672,8 @@ Wrong label.'
         f_obj = open(os.path.join(self.directory, 'version.txt'), 'w')
         f_obj.write(self.version)
         f_obj.close()
+        # Resource usage of the commands run by the spider
+        resource_usage.write_usage_file(self.directory)
         # Finish the folder
         if not self.error and self.has_pdf:
             self.print_msg('INFO: Job ready to be upload, error: %s'
@@ -733,13 +780,14 @@ def list_project_resources(intf, projectid):
     return resource_list
 
 
-def list_subjects(intf, projectid=None):
+def list_subjects(intf, projectid=None, subject_ids=None):
     """
     List all the subjects that you have access to. Or, alternatively, list
      the subjects in a single project based on passed project ID
 
     :param intf: pyxnat.Interface object
     :param projectid: ID of a project on XNAT
+    :param subject_ids: only list the subjects with these IDs
     :return: list of dictionaries of subjects in the project or projects.
 
     """
@@ -749,6 +797,8 @@ def list_subjects(intf, projectid=None):
         post_uri = ALL_SUBJ_URI
 
     post_uri += SUBJECT_POST_URI
+    if subject_ids is not None:
+        post_uri += '&ID=%s' % ','.join(subject_ids)
 
     subject_list = intf._get_json(post_uri)
 
@@ -782,7 +832,7 @@ def list_subject_resources(intf, projectid, subjectid):
     return resource_list
 
 
-def list_sessions(intf, projectid=None, subjectid=None):
+def list_sessions(intf, projectid=None, subjectid=None, session_ids=None):
     """
     List all the sessions either:
         1) that you have access to
@@ -792,6 +842,7 @@ def list_sessions(intf, projectid=None, subjectid=None):
     :param intf: pyxnat.Interface object
     :param projectid: ID of a project on XNAT
     :param subjectid: ID/label of a subject
+    :param session_ids: only list the sessions with these IDs
     :return: List of sessions
     """
     type_list = []
@@ -806,16 +857,27 @@ def list_sessions(intf, projectid=None, subjectid=None):
     else:
         return None
 
+    columns = 'xsiType'
+    id_filter = ''
+    subject_ids = None
+    if session_ids is not None:
+        if not session_ids:
+            return list()
+        columns += ',subject_ID'
+        id_filter = '&ID=%s' % ','.join(session_ids)
+
     # First get a list of all experiment types
-    post_uri_types = '%s?columns=xsiType' % post_uri
+    post_uri_types = '%s?columns=%s%s' % (post_uri, columns, id_filter)
     sess_list = intf._get_json(post_uri_types)
     for sess in sess_list:
         sess_type = sess['xsiType'].lower()
         if sess_type not in type_list:
             type_list.append(sess_type)
+    if session_ids is not None:
+        subject_ids = sorted(set(sess['subject_ID'] for sess in sess_list))
 
     # Get the subjects list to get the subject ID:
-    subj_list = list_subjects(intf, projectid)
+    subj_list = list_subjects(intf, projectid, subject_ids)
     subj_id2lab = dict((subj['ID'], [subj['handedness'], subj['gender'],
                         subj['yob'], subj['dob']]) for subj in subj_list)
 
@@ -826,7 +888,7 @@ def list_sessions(intf, projectid=None, subjectid=None):
             add_uri_str = SESSION_POST_URI.format(stype=sess_type)
         else:
             add_uri_str = NO_MOD_SESSION_POST_URI.format(stype=sess_type)
-        post_uri_type = '%s%s' % (post_uri, add_uri_str)
+        post_uri_type = '%s%s%s' % (post_uri, add_uri_str, id_filter)
         sess_list = intf._get_json(post_uri_type)
 
         for sess in sess_list:
@@ -871,6 +933,49 @@ def list_sessions(intf, projectid=None, subjectid=None):
     return sorted(full_sess_list, key=lambda k: k['session_label'])
 
 
+def list_modified_session_ids(intf, projectid, since):
+    """
+    Search the IDs of the sessions of a project modified since a date
+     (XNAT search engine filtered on meta/last_modified).
+
+    :param intf: pyxnat.Interface object
+    :param projectid: ID of a project on XNAT
+    :param since: datetime, sessions modified at or after this date
+    :return: list of session IDs
+    """
+    constraints = [(MODIFIED_SESSION_PROJECT, '=', projectid),
+                   (MODIFIED_SESSION_FIELD, '>=',
+                    since.strftime('%Y-%m-%d %H:%M:%S')),
+                   'AND']
+    table = intf.select(MODIFIED_SESSION_ROW,
+                        MODIFIED_SESSION_COLUMNS).where(constraints)
+    session_ids = list()
+    for row in table:
+        session_id = list(row.values())[0]
+        if session_id and session_id not in session_ids:
+            session_ids.append(session_id)
+    return session_ids
+
+
+def list_modified_sessions(intf, projectid, since):
+    """
+    List the sessions of a project modified since a date without listing
+     all the sessions of the project (change feed for dax build).
+
+    :param intf: pyxnat.Interface object
+    :param projectid: ID of a project on XNAT
+    :param since: datetime, sessions modified at or after this date
+    :return: list of sessions (same as list_sessions)
+    """
+    session_ids = list_modified_session_ids(intf, projectid, since)
+    sess_list = list()
+    for ind in range(0, len(session_ids), MAX_IDS_PER_QUERY):
+        sess_list.extend(list_sessions(
+            intf, projectid,
+            session_ids=session_ids[ind:ind + MAX_IDS_PER_QUERY]))
+    return sorted(sess_list, key=lambda k: k['session_label'])
+
+
 def list_session_resources(intf, projectid, subjectid, sessionid):
     """
     Gets a list of all of the resources for a session associated to a
@@ -1204,6 +1309,7 @@ def list_project_assessors(intf, projectid):
                     anew['memused'] = asse.get('%s/memused' % pfix)
                     anew['walltimeused'] = asse.get('%s/walltimeused' % pfix)
                     anew['jobnode'] = asse.get('%s/jobnode' % pfix)
+                    anew['createdate'] = asse.get('%s/date' % pfix)
                     anew['handedness'] = sess_id2mod[asse['session_ID']][2]
                     anew['gender'] = sess_id2mod[asse['session_ID']][3]
                     anew['yob'] = sess_id2mod[asse['session_ID']][4]
@@ -1250,6 +1356,7 @@ def list_project_assessors(intf, projectid):
                     anew['xsiType'] = asse['xsiType']
                     anew['jobid'] = asse.get('%s/jobid' % pfix)
                     anew['jobnode'] = asse.get('%s/jobnode' % pfix)
+                    anew['createdate'] = asse.get('%s/date' % pfix)
                     anew['jobstartdate'] = asse.get('%s/jobstartdate' % pfix)
                     anew['memused'] = asse.get('%s/memused' % pfix)
                     anew['walltimeused'] = asse.get('%s/walltimeused' % pfix)
@@ -1301,6 +1408,8 @@ def get_resource_lastdate_modified(intf, resource_obj):
     :param resource: resource pyxnat Eobject
     :return: date of last modified data with the format %Y%m%d%H%M%S
     """
+    from lxml import etree
+
     # xpaths for times in resource xml
     created_dcm_xpath = "/cat:DCMCatalog/cat:entries/cat:entry/@createdTime"
     modified_dcm_xpath = "/cat:DCMCatalog/cat:entries/cat:entry/@modifiedTime"
@@ -1531,11 +1640,8 @@ def is_cscan_good_type(cscan, types_list, full_regex=False):
     :return: True if type is in the list, False if not.
 
     """
-    for exp in types_list:
-        regex = extract_exp(exp, full_regex)
-        if regex.match(cscan.info()['type']):
-            return True
-    return False
+    matcher = get_types_matcher(types_list, full_regex)
+    return matcher.match(cscan.info()['type'])
 
 
 def is_scan_unusable(scan_obj):
@@ -1559,11 +1665,8 @@ def is_scan_good_type(scan_obj, types_list, full_regex=False):
     :return: True if scan is in type list, False if not.
 
     """
-    for exp in types_list:
-        regex = extract_exp(exp, full_regex)
-        if regex.match(scan_obj.attrs.get('xnat:imageScanData/type')):
-            return True
-    return False
+    matcher = get_types_matcher(types_list, full_regex)
+    return matcher.match(scan_obj.attrs.get('xnat:imageScanData/type'))
 
 
 def has_resource(cobj, resource_label):
@@ -1578,7 +1681,7 @@ def has_resource(cobj, resource_label):
     """
     res_list = [res for res in cobj.get_resources()
                 if res['label'] == resource_label]
-    if len(res_list) > 0 and res_list[0]['file_count'] > 0:
+    if len(res_list) > 0 and int(res_list[0]['file_count'] or 0) > 0:
         return True
     return False
 
@@ -1684,11 +1787,8 @@ def is_cassessor_good_type(cassr, types_list, full_regex=False):
 
     """
     assr_info = cassr.info()
-    for exp in types_list:
-        regex = extract_exp(exp, full_regex)
-        if regex.match(assr_info['proctype']):
-            return True
-    return False
+    matcher = get_types_matcher(types_list, full_regex)
+    return matcher.match(assr_info['proctype'])
 
 
 def is_cassessor_usable(cassr):
@@ -1715,11 +1815,7 @@ def is_assessor_good_type(assessor_obj, types_list, full_regex=False):
     """
     atype = assessor_obj.attrs.get('xsiType')
     proctype = assessor_obj.attrs.get('%s/proctype' % atype)
-    for exp in types_list:
-        regex = extract_exp(exp, full_regex)
-        if regex.match(proctype):
-            return True
-    return False
+    return get_types_matcher(types_list, full_regex).match(proctype)
 
 
 def is_assessor_usable(assessor_obj):
@@ -1880,6 +1976,293 @@ def islist(argument, argname, function_name):
     return argument
 
 
+def read_transfer_journal(journal_path):
+    """
+    Read the journal of a transfer (JSON sidecar file).
+
+    :param journal_path: path to the journal
+    :return: dictionary from the journal, None if missing or corrupted
+    """
+    try:
+        with open(journal_path, 'r') as f_obj:
+            return json.load(f_obj)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_transfer_journal(journal_path, journal):
+    """
+    Write the journal of a transfer atomically.
+
+    :param journal_path: path to the journal
+    :param journal: dictionary to save
+    :return: None
+    """
+    tmp_path = '%s.tmp' % journal_path
+    with open(tmp_path, 'w') as f_obj:
+        json.dump(journal, f_obj)
+    os.rename(tmp_path, journal_path)
+
+
+def get_response_total_size(response, offset):
+    """
+    Get the full size of the file requested from the HTTP response headers.
+
+    :param response: requests response object
+    :param offset: first byte requested
+    :return: size in bytes or None if unknown
+    """
+    content_range = response.headers.get('Content-Range')
+    if response.status_code == 206 and content_range:
+        total = content_range.rsplit('/', 1)[-1]
+        return int(total) if total.isdigit() else None
+    length = response.headers.get('Content-Length')
+    if length and length.isdigit():
+        return int(length) + (offset if response.status_code == 206 else 0)
+    return None
+
+
+def download_uri_resumable(intf, uri, fpath, size=None,
+                           retries=TRANSFER_RETRIES):
+    """
+    Download a file from XNAT with HTTP range requests.
+
+    The data is written to fpath.part and the transfer recorded in
+    fpath.part.json so an interrupted download (dropped connection or
+    killed process) restarts from the bytes already on disk. Transient
+    HTTP errors (TRANSFER_RETRY_STATUSES) are retried; a range refused by
+    XNAT (416) restarts the download from zero.
+
+    :param intf: pyxnat.Interface object
+    :param uri: URI of the file on XNAT
+    :param fpath: path where to save the file
+    :param size: size of the file if known (from the resource catalog)
+    :param retries: number of retries after a failure
+    :return: fpath
+    """
+    part_path = '%s.part' % fpath
+    journal_path = '%s.json' % part_path
+    journal = read_transfer_journal(journal_path)
+    if not journal or journal.get('uri') != uri or \
+       (size is not None and journal.get('size') not in [None, size]):
+        journal = {'uri': uri, 'size': size}
+        if os.path.exists(part_path):
+            os.remove(part_path)
+    try:
+        os.makedirs(os.path.dirname(fpath))
+    except OSError:
+        # already created (maybe by another thread)
+        if not os.path.isdir(os.path.dirname(fpath)):
+            raise
+    write_transfer_journal(journal_path, journal)
+
+    attempt = 0
+    while True:
+        offset = 0
+        if os.path.exists(part_path):
+            offset = os.path.getsize(part_path)
+        total = journal['size']
+        if total is not None and offset == total:
+            break
+        if total is not None and offset > total:
+            os.remove(part_path)
+            offset = 0
+
+        headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+        try:
+            response = intf.get(uri, stream=True, headers=headers)
+            if response.status_code == 416:
+                # the range does not match the file: start again from zero
+                response.close()
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                journal['size'] = size
+                write_transfer_journal(journal_path, journal)
+                raise IOError('HTTP 416 for the bytes from %d' % offset)
+            if response.status_code in TRANSFER_RETRY_STATUSES:
+                response.close()
+                raise IOError('HTTP %s' % response.status_code)
+            if response.status_code not in [200, 206]:
+                err = '%s: HTTP %s when downloading %s.'
+                raise XnatUtilsError(err % ('download_uri_resumable',
+                                            response.status_code, uri))
+            if total is None:
+                journal['size'] = get_response_total_size(response, offset)
+                write_transfer_journal(journal_path, journal)
+            # 200: the server ignored the range, start again
+            mode = 'ab' if response.status_code == 206 else 'wb'
+            with open(part_path, mode) as f_obj:
+                for chunk in response.iter_content(TRANSFER_CHUNK_SIZE):
+                    f_obj.write(chunk)
+            if journal['size'] is None or \
+               os.path.getsize(part_path) == journal['size']:
+                break
+            raise IOError('connection closed before the end of the file')
+        except IOError as err:
+            attempt += 1
+            if attempt > retries:
+                msg = '%s: failed to download %s after %s attempts: %s'
+                raise XnatUtilsError(msg % ('download_uri_resumable', uri,
+                                            attempt, err))
+            time.sleep(min(2 ** attempt, 60))
+
+    os.rename(part_path, fpath)
+    os.remove(journal_path)
+    return fpath
+
+
+def set_connection_pool(intf, size):
+    """
+    Allow size concurrent HTTP connections to XNAT on the interface.
+
+    The adapters are mounted once per interface (again only for a bigger
+    pool) so the keep-alive connections of the pool are reused.
+
+    :param intf: pyxnat.Interface object
+    :param size: number of connections to keep in the pool
+    :return: None
+    """
+    if getattr(intf, '_dax_pool_size', 0) >= size:
+        return
+    from requests.adapters import HTTPAdapter
+    adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size)
+    intf._http.mount('http://', adapter)
+    intf._http.mount('https://', adapter)
+    intf._dax_pool_size = size
+
+
+def download_catalog_file(intf, resource_uri, resource_dir, filename, size,
+                          digest):
+    """
+    Download one file of a resource catalog and verify size and digest.
+
+    A file already downloaded matching the catalog is not downloaded again.
+
+    :param intf: pyxnat.Interface object
+    :param resource_uri: URI of the resource on XNAT
+    :param resource_dir: local directory of the resource
+    :param filename: path of the file relative to the resource
+    :param size: size of the file from the catalog
+    :param digest: MD5 digest of the file from the catalog (or None)
+    :return: path to the file downloaded
+    """
+    fpath = os.path.join(resource_dir, filename)
+    if os.path.isfile(fpath) and is_same_file(fpath, size, digest):
+        return fpath
+    uri = '%s/files/%s' % (resource_uri, quote(filename))
+    for _ in range(2):
+        download_uri_resumable(intf, uri, fpath, size)
+        if size is None or is_same_file(fpath, size, digest):
+            return fpath
+        os.remove(fpath)
+    err = '%s: file %s does not match the size/digest on XNAT.'
+    raise XnatUtilsError(err % ('download_catalog_file', uri))
+
+
+def download_files_resumable(directory, resource_obj, catalog=None,
+                             workers=DOWNLOAD_WORKERS):
+    """
+    Download the files of a resource from its catalog.
+
+    The files are downloaded concurrently with resumable transfers and
+    verified against the size and digest of the catalog.
+
+    :param directory: Full path to the download directory
+    :param resource_obj: Pyxnat EObject of the resource
+    :param catalog: resource catalog from get_resource_catalog (optional)
+    :param workers: number of files to download at the same time
+    :return: List of all the files downloaded
+    """
+    if catalog is None:
+        catalog = get_resource_catalog(resource_obj)
+    resource_dir = os.path.join(directory, resource_obj.label())
+    return download_catalog_files(resource_obj, resource_dir, catalog,
+                                  workers)
+
+
+def download_catalog_files(resource_obj, resource_dir, catalog,
+                           workers=DOWNLOAD_WORKERS):
+    """
+    Download the files of a resource catalog concurrently in resource_dir.
+
+    :param resource_obj: Pyxnat EObject of the resource
+    :param resource_dir: local directory for the files of the resource
+    :param catalog: resource catalog from get_resource_catalog
+    :param workers: number of files to download at the same time
+    :return: List of all the files downloaded
+    """
+    intf = resource_obj._intf
+    resource_uri = resource_obj._uri
+
+    def download_one(item):
+        filename, (size, digest) = item
+        return download_catalog_file(intf, resource_uri, resource_dir,
+                                     filename, size, digest)
+
+    items = sorted(catalog.items())
+    if workers <= 1 or len(items) <= 1:
+        return [download_one(item) for item in items]
+
+    set_connection_pool(intf, workers)
+    workers = min(workers, len(items))
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(profiling.inherit_rest_counters(download_one), items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def upload_folder_resumable(directory, resource_obj, journal_path,
+                            removeall=False, retries=TRANSFER_RETRIES):
+    """
+    Upload the files of a folder one by one, recording the progress.
+
+    XNAT does not accept partial uploads, so the transfer is resumed at the
+    file level: the files uploaded are saved in the journal and skipped when
+    the upload is restarted after a failure.
+
+    :param directory: Full path of the directory to upload
+    :param resource_obj: pyxnat resource EObject to upload the data to
+    :param journal_path: path to the journal of the upload
+    :param removeall: Remove all of the files on XNAT before the upload
+                      (only when the upload starts, not when it resumes)
+    :param retries: number of retries for each file
+    :return: number of files uploaded
+    """
+    journal = read_transfer_journal(journal_path)
+    if not journal or journal.get('uri') != resource_obj._uri:
+        if removeall and resource_obj.exists():
+            resource_obj.delete()
+        journal = {'uri': resource_obj._uri, 'done': list()}
+        write_transfer_journal(journal_path, journal)
+
+    done = set(journal['done'])
+    nb_files = 0
+    for filename in list_folder_files(directory):
+        if filename in done:
+            continue
+        attempt = 0
+        while True:
+            try:
+                resource_obj.file(filename).put(
+                    os.path.join(directory, filename), overwrite=True)
+                break
+            except Exception as err:
+                attempt += 1
+                if attempt > retries:
+                    msg = '%s: failed to upload %s after %s attempts: %s'
+                    raise XnatUtilsError(msg % ('upload_folder_resumable',
+                                                filename, attempt, err))
+                time.sleep(min(2 ** attempt, 60))
+        journal['done'].append(filename)
+        write_transfer_journal(journal_path, journal)
+        nb_files += 1
+
+    os.remove(journal_path)
+    return nb_files
+
+
 def download_file_from_obj(directory, resource_obj, fname=None):
     """
     Downloads a file from a Pyxnat EObject
@@ -1895,8 +2278,8 @@ def download_file_from_obj(directory, resource_obj, fname=None):
     if fname:
         if resource_obj.file(fname).exists():
             fpath = os.path.join(directory, os.path.basename(fname))
-            resource_obj.file(fname).get(fpath)
-            return fpath
+            uri = '%s/files/%s' % (resource_obj._uri, quote(fname))
+            return download_uri_resumable(resource_obj._intf, uri, fpath)
         else:
             err = 'file %s does not exist for resource %s.'
             raise XnatAccessError(err % (fname, resource_obj.label()))
@@ -1940,6 +2323,17 @@ def download_files_from_obj(directory, resource_obj):
     """
     fpaths = list()
     check_dl_inputs(directory, resource_obj, 'download_files_from_obj')
+    # Download the files from the catalog, the zip only without catalog
+    catalog = get_resource_catalog(resource_obj)
+    if catalog:
+        cache = get_input_cache()
+        if cache:
+            return cache.get_files(
+                resource_obj._uri, catalog,
+                os.path.join(directory, resource_obj.label()),
+                lambda tmp_dir: download_catalog_files(
+                    resource_obj, tmp_dir, catalog))
+        return download_files_resumable(directory, resource_obj, catalog)
     resource_obj.get(directory, extract=True)
     resource_dir = os.path.join(directory, resource_obj.label())
     for root, _, filenames in os.walk(resource_dir):
@@ -2334,19 +2728,167 @@ def upload_folder_to_obj(directory, resource_obj, resource_label, remove=False,
 %s already found on XNAT. No upload. Use remove/removeall." % fpath)
                     return False
 
-    fzip = '%s.zip' % resource_label
-    initdir = os.getcwd()
-    # Zip all the files in the directory
-    os.chdir(directory)
-    os.system('zip -r %s * > /dev/null' % fzip)
-    # upload
-    resource_obj.put_zip(os.path.join(directory, fzip), overwrite=True,
-                         extract=extract)
-    # return to the initial directory:
-    os.chdir(initdir)
+    put_folder_zip(directory, resource_obj, resource_label, extract=extract)
     return True
 
 
+def put_folder_zip(directory, resource_obj, resource_label, filenames=None,
+                   extract=True):
+    """
+    Zip files from a folder and stream the zip to a resource on XNAT
+
+    :param directory: Full path of the directory to upload
+    :param resource_obj: pyxnat EObject to upload the data to
+    :param resource_label: label of the resource (name of the zip)
+    :param filenames: paths relative to directory to upload (default: all)
+    :param extract: extract the files if it's a zip
+    :return: None
+    """
+    fzip = '%s.zip' % resource_label
+    if extract:
+        fzip = '%s?extract=true' % fzip
+    if not resource_obj.exists():
+        resource_obj.create()
+    if filenames is None:
+        filenames = list_folder_files(directory)
+    # Zip the directory in memory or in a temporary file and stream it to
+    # XNAT. Not a SpooledTemporaryFile: requests calls fileno() to get the
+    # size of the body, which writes the spooled file to disk.
+    size = sum(os.path.getsize(os.path.join(directory, filename))
+               for filename in filenames)
+    if size <= ZIP_SPOOL_SIZE:
+        zip_obj = io.BytesIO()
+    else:
+        zip_obj = tempfile.TemporaryFile()
+    with zip_obj:
+        zip_folder(directory, zip_obj, filenames)
+        zip_obj.seek(0)
+        resource_obj.file(fzip).put(zip_obj, overwrite=True)
+
+
+def list_folder_files(directory):
+    """
+    List all the files in a directory, paths relative to the directory.
+
+    :param directory: Full path to the directory
+    :return: sorted list of relative paths
+    """
+    filenames = list()
+    for root, _, files in os.walk(directory, followlinks=True):
+        for filename in files:
+            fpath = os.path.join(root, filename)
+            filenames.append(os.path.relpath(fpath, directory))
+    return sorted(filenames)
+
+
+def zip_folder(directory, zip_obj, filenames=None):
+    """
+    Zip all the files in a directory, paths relative to the directory.
+
+    Files already compressed (see ZIP_STORED_EXTENSIONS) are stored as is.
+
+    :param directory: Full path to the directory to zip
+    :param zip_obj: path or file object to write the zip to
+    :param filenames: paths relative to directory to zip (default: all)
+    :return: None
+    """
+    if filenames is None:
+        filenames = list_folder_files(directory)
+    with zipfile.ZipFile(zip_obj, 'w', allowZip64=True) as myzip:
+        for filename in filenames:
+            if filename.lower().endswith(ZIP_STORED_EXTENSIONS):
+                compress_type = zipfile.ZIP_STORED
+            else:
+                compress_type = zipfile.ZIP_DEFLATED
+            myzip.write(os.path.join(directory, filename), filename,
+                        compress_type=compress_type)
+
+
+def get_file_md5(fpath):
+    """
+    Compute the MD5 digest of a file (same digest as the XNAT catalog).
+
+    :param fpath: path to the file
+    :return: hexadecimal digest
+    """
+    md5 = hashlib.md5()
+    with open(fpath, 'rb') as f_obj:
+        for chunk in iter(lambda: f_obj.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def get_resource_catalog(resource_obj):
+    """
+    Get the files of a resource on XNAT with their size and digest.
+
+    :param resource_obj: pyxnat resource EObject
+    :return: dictionary {path relative to the resource: (size, digest)}.
+             digest is None if XNAT did not compute it.
+    """
+    catalog = dict()
+    if not resource_obj.exists():
+        return catalog
+    intf = resource_obj._intf
+    for fdict in intf._get_json('%s/files' % resource_obj._uri):
+        fpath = unquote(fdict['URI'].split('/files/', 1)[1])
+        size = fdict.get('Size')
+        size = int(size) if size not in [None, ''] else None
+        catalog[fpath] = (size, fdict.get('digest') or None)
+    return catalog
+
+
+def is_same_file(fpath, size, digest):
+    """
+    Check if a local file matches the size/digest of a file on XNAT.
+
+    The digest is only computed when the sizes are the same.
+
+    :param fpath: path to the local file
+    :param size: size of the file on XNAT
+    :param digest: MD5 digest of the file on XNAT (None to skip)
+    :return: True if the files are the same, False otherwise
+    """
+    if size is None or os.path.getsize(fpath) != size:
+        return False
+    return digest is None or get_file_md5(fpath) == digest
+
+
+def sync_folder_to_obj(directory, resource_obj, resource_label, delete=True):
+    """
+    Upload only the new or modified files of a folder to a resource.
+
+    The local files are compared to the resource catalog on XNAT (size and
+    MD5 digest). Files on XNAT missing from the folder are deleted if
+    delete is True.
+
+    :param directory: Full path of the directory to upload
+    :param resource_obj: pyxnat resource EObject to upload the data to
+    :param resource_label: label of the resource
+    :param delete: delete the files on XNAT not found in directory
+    :return: tuple (number of files uploaded, number of files deleted)
+    """
+    if not os.path.isdir(directory):
+        err = '%s: directory %s does not exist.'
+        raise XnatUtilsError(err % ('sync_folder_to_obj', directory))
+
+    catalog = get_resource_catalog(resource_obj)
+    local_files = list_folder_files(directory)
+    to_upload = [fpath for fpath in local_files
+                 if fpath not in catalog or
+                 not is_same_file(os.path.join(directory, fpath),
+                                  *catalog[fpath])]
+    to_delete = list()
+    if delete:
+        to_delete = sorted(set(catalog.keys()) - set(local_files))
+
+    for fpath in to_delete:
+        resource_obj.file(fpath).delete()
+    if to_upload:
+        put_folder_zip(directory, resource_obj, resource_label, to_upload)
+    return len(to_upload), len(to_delete)
+
+
 def upload_folder(directory, project_id=None, subject_id=None, session_id=None,
                   scan_id=None, assessor_id=None, resource=None, remove=False,
                   removeall=False, extract=True):
@@ -2493,13 +3035,11 @@ def filter_list_dicts_regex(list_dicts, key, expressions, nor=False,
 found, <type 'str'> or <type 'list'> required." % type(expressions)
         raise XnatUtilsError(err)
 
-    for exp in expressions:
-        regex = extract_exp(exp, full_regex)
-        if nor:
-            flist = [d for d in flist if not regex.match(d[key])]
-        else:
-            flist.extend([d for d in list_dicts
-                          if regex.match(d[key])])
+    matcher = get_types_matcher(expressions, full_regex)
+    if nor:
+        flist = [d for d in flist if not matcher.match(d[key])]
+    else:
+        flist = [d for d in list_dicts if matcher.match(d[key])]
     return flist
 
 
@@ -2512,9 +3052,72 @@ def extract_exp(expression, full_regex=False):
     """
     if not full_regex:
         exp = fnmatch.translate(expression)
+    else:
+        exp = expression
     return re.compile(exp)
 
 
+class TypesMatcher(object):
+    """ Class to match a value against a list of scan types/proctypes.
+
+    The expressions are compiled once: plain strings (no wildcard) are
+    checked with a set lookup and the others are joined in one regex.
+    """
+    def __init__(self, expressions, full_regex=False):
+        """
+        Entry point of the TypesMatcher class.
+
+        :param expressions: list of expressions (wildcards or regex)
+        :param full_regex: use full regex expressions
+        :return: None
+
+        """
+        self.exact = set()
+        patterns = list()
+        for exp in expressions:
+            if not full_regex and not GLOB_CHARS_RE.search(exp):
+                self.exact.add(exp)
+            elif full_regex:
+                patterns.append('(?:%s)' % exp)
+            else:
+                patterns.append(fnmatch.translate(exp))
+        if patterns:
+            self.regex = re.compile('|'.join(patterns))
+        else:
+            self.regex = None
+
+    def match(self, value):
+        """
+        Check if the value matches one of the expressions.
+
+        :param value: string to check (e.g: scan type)
+        :return: True if it matches, False otherwise
+
+        """
+        if value is None:
+            return False
+        if value in self.exact:
+            return True
+        return self.regex is not None and self.regex.match(value) is not None
+
+
+def get_types_matcher(expressions, full_regex=False):
+    """Get the compiled TypesMatcher for the expressions (cached).
+
+    :param expressions: list of expressions or a single expression
+    :param full_regex: using full regex
+    :return: TypesMatcher object
+    """
+    if isinstance(expressions, basestring):
+        expressions = [expressions]
+    key = (tuple(expressions), full_regex)
+    matcher = TYPES_MATCHERS.get(key)
+    if matcher is None:
+        matcher = TypesMatcher(expressions, full_regex)
+        TYPES_MATCHERS[key] = matcher
+    return matcher
+
+
 def clean_directory(directory):
     """
     Remove a directory tree or file
@@ -2534,26 +3137,24 @@ def clean_directory(directory):
 
 def gzip_nii(directory):
     """
-    Gzip all the NIfTI files in a directory via system call.
+    Gzip all the NIfTI files in a directory (concurrently, in-process).
 
     :param directory: The directory to filter for *.nii files
     :return: None
 
     """
-    for fpath in glob.glob(os.path.join(directory, '*.nii')):
-        os.system('gzip %s' % fpath)
+    compression.gzip_files(glob.glob(os.path.join(directory, '*.nii')))
 
 
 def ungzip_nii(directory):
     """
-    Gunzip all of the NIfTI files in a directory via system call.
+    Gunzip all of the NIfTI files in a directory (concurrently, in-process).
 
     :param directory: The directory to filter for *.nii.gz files
     :return: None
 
     """
-    for fpath in glob.glob(os.path.join(directory, '*.nii.gz')):
-        os.system('gzip -d %s' % fpath)
+    compression.gunzip_files(glob.glob(os.path.join(directory, '*.nii.gz')))
 
 
 def run_matlab(matlab_script, verbose=False, matlab_bin='matlab'):
@@ -2701,16 +3302,15 @@ def executable_exists(executable):
 
 def check_image_format(fpath):
     """
-    Check to see if a NIfTI file or REC file are uncompress and runs gzip via
-     system command if not compressed
+    Check to see if a NIfTI file or REC file are uncompress and gzip them
+     if not compressed
 
     :param fpath: Filepath of a NIfTI or REC file
     :return: the new file path of the gzipped file.
 
     """
     if fpath.endswith('.nii') or fpath.endswith('.rec'):
-        os.system('gzip %s' % fpath)
-        fpath = '%s.gz' % fpath
+        fpath = compression.gzip_file(fpath)
     return fpath
 
 
@@ -3364,35 +3964,24 @@ class CachedResource(object):
 # File Utils
 def gzip_file(file_not_zipped):
     """
-    Method to gzip a file using the gzip python package
+    Method to gzip a file in-process (multi-threaded)
 
     :param file_not_zipped: Full path to a file to gzip
     :return: Full path to the gzipped file
 
     """
-    file_out = list()
-    content = open(file_not_zipped, 'rb')
-    content = content.read()
-    fout = gzip.open(file_not_zipped + '.gz', 'wb')
-    fout.write(content)
-    fout.close()
-    file_out.append(file_not_zipped + '.gz')
-    os.remove(file_not_zipped)
-    return file_out
+    return [compression.gzip_file(file_not_zipped)]
 
 
 def gunzip_file(file_zipped):
     """
-    Gunzips a file using the gzip python package
+    Gunzips a file in-process
 
     :param file_zipped: Full path to the gzipped file
     :return: None
 
     """
-    gzfile = gzip.GzipFile(file_zipped)
-    gzdata = gzfile.read()
-    gzfile.close()
-    open(file_zipped[:-3], 'w').write(gzdata)
+    compression.decompress_file(file_zipped, file_zipped[:-3])
 
 
 def find_files(directory, ext):
@@ -3490,6 +4079,8 @@ def read_excel(excel_file, header_indexes=None):
     if not excel_file.endswith('.xlsx'):
         raise XnatUtilsError('File format unknown. Need .xlsx: %s'
                              % excel_file)
+    import xlrd
+
     # Read the xlsx file:
     book = xlrd.open_workbook(excel_file)
     excel_sheets = dict()
@@ -3519,7 +4110,7 @@ def read_yaml(yaml_file):
     """
     with open(yaml_file, "r") as yaml_stream:
         try:
-            return yaml.load(yaml_stream)
+            return yaml.safe_load(yaml_stream)
         except yaml.error.YAMLError as exc:
             err = 'YAML File {} could not be loaded properly. Error: {}'
             raise XnatUtilsError(err.format(yaml_file, exc))
@@ -3549,6 +4140,8 @@ def order_dicoms(folder):
     :param folder: path to the folder
     :return: dictionary of the files with the key is the slice location
     """
+    import dicom
+
     if not os.path.isdir(folder):
         raise XnatUtilsError('Folder not found: %s' % folder)
     dcm_files = dict()
@@ -3591,6 +4184,9 @@ def write_dicom(pixel_array, filename, ds_copy, ds_ori, volume_number,
     :param sop_id: SOPID for the dicom
     :return: None
     """
+    from dicom.dataset import Dataset, FileDataset
+    import numpy as np
+
     # Set to zero negatives values in the image:
     pixel_array[pixel_array < 0] = 0
 
@@ -3651,6 +4247,10 @@ def convert_nifti_2_dicoms(nifti_path, dicom_targets, dicom_source,
     :param label: name for the output dicom files
     :return: None
     """
+    import dicom
+    import nibabel as nib
+    import numpy as np
+
     if not os.path.isfile(nifti_path):
         raise XnatUtilsError("NIFTI File %s not found." % nifti_path)
     # Load image from NIFTI
@@ -4,18 +4,59 @@
 
 from __future__ import absolute_import
 
-from . import bin
-from . import dax_tools_utils
-from . import log
-from . import xnat_tools_utils
-from . import XnatUtils
-
-from .task import Task
-from .cluster import PBS
-from .launcher import Launcher
-from .dax_settings import DAX_Settings, DAX_Netrc
+import importlib
+import pkgutil
+import sys
+
 from .version import VERSION as __version__
-from .XnatUtils import SpiderProcessHandler, AssessorHandler
-from .modules import ScanModule, SessionModule
-from .spiders import AutoSpider, ScanSpider, SessionSpider
-from .processors import ScanProcessor, SessionProcessor, AutoProcessor
+
+# Submodules and objects of dax are only imported when first accessed
+# (e.g: dax.XnatUtils or dax.AutoSpider) to keep `import dax` fast for the
+# executables and the spiders. The other submodules (e.g: dax.spiders or
+# dax.processors) are imported the same way on first access.
+_LAZY_MODULES = ['bin', 'daemon', 'dax_tools_utils', 'log', 'metrics',
+                 'profiling', 'xnat_tools_utils', 'XnatUtils']
+_LAZY_OBJECTS = {
+    'Task': 'task',
+    'PBS': 'cluster',
+    'Launcher': 'launcher',
+    'DAX_Settings': 'dax_settings',
+    'DAX_Netrc': 'dax_settings',
+    'SpiderProcessHandler': 'XnatUtils',
+    'AssessorHandler': 'XnatUtils',
+    'ScanModule': 'modules',
+    'SessionModule': 'modules',
+    'AutoSpider': 'spiders',
+    'ScanSpider': 'spiders',
+    'SessionSpider': 'spiders',
+    'ScanProcessor': 'processors',
+    'SessionProcessor': 'processors',
+    'AutoProcessor': 'processors',
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_MODULES or name in _get_submodules():
+        return importlib.import_module('.%s' % name, __name__)
+    if name in _LAZY_OBJECTS:
+        module = importlib.import_module('.%s' % _LAZY_OBJECTS[name],
+                                         __name__)
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def _get_submodules():
+    return [mod_name for _, mod_name, _ in pkgutil.iter_modules(__path__)]
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + _LAZY_MODULES +
+                  list(_LAZY_OBJECTS.keys()))
+
+
+if sys.version_info < (3, 7):
+    # No module __getattr__ (PEP 562): import everything now.
+    for _name in _LAZY_MODULES + list(_LAZY_OBJECTS.keys()):
+        globals()[_name] = __getattr__(_name)
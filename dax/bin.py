@@ -8,6 +8,7 @@ from __future__ import print_function
 from builtins import str
 
 from datetime import datetime
+import hashlib
 import imp
 import os
 
@@ -18,6 +19,8 @@ from . import processors
 from .dax_settings import DAX_Settings
 from .errors import DaxError
 DAX_SETTINGS = DAX_Settings()
+# Python files already loaded for modules/processors
+PYTHON_SOURCES = dict()
 
 
 def set_logger(logfile, debug):
@@ -102,7 +105,7 @@ def launch_jobs(settings_path, logfile, debug, projects=None, sessions=None,
 
 
 def build(settings_path, logfile, debug, projects=None, sessions=None,
-          mod_delta=None, proj_lastrun=None):
+          mod_delta=None, proj_lastrun=None, incremental=None):
     """
     Method that is responsible for running all modules and putting assessors
      into the database
@@ -112,6 +115,8 @@ def build(settings_path, logfile, debug, projects=None, sessions=None,
     :param debug: Should debug mode be used
     :param projects: Project(s) that need to be built
     :param sessions: Session(s) that need to be built
+    :param incremental: only build the sessions modified since the last
+     build (default: incremental_build in the settings)
     :return: None
 
     """
@@ -122,7 +127,8 @@ def build(settings_path, logfile, debug, projects=None, sessions=None,
     lockfile_prefix = os.path.splitext(os.path.basename(settings_path))[0]
     try:
         _launcher_obj.build(lockfile_prefix, projects, sessions,
-                            mod_delta=mod_delta, proj_lastrun=proj_lastrun)
+                            mod_delta=mod_delta, proj_lastrun=proj_lastrun,
+                            incremental=incremental)
     except KeyboardInterrupt:
         logger.warn('Killed by user.')
         flagfile = os.path.join(os.path.join(
@@ -223,8 +229,7 @@ def read_yaml_settings(yaml_file, logger):
         mods[mod_dict.get('name')] = load_from_file(
             mod_dict.get('filepath'), mod_dict.get('arguments'), logger)
     procs = dict()
-    processors = doc.get('processors', list())
-    for proc_dict in processors:
+    for proc_dict in doc.get('processors', list()):
         if proc_dict.get('filepath') is None:
             err = 'Filepath not set for {}'.format(proc_dict.get('name'))
             raise DaxError(err)
@@ -271,6 +276,9 @@ def read_yaml_settings(yaml_file, logger):
                     else:
                         yaml_proc[project].append(yamlprocs[yaml_n])
 
+    # Keep the YAML processors read for the next runs:
+    processors.YAML_CACHE.save()
+
     # set in attrs:
     attrs['project_process_dict'] = proj_proc
     attrs['project_modules_dict'] = proj_mod
@@ -316,7 +324,7 @@ def load_from_file(filepath, args, logger):
         raise DaxError('File %s does not exists.' % filepath)
 
     if filepath.endswith('.py'):
-        test = imp.load_source('test', filepath)
+        test = load_python_source(filepath)
         try:
             return eval(_tmp.format(test.__processor_name__))
         except AttributeError:
@@ -331,6 +339,25 @@ def load_from_file(filepath, args, logger):
         logger.err(err.format(filepath))
 
     elif filepath.endswith('.yaml'):
-        return processors.AutoProcessor(filepath, args)
+        return processors.get_auto_processor(filepath, args)
 
     return None
+
+
+def load_python_source(filepath):
+    """
+    Load a python file defining modules/processors only once per run.
+
+    Each file is loaded as its own module (named from the hash of its path)
+    so the files loaded before are not overwritten.
+
+    :param filepath: path to the python file
+    :return: module loaded
+    """
+    filepath = os.path.abspath(filepath)
+    key = (filepath, os.path.getmtime(filepath))
+    if key not in PYTHON_SOURCES:
+        name = 'dax_source_%s' % hashlib.md5(
+            filepath.encode('utf-8')).hexdigest()
+        PYTHON_SOURCES[key] = imp.load_source(name, filepath)
+    return PYTHON_SOURCES[key]
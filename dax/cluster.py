@@ -15,6 +15,8 @@ import logging
 import subprocess as sb
 from datetime import datetime
 
+from . import profiling
+from . import usage_history
 from .dax_settings import DAX_Settings
 from .errors import ClusterError
 
@@ -26,6 +28,18 @@ MAX_TRACE_DAYS = 30
 LOGGER = logging.getLogger('dax')
 
 
+def check_output(cmd, **kwargs):
+    """
+    Run a cluster command (subprocess.check_output) and time it for the
+     profile (--profile).
+
+    :param cmd: command line
+    :return: output of the command
+    """
+    with profiling.command(cmd):
+        return sb.check_output(cmd, **kwargs)
+
+
 def c_output(output):
     """
     Check if the output value is an integer
@@ -50,12 +64,12 @@ def count_jobs():
     """
     if command_found(cmd=DAX_SETTINGS.get_cmd_submit()):
         cmd = DAX_SETTINGS.get_cmd_count_nb_jobs()
-        output = sb.check_output(cmd, shell=True)
+        output = check_output(cmd, shell=True)
         error = c_output(output)
         while error:
             LOGGER.info('    try again to access number of jobs in 2 seconds.')
             time.sleep(2)
-            output = sb.check_output(cmd, shell=True)
+            output = check_output(cmd, shell=True)
             error = c_output(output)
         if int(output) < 0:
             return 0
@@ -77,7 +91,7 @@ def job_status(jobid):
     cmd = DAX_SETTINGS.get_cmd_get_job_status()\
                       .safe_substitute({'jobid': jobid})
     try:
-        output = sb.check_output(cmd, stderr=sb.STDOUT, shell=True)
+        output = check_output(cmd, stderr=sb.STDOUT, shell=True)
         output = output.strip()
         if output == DAX_SETTINGS.get_running_status():
             return 'R'
@@ -141,7 +155,7 @@ def get_job_mem_used(jobid, diff_days):
                       .safe_substitute({'numberofdays': diff_days,
                                         'jobid': jobid})
     try:
-        output = sb.check_output(cmd, stderr=sb.STDOUT, shell=True)
+        output = check_output(cmd, stderr=sb.STDOUT, shell=True)
         if output.startswith('sacct: error'):
             raise ClusterError(output)
         if output:
@@ -171,7 +185,7 @@ def get_job_walltime_used(jobid, diff_days):
                                         'jobid': jobid})
 
     try:
-        output = sb.check_output(cmd, stderr=sb.STDOUT, shell=True)
+        output = check_output(cmd, stderr=sb.STDOUT, shell=True)
         if output:
             walltime = output.strip()
 
@@ -199,7 +213,7 @@ def get_job_node(jobid, diff_days):
 
     if jobid == 'no_qsub':
         cmd = 'uname -a'
-        output = sb.check_output(cmd, stderr=sb.STDOUT, shell=True)
+        output = check_output(cmd, stderr=sb.STDOUT, shell=True)
         if output and len(output.strip().split(' ')) > 1:
             jobnode = output.strip().split(' ')[1]
         return jobnode
@@ -209,7 +223,7 @@ def get_job_node(jobid, diff_days):
                                         'jobid': jobid})
 
     try:
-        output = sb.check_output(cmd, stderr=sb.STDOUT, shell=True)
+        output = check_output(cmd, stderr=sb.STDOUT, shell=True)
         if output:
             jobnode = output.strip()
 
@@ -252,7 +266,8 @@ class PBS(object):   # The script file generator class
     """ PBS class to generate/submit the cluster file to run a task """
     def __init__(self, filename, outfile, cmds, walltime_str, mem_mb=2048,
                  ppn=1, env=None, email=None,
-                 email_options=DAX_SETTINGS.get_email_opts(), xnat_host=None):
+                 email_options=DAX_SETTINGS.get_email_opts(), xnat_host=None,
+                 proctype=None, version=None, assessor=None):
         """
         Entry point for the PBS class
 
@@ -266,6 +281,9 @@ class PBS(object):   # The script file generator class
         :param email: email address to set for the script
         :param email_options: email options to set for the script
         :param xnat_host: set the XNAT_HOST for the job (export)
+        :param proctype: proctype of the job (right_size option)
+        :param version: version of the spider (right_size option)
+        :param assessor: assessor label of the job (right_size option)
         :return: None
         """
         self.filename = filename
@@ -284,13 +302,28 @@ class PBS(object):   # The script file generator class
             self.xnat_host = xnat_host
         else:
             self.xnat_host = os.environ['XNAT_HOST']
+        self.proctype = proctype
+        self.version = version
+        self.assessor = assessor
 
     def write(self):
         """
         Write the file
 
+        The memory and walltime are set from the usage history of the
+        proctype when right_size is enabled in the settings.
+
         :return: None
         """
+        if self.proctype and DAX_SETTINGS.get_right_size():
+            mem_mb, walltime_str = usage_history.right_size(
+                self.proctype, self.version, self.mem_mb, self.walltime_str,
+                self.assessor)
+            if (mem_mb, walltime_str) != (self.mem_mb, self.walltime_str):
+                LOGGER.info('right size for %s: memory %sMB -> %sMB, \
+walltime %s -> %s' % (self.proctype, self.mem_mb, mem_mb,
+                      self.walltime_str, walltime_str))
+                self.mem_mb, self.walltime_str = mem_mb, walltime_str
         # pbs_dir
         job_dir = os.path.dirname(self.filename)
         if not os.path.exists(job_dir):
@@ -331,8 +364,9 @@ def submit_job(filename, outlog=None, force_no_qsub=False):
     if command_found(cmd=submit_cmd) and not force_no_qsub:
         try:
             cmd = '%s %s' % (submit_cmd, filename)
-            proc = sb.Popen(cmd.split(), stdout=sb.PIPE, stderr=sb.PIPE)
-            output, error = proc.communicate()
+            with profiling.command(cmd):
+                proc = sb.Popen(cmd.split(), stdout=sb.PIPE, stderr=sb.PIPE)
+                output, error = proc.communicate()
             if output:
                 LOGGER.info(output)
             if error:
@@ -345,8 +379,9 @@ def submit_job(filename, outlog=None, force_no_qsub=False):
 
     else:
         cmd = 'sh %s' % (filename)
-        proc = sb.Popen(cmd.split(), stdout=sb.PIPE, stderr=sb.PIPE)
-        output, error = proc.communicate()
+        with profiling.command(cmd):
+            proc = sb.Popen(cmd.split(), stdout=sb.PIPE, stderr=sb.PIPE)
+            output, error = proc.communicate()
         if outlog:
             with open(outlog, 'w') as log_obj:
                 for line in output:
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" compression.py
+
+In-process gzip compression of NIfTI/REC files using several threads.
+
+A file is split in blocks compressed concurrently (zlib releases the GIL),
+each block written as its own gzip member like pigz --independent does: the
+output is a standard gzip file readable by gzip, zlib, nibabel or FSL.
+"""
+
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import gzip
+import os
+import shutil
+import struct
+import zlib
+
+
+__copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
+GZIP_BLOCK_SIZE = 4 * 1024 ** 2
+GZIP_LEVEL = 6
+# gzip member header: magic, deflate, no flags, no mtime, no extra, unix
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\x03'
+# Variables with the number of CPUs of the job: SLURM, SGE, PBS and the job
+# templates of dax (ppn)
+CPU_ENV_VARS = ['SLURM_CPUS_PER_TASK', 'SLURM_NTASKS', 'NSLOTS',
+                'PBS_NUM_PPN', 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS']
+
+
+def get_cpus():
+    """
+    Number of CPUs the process can use.
+
+    On a node shared by several jobs, cpu_count() is the number of CPUs of
+    the node: the CPUs of the job are given by the scheduler variables
+    (CPU_ENV_VARS) and the CPU affinity of the process.
+
+    :return: number of CPUs
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        try:
+            cpus = cpu_count()
+        except NotImplementedError:
+            cpus = 1
+    for var in CPU_ENV_VARS:
+        try:
+            job_cpus = int(os.environ.get(var, 0))
+        except ValueError:
+            continue
+        if job_cpus > 0:
+            return max(1, min(cpus, job_cpus))
+    return max(1, cpus)
+
+
+def get_threads(threads=None):
+    """
+    Number of threads to use for the compression (default: the CPUs of the
+    job, see get_cpus).
+
+    :param threads: number of threads asked or None
+    :return: number of threads
+    """
+    if threads:
+        return max(1, int(threads))
+    return get_cpus()
+
+
+def compress_block(data, level=GZIP_LEVEL):
+    """
+    Compress a block of data into a complete gzip member.
+
+    :param data: bytes to compress
+    :param level: compression level (1-9)
+    :return: gzip member (bytes)
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    trailer = struct.pack('<II', zlib.crc32(data) & 0xffffffff,
+                          len(data) & 0xffffffff)
+    return GZIP_HEADER + deflated + trailer
+
+
+def compress_file(src, dst, threads=None, level=GZIP_LEVEL):
+    """
+    Gzip src into dst with the blocks compressed by several threads.
+
+    dst is written in a temporary file renamed at the end.
+
+    :param src: path to the file to compress
+    :param dst: path to the gzip file to create
+    :param threads: number of threads (default: the CPUs of the job)
+    :param level: compression level (1-9)
+    :return: dst
+    """
+    threads = get_threads(threads)
+    tmp_path = '%s.tmp%s' % (dst, os.getpid())
+    pool = ThreadPool(threads) if threads > 1 else None
+    try:
+        with open(src, 'rb') as f_in, open(tmp_path, 'wb') as f_out:
+            empty = True
+            while True:
+                # Read a few blocks per thread at a time to bound the memory
+                blocks = list()
+                for _ in range(threads * 2):
+                    block = f_in.read(GZIP_BLOCK_SIZE)
+                    if not block:
+                        break
+                    blocks.append(block)
+                if not blocks:
+                    break
+                empty = False
+                if pool:
+                    members = pool.map(lambda b: compress_block(b, level),
+                                       blocks)
+                else:
+                    members = [compress_block(b, level) for b in blocks]
+                for member in members:
+                    f_out.write(member)
+            if empty:
+                f_out.write(compress_block(b'', level))
+        shutil.copystat(src, tmp_path)
+        os.rename(tmp_path, dst)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return dst
+
+
+def decompress_file(src, dst):
+    """
+    Gunzip src into dst in-process (gzip decompression is sequential).
+
+    :param src: path to the gzip file
+    :param dst: path to the file to create
+    :return: dst
+    """
+    tmp_path = '%s.tmp%s' % (dst, os.getpid())
+    try:
+        with gzip.open(src, 'rb') as f_in, open(tmp_path, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, GZIP_BLOCK_SIZE)
+        shutil.copystat(src, tmp_path)
+        os.rename(tmp_path, dst)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return dst
+
+
+def gzip_file(fpath, threads=None, remove=True):
+    """
+    Gzip a file to fpath.gz like the gzip command.
+
+    :param fpath: path to the file to compress
+    :param threads: number of threads (default: the CPUs of the job)
+    :param remove: remove the original file
+    :return: path to the gzip file
+    """
+    gz_path = compress_file(fpath, '%s.gz' % fpath, threads)
+    if remove:
+        os.remove(fpath)
+    return gz_path
+
+
+def gunzip_file(fpath, remove=True):
+    """
+    Gunzip a .gz file like the gzip -d command.
+
+    :param fpath: path to the gzip file
+    :param remove: remove the gzip file
+    :return: path to the file decompressed
+    """
+    out_path = decompress_file(fpath, fpath[:-3])
+    if remove:
+        os.remove(fpath)
+    return out_path
+
+
+def _run_on_files(function, fpaths, threads):
+    """Run function(fpath, threads) on the files concurrently."""
+    threads = get_threads(threads)
+    if len(fpaths) <= 1:
+        return [function(fpath, threads) for fpath in fpaths]
+    workers = min(len(fpaths), threads)
+    # Share the threads between the files compressed at the same time
+    file_threads = max(1, threads // workers)
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(lambda fpath: function(fpath, file_threads), fpaths)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def gzip_files(fpaths, threads=None):
+    """
+    Gzip several files concurrently (each one replaced by fpath.gz).
+
+    :param fpaths: list of paths to compress
+    :param threads: total number of threads (default: the CPUs of the job)
+    :return: list of the gzip files
+    """
+    return _run_on_files(gzip_file, fpaths, threads)
+
+
+def gunzip_files(fpaths, threads=None):
+    """
+    Gunzip several .gz files concurrently (each one replaced by its content).
+
+    :param fpaths: list of gzip files
+    :param threads: number of files decompressed at the same time
+    :return: list of the files decompressed
+    """
+    return _run_on_files(lambda fpath, _: gunzip_file(fpath), fpaths, threads)
@@ -0,0 +1,506 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" daemon.py
+
+Long-running dax process (dax daemon) replacing the cron jobs running
+dax build, dax update, dax launch and dax upload.
+
+The settings, the processors and the connections to XNAT are loaded once and
+kept in memory. build/update/launch share the launcher and run one at a time
+in the main loop, each at its own cadence; upload runs in its own thread as
+it only depends on RESULTS_DIR. A build pass only looks at the sessions
+modified since the previous pass except every full_build passes.
+
+The upload thread watches RESULTS_DIR (see upload_watcher) and uploads the
+assessors as soon as their spider writes the flag files; the upload cadence
+is the maximum time between two uploads of the PBS/OUTLOG files.
+
+The flag files of the cron executables are used the same way: a phase is
+skipped while its flag file exists (e.g. a dax build started by cron).
+With a port, the state of the phases is served as JSON on
+http://127.0.0.1:<port>/.
+"""
+
+from __future__ import print_function
+
+from future import standard_library
+standard_library.install_aliases()
+from builtins import object
+
+from collections import OrderedDict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import os
+import signal
+import threading
+import time
+import traceback
+
+from . import bin
+from . import launcher
+from . import metrics
+from . import upload_watcher
+from . import XnatUtils
+from . import dax_tools_utils
+from .dax_settings import DAX_Settings
+
+
+__copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
+DAX_SETTINGS = DAX_Settings()
+# Seconds between two runs of each phase (0 to disable a phase)
+DEFAULT_CADENCES = OrderedDict([('update', 300),
+                                ('launch', 300),
+                                ('build', 900),
+                                ('upload', 120)])
+# One build pass out of FULL_BUILD_EVERY looks at all the sessions
+FULL_BUILD_EVERY = 8
+# Re-authenticate the XNAT session (JSESSION) older than that (seconds)
+SESSION_MAX_AGE = 10 * 60
+FLAGFILE_SUFFIXES = {'build': launcher.BUILD_SUFFIX,
+                     'update': launcher.UPDATE_SUFFIX,
+                     'launch': launcher.LAUNCH_SUFFIX}
+# Logger to print logs
+LOGGER = logging.getLogger('dax')
+
+
+class PersistentInterface(object):
+    """ Connection to XNAT kept open between the runs of the daemon """
+    def __init__(self, host=None, user=None, pwd=None,
+                 max_age=SESSION_MAX_AGE):
+        """
+        Entry point for the PersistentInterface class.
+
+        Used like XnatUtils.get_interface() in a with statement but the
+        connection is not closed at the end of the block.
+
+        :param host: XNAT host (default: $XNAT_HOST)
+        :param user: XNAT user (default: from the netrc file)
+        :param pwd: XNAT password
+        :param max_age: seconds before re-authenticating the session
+        :return: None
+        """
+        self.host = host
+        self.user = user
+        self.pwd = pwd
+        self.max_age = max_age
+        self.xnat = None
+        self.auth_time = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        """
+        Get the connection, re-authenticated if its session is too old.
+
+        :return: XnatUtils.InterfaceTemp object
+        """
+        with self.lock:
+            if self.xnat is None:
+                self.xnat = XnatUtils.get_interface(self.host, self.user,
+                                                    self.pwd)
+                self.auth_time = time.time()
+            elif time.time() - self.auth_time > self.max_age:
+                self.xnat.authenticate()
+                self.auth_time = time.time()
+            return self.xnat
+
+    def __enter__(self):
+        return self.get()
+
+    def __exit__(self, type, value, traceback):
+        # Connection lost: open a new one next time
+        if type is not None and self.xnat is not None:
+            self.auth_time = 0
+
+    def close(self):
+        """Disconnect from XNAT."""
+        with self.lock:
+            if self.xnat is not None:
+                try:
+                    self.xnat.disconnect()
+                except Exception as err:
+                    LOGGER.warn('cannot disconnect from XNAT: %s' % err)
+                self.xnat = None
+
+
+class PhaseStatus(object):
+    """ State of a phase of the daemon """
+    def __init__(self, name, cadence):
+        """
+        Entry point for the PhaseStatus class.
+
+        :param name: build, update, launch or upload
+        :param cadence: seconds between two runs
+        :return: None
+        """
+        self.name = name
+        self.cadence = cadence
+        self.runs = 0
+        self.errors = 0
+        self.skipped = 0
+        self.running = False
+        self.last_start = None
+        self.last_end = None
+        self.last_error = None
+        self.next_run = time.time()
+
+    def to_dict(self):
+        """State of the phase for the status endpoint."""
+        def _date(timestamp):
+            if timestamp is None:
+                return None
+            return datetime.fromtimestamp(timestamp).isoformat()
+
+        duration = None
+        if self.last_start and self.last_end and \
+           self.last_end >= self.last_start:
+            duration = round(self.last_end - self.last_start, 1)
+        return {'cadence': self.cadence,
+                'runs': self.runs,
+                'errors': self.errors,
+                'skipped': self.skipped,
+                'running': self.running,
+                'last_start': _date(self.last_start),
+                'last_end': _date(self.last_end),
+                'last_duration': duration,
+                'last_error': self.last_error,
+                'next_run': _date(self.next_run)}
+
+
+class DaxDaemon(object):
+    """ Class running the dax phases in a loop """
+    def __init__(self, settings_path, cadences=None,
+                 full_build_every=FULL_BUILD_EVERY, port=None,
+                 upload_settings=None, workers=1, emailaddress=None,
+                 upload_poll=None):
+        """
+        Entry point for the DaxDaemon class.
+
+        :param settings_path: settings file of the launcher (.py or .yaml)
+        :param cadences: dictionary {phase: seconds between runs}
+        :param full_build_every: one build out of full_build_every looks at
+                                 all the sessions
+        :param port: local port of the status endpoint (None: disabled)
+        :param upload_settings: file defining the hosts/projects to upload
+                                (default: host and projects of the launcher)
+        :param workers: number of assessors to upload at the same time
+        :param emailaddress: email address for the upload warnings
+        :param upload_poll: True to poll RESULTS_DIR instead of using inotify
+                            (default: poll only on a network filesystem)
+        :return: None
+        """
+        self.settings_path = settings_path
+        self.lockfile_prefix = os.path.splitext(
+            os.path.basename(settings_path))[0]
+        self.full_build_every = max(1, int(full_build_every))
+        self.port = port
+        self.upload_settings = upload_settings
+        self.workers = workers
+        self.emailaddress = emailaddress
+        self.upload_poll = upload_poll
+        _cadences = DEFAULT_CADENCES.copy()
+        _cadences.update(cadences or dict())
+        self.phases = OrderedDict(
+            (name, PhaseStatus(name, int(cadence)))
+            for name, cadence in list(_cadences.items()) if cadence)
+        self.started = time.time()
+        self.stop_event = threading.Event()
+        self.launcher = None
+        self.settings_mtime = None
+        self.interface = None
+        self.upload_interfaces = dict()
+        self.watcher = None
+        self.builds = 0
+        self.last_build = None
+        self.status_server = None
+
+    # Settings and connections
+    def load_launcher(self):
+        """Read the settings file again if it changed."""
+        mtime = os.path.getmtime(self.settings_path)
+        if self.launcher is not None and mtime == self.settings_mtime:
+            return
+        if self.launcher is not None:
+            LOGGER.info('settings file changed, reloading: %s'
+                        % self.settings_path)
+        self.launcher = bin.read_settings(self.settings_path, LOGGER,
+                                          exe='daemon')
+        self.settings_mtime = mtime
+        if self.interface is None:
+            self.interface = PersistentInterface(self.launcher.xnat_host,
+                                                 self.launcher.xnat_user,
+                                                 self.launcher.xnat_pass)
+        self.launcher.interface = self.interface
+
+    def get_upload_settings(self):
+        """Hosts/projects to upload (settings file or the launcher)."""
+        if self.upload_settings:
+            return dax_tools_utils.load_upload_settings(
+                self.upload_settings, None, None, None, None)
+        projects = sorted(set(
+            list(self.launcher.project_process_dict.keys()) +
+            list(self.launcher.project_modules_dict.keys())))
+        return [{'host': self.launcher.xnat_host or
+                 os.environ.get('XNAT_HOST'),
+                 'username': self.launcher.xnat_user,
+                 'password': self.launcher.xnat_pass,
+                 'projects': projects}]
+
+    def get_upload_interface(self, upload_dict):
+        """Persistent connection to the host of an upload setting."""
+        key = (upload_dict['host'], upload_dict['username'])
+        if key not in self.upload_interfaces:
+            self.upload_interfaces[key] = PersistentInterface(
+                upload_dict['host'], upload_dict['username'],
+                upload_dict['password'])
+        return self.upload_interfaces[key]
+
+    def get_flagfile(self, phase):
+        """Flag file of the cron executable for a phase."""
+        flag_dir = os.path.join(DAX_SETTINGS.get_results_dir(), 'FlagFiles')
+        if phase == 'upload':
+            return '%s.txt' % dax_tools_utils.FLAGFILE_TEMPLATE
+        return os.path.join(flag_dir, '%s_%s' % (self.lockfile_prefix,
+                                                 FLAGFILE_SUFFIXES[phase]))
+
+    # Phases
+    def run_build(self):
+        """Build the sessions (modified since the last build if possible)."""
+        start = datetime.now()
+        proj_lastrun = None
+        if self.builds % self.full_build_every and self.last_build:
+            LOGGER.info('incremental build since %s' % self.last_build)
+            proj_lastrun = dict(
+                (project, self.last_build)
+                for project in self.launcher.project_process_dict)
+        self.launcher.build(self.lockfile_prefix, None, None,
+                            proj_lastrun=proj_lastrun)
+        self.builds += 1
+        self.last_build = start
+
+    def run_update(self):
+        """Update the open tasks."""
+        self.launcher.update_tasks(self.lockfile_prefix, None, None)
+
+    def run_launch(self):
+        """Launch the tasks that need to run."""
+        self.launcher.launch_jobs(self.lockfile_prefix, None, None)
+
+    def run_upload(self, assessors_list=None):
+        """
+        Upload the results of the jobs finished.
+
+        :param assessors_list: labels of the assessors ready to upload
+                               (default: look for them in RESULTS_DIR)
+        :return: False if a dax upload is already running
+        """
+        dax_tools_utils.check_folders()
+        flagfile = self.get_flagfile('upload')
+        if dax_tools_utils.is_dax_upload_running(flagfile):
+            return False
+        try:
+            warnings = list()
+            metrics.start_pass('upload')
+            for upload_dict in self.get_upload_settings():
+                with self.get_upload_interface(upload_dict) as xnat:
+                    warnings.extend(dax_tools_utils.upload_host(
+                        xnat, upload_dict, self.workers,
+                        assessors_list=assessors_list))
+            metrics.end_pass()
+            dax_tools_utils.send_warning_emails(warnings, self.emailaddress)
+        finally:
+            os.remove(flagfile)
+        return True
+
+    def run_phase(self, phase, *args):
+        """
+        Run a phase once and record its state.
+
+        :param phase: PhaseStatus object
+        :param args: arguments of the run_<phase> method
+        :return: None
+        """
+        flagfile = self.get_flagfile(phase.name)
+        if phase.name != 'upload' and os.path.exists(flagfile):
+            LOGGER.info('daemon: %s skipped, %s exists (already running)'
+                        % (phase.name, flagfile))
+            phase.skipped += 1
+            phase.next_run = time.time() + phase.cadence
+            return
+
+        LOGGER.info('daemon: running %s' % phase.name)
+        phase.running = True
+        phase.last_start = time.time()
+        try:
+            if phase.name != 'upload':
+                self.load_launcher()
+            if getattr(self, 'run_%s' % phase.name)(*args) is False:
+                phase.skipped += 1
+            else:
+                phase.runs += 1
+        except (Exception, SystemExit) as err:
+            phase.errors += 1
+            phase.last_error = '%s: %s' % (err.__class__.__name__, err)
+            LOGGER.critical('Caught exception running %s in the daemon'
+                            % phase.name)
+            LOGGER.critical(traceback.format_exc())
+            if phase.name != 'upload':
+                # Same as the executables: release the lock
+                launcher.Launcher.unlock_flagfile(flagfile)
+        finally:
+            phase.running = False
+            phase.last_end = time.time()
+            phase.next_run = phase.last_end + phase.cadence
+        LOGGER.info('daemon: %s done in %.1fs'
+                    % (phase.name, phase.last_end - phase.last_start))
+
+    def loop(self, names):
+        """
+        Run the phases in names when they are due until the daemon stops.
+
+        :param names: list of phase names run one at a time
+        :return: None
+        """
+        phases = [self.phases[name] for name in names if name in self.phases]
+        while phases and not self.stop_event.is_set():
+            phase = min(phases, key=lambda _phase: _phase.next_run)
+            wait = phase.next_run - time.time()
+            if wait > 0:
+                self.stop_event.wait(wait)
+                continue
+            self.run_phase(phase)
+
+    def upload_loop(self):
+        """
+        Upload the assessors when they are ready until the daemon stops.
+
+        :return: None
+        """
+        phase = self.phases['upload']
+        dax_tools_utils.check_folders()
+        self.watcher = upload_watcher.UploadWatcher(
+            dax_tools_utils.RESULTS_DIR, dax_tools_utils.is_ready_to_upload,
+            dax_tools_utils._UPLOAD_SKIP_LIST, self.upload_poll)
+        LOGGER.info('daemon: watching %s for the assessors to upload (%s)'
+                    % (dax_tools_utils.RESULTS_DIR, self.watcher.mode))
+        try:
+            while not self.stop_event.is_set():
+                labels = self.watcher.wait(
+                    min(1.0, max(0, phase.next_run - time.time())))
+                if labels or time.time() >= phase.next_run:
+                    self.run_phase(phase, labels)
+                    self.watcher.done(labels)
+        finally:
+            self.watcher.close()
+
+    # Status endpoint
+    def status(self):
+        """
+        State of the daemon.
+
+        :return: dictionary
+        """
+        return {'pid': os.getpid(),
+                'settings': os.path.abspath(self.settings_path),
+                'started': datetime.fromtimestamp(self.started).isoformat(),
+                'uptime': round(time.time() - self.started, 1),
+                'builds': self.builds,
+                'upload_watch': self.watcher.mode if self.watcher else None,
+                'phases': dict((name, phase.to_dict())
+                               for name, phase in list(self.phases.items()))}
+
+    def start_status_server(self):
+        """Serve the status as JSON on 127.0.0.1:port in a thread."""
+        daemon = self
+
+        class StatusHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(daemon.status(), indent=2).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                LOGGER.debug('status endpoint: ' + format % args)
+
+        self.status_server = HTTPServer(('127.0.0.1', int(self.port)),
+                                        StatusHandler)
+        thread = threading.Thread(target=self.status_server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        LOGGER.info('daemon status on http://127.0.0.1:%s/'
+                    % self.status_server.server_port)
+
+    # Main
+    def stop(self, *args):
+        """Stop the daemon after the phases running."""
+        LOGGER.info('daemon: stopping...')
+        self.stop_event.set()
+
+    def run(self):
+        """
+        Run the daemon until SIGINT/SIGTERM.
+
+        :return: None
+        """
+        LOGGER.info('daemon: pid %s, phases: %s' % (
+            os.getpid(), ', '.join('%s every %ss' % (name, phase.cadence)
+                                   for name, phase in
+                                   list(self.phases.items()))))
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.load_launcher()
+        if self.port is not None:
+            self.start_status_server()
+
+        upload_thread = None
+        if 'upload' in self.phases:
+            upload_thread = threading.Thread(target=self.upload_loop)
+            upload_thread.daemon = True
+            upload_thread.start()
+        try:
+            self.loop(['update', 'launch', 'build'])
+            # Wait for the upload phase only
+            while upload_thread and upload_thread.is_alive() and \
+                    not self.stop_event.is_set():
+                self.stop_event.wait(1)
+        finally:
+            self.stop_event.set()
+            if upload_thread:
+                upload_thread.join()
+            if self.status_server:
+                self.status_server.shutdown()
+            if self.interface:
+                self.interface.close()
+            for interface in list(self.upload_interfaces.values()):
+                interface.close()
+        LOGGER.info('daemon: stopped')
+
+
+def run_daemon(settings_path, logfile, debug, cadences=None,
+               full_build_every=FULL_BUILD_EVERY, port=None,
+               upload_settings=None, workers=1, emailaddress=None,
+               upload_poll=None):
+    """
+    Method to run dax as a daemon (dax daemon)
+
+    :param settings_path: Path to the project settings file
+    :param logfile: Full file of the file used to log to
+    :param debug: Should debug mode be used
+    :param cadences: dictionary {phase: seconds between runs, 0 to disable}
+    :param full_build_every: one build out of full_build_every looks at all
+                             the sessions
+    :param port: local port of the status endpoint (None: disabled)
+    :param upload_settings: file defining the hosts/projects to upload
+    :param workers: number of assessors to upload at the same time
+    :param emailaddress: email address for the upload warnings
+    :param upload_poll: True to poll RESULTS_DIR instead of using inotify
+    :return: None
+    """
+    bin.set_logger(logfile, debug)
+    DaxDaemon(settings_path, cadences, full_build_every, port,
+              upload_settings, workers, emailaddress, upload_poll).run()
@@ -593,6 +593,67 @@ class DAX_Settings(object):
         """
         return self.get('cluster', 'launcher_type')
 
+    def get_optional(self, header, key, default=None):
+        """Getter for an option that can be missing (no warning).
+
+        :param header: The header section that is associated with the key
+        :param key: String which is a key to to a variable in the ini file
+        :param default: value returned if the option is missing or empty
+        :return: The value of the key or default
+        """
+        if self.config_parser.has_option(header, key):
+            value = self.config_parser.get(header, key)
+            if value:
+                return value
+        return default
+
+    def get_usage_db(self):
+        """Get the usage_db value from the cluster section.
+
+        Path to the history of the resources used by the jobs.
+
+        :return: String of the usage_db value, None if empty
+        """
+        usage_db = self.get_optional('cluster', 'usage_db')
+        if usage_db and usage_db.startswith('~'):
+            return os.path.join(os.path.expanduser('~'), usage_db[2:])
+        return usage_db
+
+    def get_right_size(self):
+        """Get the right_size value from the cluster section.
+
+        :return: True if the job resources are set from the usage history
+        """
+        value = self.get_optional('cluster', 'right_size', 'false')
+        return value.lower() in ['true', 'yes', 'on', '1']
+
+    def get_right_size_factor(self):
+        """Get the right_size_factor value from the cluster section.
+
+        :return: float of the safety factor applied on the usage (1.2)
+        """
+        return float(self.get_optional('cluster', 'right_size_factor', 1.2))
+
+    def get_right_size_min_jobs(self):
+        """Get the right_size_min_jobs value from the cluster section.
+
+        :return: int of the number of jobs needed in the history (10)
+        """
+        return int(self.get_optional('cluster', 'right_size_min_jobs', 10))
+
+    def get_metrics_dir(self):
+        """Get the metrics_dir value from the cluster section.
+
+        Folder of the Prometheus textfile collector where each pass of
+        build/update/launch/upload writes its metrics.
+
+        :return: String of the metrics_dir value, None if empty
+        """
+        metrics_dir = self.get_optional('cluster', 'metrics_dir')
+        if metrics_dir and metrics_dir.startswith('~'):
+            return os.path.join(os.path.expanduser('~'), metrics_dir[2:])
+        return metrics_dir
+
     def get_api_url(self):
         """Get the api_url value from the dax_manager section.
 
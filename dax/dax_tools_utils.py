@@ -36,22 +36,29 @@ import socket
 import stat
 import subprocess as sb
 import sys
+import threading
 import time
 import traceback
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 from . import bin
 from . import launcher
 from . import log
+from . import metrics
 from . import modules
 from . import processors
+from . import profiling
+from . import resource_usage
 from . import task
+from . import usage_history
 from . import xnat_tools_utils
 from . import XnatUtils
 from .dax_settings import (DAX_Settings, DAX_Netrc, DEFAULT_DATATYPE,
                            DEFAULT_FS_DATATYPE)
 from .errors import DaxUploadError, AutoProcessorError, DaxSetupError, DaxError
 from .task import (READY_TO_COMPLETE, COMPLETE, UPLOADING, JOB_FAILED,
-                   JOB_PENDING, NEEDS_QA)
+                   JOB_PENDING, NEEDS_QA, READY_TO_UPLOAD)
 from .task import ClusterTask
 from .XnatUtils import XnatUtilsError
 from .version import VERSION as __version__
@@ -105,7 +112,12 @@ CLUSTER_DEFAULTS = OrderedDict([
                                  'RESULTS_XNAT_SPIDER')),
     ('max_age', '14'),
     ('launcher_type', 'xnatq-combined'),
-    ('skip_lastupdate', '')])
+    ('skip_lastupdate', ''),
+    ('usage_db', os.path.join(os.path.expanduser('~'), '.dax_usage.db')),
+    ('right_size', 'false'),
+    ('right_size_factor', '1.2'),
+    ('right_size_min_jobs', '10'),
+    ('metrics_dir', '')])
 
 CODE_PATH_DEFAULTS = OrderedDict([
     ('processors_path', ''),
@@ -384,17 +396,30 @@ _OUTLOG = 'OUTLOG'
 _TRASH = 'TRASH'
 _PBS = 'PBS'
 _FLAG_FILES = 'FlagFiles'
-_UPLOAD_SKIP_LIST = [_OUTLOG, _TRASH, _PBS, _FLAG_FILES]
+_CACHE = 'CACHE'
+_UPLOAD_LOCK_FILE = 'UPLOAD_LOCK.txt'
+# Hours after which the upload lock of an assessor is considered stale
+UPLOAD_LOCK_EXPIRY = 24
+_UPLOAD_JOURNAL_TEMPLATE = '{resource}_UPLOAD_JOURNAL.json'
+# Maximum size of the assessors being uploaded at the same time (bytes)
+UPLOAD_BYTES_IN_FLIGHT = 20 * 1024 ** 3
+# Resources bigger than this are uploaded file by file and can be resumed
+RESUMABLE_UPLOAD_SIZE = 2 * 1024 ** 3
+_UPLOAD_SKIP_LIST = [_OUTLOG, _TRASH, _PBS, _FLAG_FILES, _CACHE]
 FLAGFILE_TEMPLATE = os.path.join(RESULTS_DIR, _FLAG_FILES,
                                  'Process_Upload_running')
 SNAPSHOTS_ORIGINAL = 'snapshot_original.png'
 SNAPSHOTS_PREVIEW = 'snapshot_preview.png'
 DEFAULT_HEADER = ['host', 'username', 'password', 'projects']
 
-# Cmd:
-GS_CMD = """gs -q -o {original} -sDEVICE=pngalpha -dLastPage=1 {assessor_path}\
-/PDF/*.pdf"""
-CONVERT_CMD = """convert {original} -resize x200 {preview}"""
+# Number of processes generating the snapshots before the upload
+SNAPSHOT_WORKERS = 4
+SNAPSHOT_RESOLUTION = 72  # dpi
+
+# Cmd (only the first page of the PDF is rendered):
+GS_CMD = ['gs', '-q', '-o', '{original}', '-sDEVICE=pngalpha',
+          '-r{resolution}', '-dFirstPage=1', '-dLastPage=1', '{pdf}']
+CONVERT_CMD = ['convert', '{original}', '-resize', 'x200', '{preview}']
 
 # WARNING content for emails
 WARNING_START_CONTENT = """
@@ -480,7 +505,8 @@ DEL_UP = "=================================================================\
 
 def upload_tasks(logfile, debug, upload_settings=None,
                  host=None, username=None, password=None,
-                 projects=None, suffix=None, emailaddress=None):
+                 projects=None, suffix=None, emailaddress=None, workers=1,
+                 sync=False):
     """
     Upload tasks from the queue folder.
 
@@ -494,27 +520,29 @@ def upload_tasks(logfile, debug, upload_settings=None,
     :param suffix: suffix for flagfile
     :param emailaddress: email address for warnings
     :param projects: Project(s) to upload
+    :param workers: number of assessors to upload at the same time
+    :param sync: only upload the new/modified files of the assessors
 
     """
     bin.set_logger(logfile, debug)
 
     # Check if folders exist
     check_folders()
-    ##flagfile = "%s%s.txt" % (FLAGFILE_TEMPLATE, suffix)
+    flagfile = "%s%s.txt" % (FLAGFILE_TEMPLATE, suffix or '')
 
     # Load the settings for upload
-    #upload_settings = load_upload_settings(upload_settings, host, username,
-    #                                       password, projects)
-    #print_upload_settings(upload_settings)
+    upload_settings = load_upload_settings(upload_settings, host, username,
+                                           password, projects)
+    print_upload_settings(upload_settings)
     # create the flag file showing that the spider is running
-    ##if is_dax_upload_running(flagfile):
-    ##    pass
-    ##else:
-    ##    try:
-    #upload_results(upload_settings, emailaddress)
-    ##    finally:
+    if is_dax_upload_running(flagfile):
+        pass
+    else:
+        try:
+            upload_results(upload_settings, emailaddress, workers, sync)
+        finally:
             # remove flagfile
-    ##        os.remove(flagfile)
+            os.remove(flagfile)
 
 
 def testing(test_file, project, sessions, host=None, username=None, hide=False,
@@ -601,6 +629,83 @@ for your dax installation.\n')
     print('########## END ##########')
 
 
+def usage_report(settings_path=None, factor=None, min_jobs=None):
+    """
+    Report the resources used by the jobs from the usage history.
+
+    For each proctype/version: percentiles of the memory and walltime used
+    and the values requested with the right_size option. With a settings
+    file, the static values of its processors are compared to those and
+    the core-hours that right-sizing would have saved are estimated.
+
+    :param settings_path: settings file (.py/.yaml) describing the launcher
+    :param factor: safety factor (default: right_size_factor)
+    :param min_jobs: minimum number of jobs (default: right_size_min_jobs)
+    :return: core-hours saved (0 without settings file)
+    """
+    processors_dict = dict()
+    if settings_path:
+        logger = bin.set_logger(None, False)
+        _launcher = bin.read_settings(settings_path, logger, exe='usage')
+        for procs in list(_launcher.project_process_dict.values()):
+            for proc in procs:
+                processors_dict[proc.name] = proc
+
+    header = '%-35s %-8s %5s %9s %9s %10s %10s %9s %10s'
+    line = '%-35s %-8s %5d %9s %9s %10s %10s %9s %10s'
+    print(header % ('proctype', 'version', 'jobs', 'mem_p50', 'mem_p95',
+                    'wall_p50', 'wall_p95', 'mem_req', 'wall_req'))
+    saved_hours = 0.0
+    with usage_history.get_usage_history() as history:
+        for proctype, version in history.get_proctypes():
+            stats = history.get_stats(proctype, version)
+            sizes = history.get_right_size(proctype, version, factor,
+                                           min_jobs)
+            mem_req = wall_req = '-'
+            if sizes:
+                mem_req = '%dMB' % sizes[0]
+                wall_req = usage_history.format_walltime(sizes[1])
+            print(line % (
+                proctype, version, stats['count'],
+                _format_memory(stats['memory_mb'][50]),
+                _format_memory(stats['memory_mb'][95]),
+                _format_walltime(stats['walltime'][50]),
+                _format_walltime(stats['walltime'][95]),
+                mem_req, wall_req))
+
+            proc = processors_dict.get(proctype)
+            if not proc or not sizes:
+                continue
+            static = usage_history.parse_walltime(proc.walltime_str)
+            if static is None or sizes[1] >= static:
+                continue
+            # walltime reserved and not used by the jobs of the history
+            nb_jobs = len(history.get_usage(proctype, version)[1])
+            saved = nb_jobs * (static - sizes[1]) / 3600.0 * \
+                int(getattr(proc, 'ppn', 1) or 1)
+            saved_hours += saved
+            print('    static request %sMB %s, %.1f core-hours saved' %
+                  (proc.memreq_mb, proc.walltime_str, saved))
+
+    if settings_path:
+        print('Total: %.1f core-hours saved by right-sizing.' % saved_hours)
+    return saved_hours
+
+
+def _format_memory(memory_mb):
+    """Format a memory in MB for the usage report."""
+    if memory_mb is None:
+        return '-'
+    return '%dMB' % memory_mb
+
+
+def _format_walltime(walltime):
+    """Format a walltime in seconds for the usage report."""
+    if walltime is None:
+        return '-'
+    return usage_history.format_walltime(walltime)
+
+
 # Functions for Uploading
 def send_email(from_add, password, dests, subject, content, server):
     """
@@ -747,22 +852,33 @@ def get_assessor_list(projects):
         if projects and assessor_label.split('-x-')[0] not in projects:
             continue
 
-        assessor_path = os.path.join(RESULTS_DIR, assessor_label)
-        if not os.path.isdir(assessor_path):
-            continue
-        if os.path.exists(os.path.join(assessor_path, _EMAILED_FLAG_FILE)):
-            continue
-        rflag = os.path.join(assessor_path, _READY_FLAG_FILE)
-        fflag = os.path.join(assessor_path, _FAILED_FLAG_FILE)
-        cflag = os.path.join(assessor_path, _COMPLETE_FLAG_FILE)
-        if (os.path.exists(rflag) or os.path.exists(fflag)) and \
-           (not is_diskq_assessor(assessor_label) or os.path.exists(cflag)):
+        if is_ready_to_upload(assessor_label):
             # Passed all checks, so add it to upload list
             assessor_label_list.append(assessor_label)
 
     return assessor_label_list
 
 
+def is_ready_to_upload(assessor_label):
+    """
+    Check the flag files of an assessor folder in the upload folder.
+
+    :param assessor_label: assessor label
+    :return: True if the spider finished (READY_TO_UPLOAD/JOB_FAILED and
+     READY_TO_COMPLETE for diskq) and no email was sent about it
+    """
+    assessor_path = os.path.join(RESULTS_DIR, assessor_label)
+    if not os.path.isdir(assessor_path):
+        return False
+    if os.path.exists(os.path.join(assessor_path, _EMAILED_FLAG_FILE)):
+        return False
+    rflag = os.path.join(assessor_path, _READY_FLAG_FILE)
+    fflag = os.path.join(assessor_path, _FAILED_FLAG_FILE)
+    cflag = os.path.join(assessor_path, _COMPLETE_FLAG_FILE)
+    return (os.path.exists(rflag) or os.path.exists(fflag)) and \
+        (not is_diskq_assessor(assessor_label) or os.path.exists(cflag))
+
+
 def get_pbs_list(projects):
     """
     Get the list of PBS file to upload to XNAT.
@@ -802,32 +918,163 @@ def get_version_assessor(assessor_path):
     return version
 
 
+def is_newer(fpath, other_path):
+    """
+    Check if a file exists and is newer than another file.
+
+    :param fpath: path to the file
+    :param other_path: path to the file to compare to
+    :return: True if fpath exists and is newer than other_path
+    """
+    return os.path.exists(fpath) and \
+        os.path.getmtime(fpath) >= os.path.getmtime(other_path)
+
+
+def run_snapshot_cmd(cmd_template, **kwargs):
+    """
+    Run a snapshot command (list of args formatted with kwargs).
+
+    :param cmd_template: command template (GS_CMD or CONVERT_CMD)
+    :return: True if the command succeeded, False otherwise
+    """
+    cmd = [arg.format(**kwargs) for arg in cmd_template]
+    try:
+        return sb.call(cmd, stdout=sb.PIPE, stderr=sb.PIPE) == 0
+    except OSError as err:
+        LOGGER.error('%s failed: %s' % (cmd[0], err))
+        return False
+
+
 def generate_snapshots(assessor_path):
     """
     Generate Snapshots from the PDF if it exists.
 
+    Nothing is done if the snapshots are newer than the PDF.
+
     :param assessor_path: path for the assessor
     :return: None
     """
     snapshot_dir = os.path.join(assessor_path, 'SNAPSHOTS')
     snapshot_original = os.path.join(snapshot_dir, SNAPSHOTS_ORIGINAL)
     snapshot_preview = os.path.join(snapshot_dir, SNAPSHOTS_PREVIEW)
-    if not os.path.exists(snapshot_original) and\
-       os.path.exists(os.path.join(assessor_path, 'PDF')):
-        LOGGER.debug('    +creating original of SNAPSHOTS')
-        if not os.path.exists(snapshot_dir):
-            os.mkdir(snapshot_dir)
-        # Make the snapshots for the assessors with ghostscript
-        cmd = GS_CMD.format(original=snapshot_original,
-                            assessor_path=assessor_path)
-        os.system(cmd)
+    pdfs = glob.glob(os.path.join(assessor_path, 'PDF', '*.pdf'))
+    if pdfs:
+        pdf_path = max(pdfs, key=os.path.getmtime)
+        if not is_newer(snapshot_original, pdf_path):
+            LOGGER.debug('    +creating original of SNAPSHOTS')
+            if not os.path.exists(snapshot_dir):
+                os.mkdir(snapshot_dir)
+            # Make the snapshots for the assessors with ghostscript
+            run_snapshot_cmd(GS_CMD, original=snapshot_original,
+                             resolution=SNAPSHOT_RESOLUTION, pdf=pdf_path)
     # Create the preview snapshot from the original if Snapshots exist :
-    if os.path.exists(snapshot_original):
+    if os.path.exists(snapshot_original) and \
+       not is_newer(snapshot_preview, snapshot_original):
         LOGGER.debug('    +creating preview of SNAPSHOTS')
         # Make the snapshot_thumbnail
-        cmd = CONVERT_CMD.format(original=snapshot_original,
-                                 preview=snapshot_preview)
-        os.system(cmd)
+        run_snapshot_cmd(CONVERT_CMD, original=snapshot_original,
+                         preview=snapshot_preview)
+
+
+def time_snapshots(assessor_path):
+    """
+    Lock an assessor, generate its snapshots and time it (process pool).
+
+    :param assessor_path: path for the assessor
+    :return: tuple (assessor_path, seconds or None if locked by another
+     upload, error message or None)
+    """
+    if not lock_assessor(assessor_path):
+        return assessor_path, None, None
+    start = time.time()
+    try:
+        generate_snapshots(assessor_path)
+        error = None
+    except Exception as err:
+        error = str(err)
+    finally:
+        unlock_assessor(assessor_path)
+    return assessor_path, time.time() - start, error
+
+
+def log_snapshots(assessor_path, duration, error):
+    """
+    Log the time taken by the snapshots of an assessor (see time_snapshots).
+
+    :param assessor_path: path for the assessor
+    :param duration: seconds taken
+    :param error: error message or None
+    :return: None
+    """
+    if error:
+        LOGGER.warn('    snapshots failed for %s: %s'
+                    % (os.path.basename(assessor_path), error))
+    elif duration is None:
+        LOGGER.debug('    snapshots of %s skipped: locked by another upload'
+                     % os.path.basename(assessor_path))
+    else:
+        LOGGER.debug('    +snapshots for %s: %.1fs'
+                     % (os.path.basename(assessor_path), duration))
+
+
+def needs_upload(xnat, assessor_dict):
+    """
+    Check if an assessor of the queue is not already complete on XNAT
+     (read-only, see should_upload_assessor).
+
+    :param xnat: pyxnat.Interface object
+    :param assessor_dict: assessor dictionary
+    :return: True if the assessor will be uploaded, False otherwise
+    """
+    assessor_obj = XnatUtils.select_obj(
+        xnat, assessor_dict['project_id'], assessor_dict['subject_label'],
+        assessor_dict['session_label'], assessor_id=assessor_dict['label'])
+    if not assessor_obj.exists():
+        return True
+    procstatus = assessor_obj.attrs.get(
+        get_xsitype(assessor_dict) + '/procstatus')
+    return procstatus not in [READY_TO_COMPLETE, COMPLETE]
+
+
+def generate_all_snapshots(xnat, assessors_list, workers=SNAPSHOT_WORKERS):
+    """
+    Generate the snapshots of the assessors to upload in a process pool.
+
+    Run before the upload of the assessors so the uploads do not wait for
+    ghostscript/convert. Only the assessors with a PDF that are not already
+    complete on XNAT are processed, each under its upload lock.
+
+    :param xnat: pyxnat.Interface object
+    :param assessors_list: list of assessor labels from the queue folder
+    :param workers: number of processes
+    :return: None
+    """
+    paths = list()
+    for label in assessors_list:
+        assessor_path = os.path.join(RESULTS_DIR, label)
+        if not os.path.isdir(os.path.join(assessor_path, 'PDF')):
+            continue
+        assessor_dict = get_assessor_dict(label, assessor_path)
+        if not assessor_dict:
+            continue
+        try:
+            if not needs_upload(xnat, assessor_dict):
+                continue
+        except Exception as err:
+            LOGGER.warn('    cannot check %s on XNAT: %s' % (label, err))
+            continue
+        paths.append(assessor_path)
+    if not paths:
+        return
+    LOGGER.info(' - Generating snapshots for %s assessors' % len(paths))
+    pool = Pool(min(workers, len(paths)))
+    try:
+        results = pool.map(time_snapshots, paths)
+    finally:
+        pool.close()
+        pool.join()
+    for result in results:
+        log_snapshots(*result)
 
 
 def copy_outlog(assessor_dict):
@@ -941,12 +1188,13 @@ def should_upload_assessor(assessor_obj, assessor_dict, xsitype, version):
     return True
 
 
-def upload_assessor(xnat, assessor_dict):
+def upload_assessor(xnat, assessor_dict, sync=False):
     """
     Upload results to an assessor
 
     :param xnat: pyxnat.Interface object
     :param assessor_dict: assessor dictionary
+    :param sync: only upload the new/modified files of the resources
     :return: None
     """
     # get spiderpath from version.txt file:
@@ -991,7 +1239,8 @@ unable to find XML file: %s'
             # Need to be in a folder to create the resource :
             if os.path.isdir(resource_path):
                 LOGGER.debug('    +uploading %s' % (resource))
-                upload_resource(assessor_obj, resource, resource_path)
+                upload_resource(assessor_obj, resource, resource_path,
+                                sync)
 
         # after Upload
         if is_diskq_assessor(assessor_dict['label']):
@@ -1009,14 +1258,34 @@ unable to find XML file: %s'
                 xsitype + '/walltimeused': ctask.get_walltime(),
                 xsitype + '/jobstartdate': ctask.get_jobstartdate()
             })
+            usage_history.record_usage(
+                assessor_dict['label'], version, ctask.get_status(),
+                ctask.get_memused(), ctask.get_walltime(),
+                ctask.get_jobnode())
 
             # Delete the task from diskq
             ctask.delete()
-        elif os.path.exists(os.path.join(assessor_dict['path'],
-                                         _READY_FLAG_FILE)):
-            assessor_obj.attrs.set(xsitype + '/procstatus', READY_TO_COMPLETE)
         else:
-            assessor_obj.attrs.set(xsitype + '/procstatus', JOB_FAILED)
+            if os.path.exists(os.path.join(assessor_dict['path'],
+                                           _READY_FLAG_FILE)):
+                status = READY_TO_COMPLETE
+            else:
+                status = JOB_FAILED
+            attrs = {xsitype + '/procstatus': status}
+            # Usage recorded by the spider: no need to query the scheduler
+            usage = resource_usage.get_xnat_usage(assessor_dict['path'])
+            if usage:
+                for key, value in list(usage.items()):
+                    attrs['%s/%s' % (xsitype, key)] = value
+                usage_history.record_usage(
+                    assessor_dict['label'], version, status,
+                    usage['memused'], usage['walltimeused'], usage['jobnode'])
+            elif status == JOB_FAILED:
+                # Killed before writing its usage: keep the failure so the
+                # next job of the assessor is not right sized
+                usage_history.record_usage(
+                    assessor_dict['label'], version, status, None, None)
+            assessor_obj.attrs.mset(attrs)
 
         # Remove the folder
         shutil.rmtree(assessor_dict['path'])
@@ -1032,13 +1301,15 @@ def is_diskq_assessor(assr_label):
     return os.path.exists(afile)
 
 
-def upload_resource(assessor_obj, resource, resource_path):
+def upload_resource(assessor_obj, resource, resource_path, sync=False):
     """
     Upload a resource folder to an assessor
 
     :param assessor_obj: pyxnat assessor Eobject
     :param resource: resource to upload
     :param resource_path: resource path on the station
+    :param sync: only upload the new/modified files and delete the files
+                 removed from the folder instead of replacing the resource
     :return: None
     """
     if resource == 'SNAPSHOTS':
@@ -1047,11 +1318,32 @@ def upload_resource(assessor_obj, resource, resource_path):
         rfiles_list = os.listdir(resource_path)
         if not rfiles_list:
             LOGGER.warn('No files in {}'.format(resource_path))
-        elif len(rfiles_list) > 1 or os.path.isdir(rfiles_list[0]):
+        elif sync:
             try:
-                XnatUtils.upload_folder_to_obj(
+                if len(rfiles_list) == 1:
+                    XnatUtils.check_image_format(
+                        os.path.join(resource_path, rfiles_list[0]))
+                nb_up, nb_del = XnatUtils.sync_folder_to_obj(
                     resource_path, assessor_obj.out_resource(resource),
-                    resource, removeall=True)
+                    resource)
+                LOGGER.debug('    +%s: %s file(s) uploaded, %s deleted'
+                             % (resource, nb_up, nb_del))
+            except XnatUtilsError as err:
+                print(ERR_MSG % err)
+        elif len(rfiles_list) > 1 or os.path.isdir(rfiles_list[0]):
+            journal_path = os.path.join(
+                os.path.dirname(resource_path),
+                _UPLOAD_JOURNAL_TEMPLATE.format(resource=resource))
+            try:
+                if os.path.exists(journal_path) or \
+                   get_folder_size(resource_path) > RESUMABLE_UPLOAD_SIZE:
+                    XnatUtils.upload_folder_resumable(
+                        resource_path, assessor_obj.out_resource(resource),
+                        journal_path, removeall=True)
+                else:
+                    XnatUtils.upload_folder_to_obj(
+                        resource_path, assessor_obj.out_resource(resource),
+                        resource, removeall=True)
             except XnatUtilsError as err:
                 print(ERR_MSG % err)
         # One or two file, let just upload them:
@@ -1099,34 +1391,244 @@ def upload_snapshots(assessor_obj, resource_path):
             print(ERR_MSG % err)
 
 
-def upload_assessors(xnat, projects):
+def get_folder_size(folder):
+    """
+    Get the size of all the files in a folder
+
+    :param folder: path to the folder
+    :return: size in bytes
+    """
+    size = 0
+    for root, _, files in os.walk(folder):
+        for fname in files:
+            fpath = os.path.join(root, fname)
+            if not os.path.islink(fpath):
+                size += os.path.getsize(fpath)
+    return size
+
+
+def lock_assessor(assessor_path):
+    """
+    Lock the assessor folder so only one dax upload handles it.
+
+    A lock left by a dead process on this host or older than
+    UPLOAD_LOCK_EXPIRY hours is removed.
+
+    :param assessor_path: path for the assessor
+    :return: True if the lock was acquired, False otherwise
+    """
+    lock_file = os.path.join(assessor_path, _UPLOAD_LOCK_FILE)
+    owner = '%s %s' % (socket.gethostname(), os.getpid())
+    for _ in range(2):
+        try:
+            fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            if not is_stale_lock(lock_file):
+                return False
+            try:
+                os.remove(lock_file)
+            except OSError:
+                return False
+            continue
+        os.write(fd, owner.encode())
+        os.close(fd)
+        return True
+    return False
+
+
+def is_stale_lock(lock_file):
+    """
+    Check if the lock file was left by a process that is not running.
+
+    A lock older than UPLOAD_LOCK_EXPIRY hours is stale whatever the host
+    that wrote it (the process of another host cannot be checked).
+
+    :param lock_file: path to the assessor lock file
+    :return: True if the lock is stale, False otherwise
+    """
+    try:
+        age = time.time() - os.path.getmtime(lock_file)
+    except OSError:
+        return False
+    if age > UPLOAD_LOCK_EXPIRY * 3600:
+        return True
+    try:
+        with open(lock_file, 'r') as f_obj:
+            host, pid = f_obj.read().split()
+        pid = int(pid)
+    except (IOError, OSError, ValueError):
+        return False
+    if host != socket.gethostname():
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return True
+    return False
+
+
+def unlock_assessor(assessor_path):
+    """
+    Remove the upload lock of the assessor folder if it still exists.
+
+    :param assessor_path: path for the assessor
+    :return: None
+    """
+    lock_file = os.path.join(assessor_path, _UPLOAD_LOCK_FILE)
+    if os.path.exists(lock_file):
+        os.remove(lock_file)
+
+
+class UploadBudget(object):
+    """
+    Limit the number of bytes uploaded at the same time by the workers.
+
+    An assessor bigger than the limit is uploaded alone.
+    """
+    def __init__(self, max_bytes=UPLOAD_BYTES_IN_FLIGHT):
+        """
+        Entry point for the UploadBudget class.
+
+        :param max_bytes: maximum number of bytes in flight
+        :return: None
+        """
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        """
+        Wait until the upload of size bytes fits in the budget.
+
+        :param size: size in bytes of the upload
+        :return: None
+        """
+        with self.condition:
+            while self.in_flight and self.in_flight + size > self.max_bytes:
+                self.condition.wait()
+            self.in_flight += size
+
+    def release(self, size):
+        """
+        Give back the bytes of a finished upload.
+
+        :param size: size in bytes of the upload
+        :return: None
+        """
+        with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
+
+
+def upload_assessor_from_queue(xnat, assessor_label, budget=None,
+                               sync=False):
+    """
+    Lock and upload one assessor from the queue folder
+
+    :param xnat: pyxnat.Interface object
+    :param assessor_label: assessor label
+    :param budget: UploadBudget object shared by the workers
+    :param sync: only upload the new/modified files of the resources
+    :return: warning message for the assessor or None
+    """
+    assessor_path = os.path.join(RESULTS_DIR, assessor_label)
+    assessor_dict = get_assessor_dict(assessor_label, assessor_path)
+    if not assessor_dict:
+        LOGGER.warn('     --> wrong label')
+        return None
+    if not lock_assessor(assessor_path):
+        LOGGER.info('     --> %s locked by another upload' % assessor_label)
+        return None
+
+    size = 0
+    if budget:
+        size = get_folder_size(assessor_path)
+        budget.acquire(size)
+    try:
+        uploaded = upload_assessor(xnat, assessor_dict, sync)
+    finally:
+        if budget:
+            budget.release(size)
+        unlock_assessor(assessor_path)
+
+    if not uploaded:
+        mess = """    - Assessor label : {label}\n"""
+        return mess.format(label=assessor_dict['label'])
+    return None
+
+
+def upload_assessors(xnat, projects, workers=1, upload_dict=None,
+                     sync=False, assessors_list=None):
     """
     Upload all assessors to XNAT
 
+    With more than one worker, each worker opens its own connection to XNAT
+    using the host/username/password from upload_dict.
+
     :param xnat: pyxnat.Interface object
     :param projects: list of projects to upload to XNAT
-    :return: None
+    :param workers: number of assessors to upload at the same time
+    :param upload_dict: dictionary defining the upload information
+    :param sync: only upload the new/modified files of the resources
+    :param assessors_list: labels of the assessors to upload (default: all
+     the assessors ready in the upload folder)
+    :return: list of warnings
     """
     # Get the assessor label from the directory :
-    assessors_list = get_assessor_list(projects)
+    if assessors_list is None:
+        assessors_list = get_assessor_list(projects)
+    elif projects:
+        assessors_list = [label for label in assessors_list
+                          if label.split('-x-')[0] in projects]
     number_of_processes = len(assessors_list)
-    warnings = list()
+    generate_all_snapshots(xnat, assessors_list)
 
-    for index, assessor_label in enumerate(assessors_list):
-        assessor_path = os.path.join(RESULTS_DIR, assessor_label)
+    def upload_one(intf, index, assessor_label, budget=None):
         msg = "    *Process: %s/%s -- label: %s / time: %s"
         LOGGER.info(msg % (str(index + 1), str(number_of_processes),
                            assessor_label, str(datetime.now())))
-
-        assessor_dict = get_assessor_dict(assessor_label, assessor_path)
-        if assessor_dict:
-            uploaded = upload_assessor(xnat, assessor_dict)
-            if not uploaded:
-                mess = """    - Assessor label : {label}\n"""
-                warnings.append(mess.format(label=assessor_dict['label']))
-        else:
-            LOGGER.warn('     --> wrong label')
-    return warnings
+        try:
+            return upload_assessor_from_queue(intf, assessor_label, budget,
+                                              sync)
+        except Exception:
+            LOGGER.error('Upload of %s failed:\n%s'
+                         % (assessor_label, traceback.format_exc()))
+            mess = """    - Assessor label : {label}\n"""
+            return mess.format(label=assessor_label)
+
+    if workers <= 1 or number_of_processes <= 1 or not upload_dict:
+        results = [upload_one(xnat, index, assessor_label)
+                   for index, assessor_label in enumerate(assessors_list)]
+        return [warning for warning in results if warning]
+
+    budget = UploadBudget()
+    local = threading.local()
+    interfaces = list()
+    interfaces_lock = threading.Lock()
+
+    def worker_interface():
+        if not hasattr(local, 'xnat'):
+            local.xnat = XnatUtils.get_interface(
+                host=upload_dict['host'], user=upload_dict['username'],
+                pwd=upload_dict['password'])
+            with interfaces_lock:
+                interfaces.append(local.xnat)
+        return local.xnat
+
+    def upload_worker(args):
+        index, assessor_label = args
+        return upload_one(worker_interface(), index, assessor_label, budget)
+
+    pool = ThreadPool(min(workers, number_of_processes))
+    try:
+        results = pool.map(profiling.inherit_rest_counters(upload_worker),
+                           list(enumerate(assessors_list)))
+    finally:
+        pool.close()
+        pool.join()
+        for intf in interfaces:
+            intf.disconnect()
+    return [warning for warning in results if warning]
 
 
 def upload_pbs(xnat, projects):
@@ -1232,12 +1734,15 @@ def upload_outlog(xnat, projects):
                             os.remove(outlog_fpath)
 
 
-def upload_results(upload_settings, emailaddress):
+def upload_results(upload_settings, emailaddress, workers=1, sync=False):
     """
     Main function to upload the results / PBS / OUTLOG of assessors
      from the queue folder
 
     :param upload_settings: dictionary defining the upload information
+    :param emailaddress: email address for warnings
+    :param workers: number of assessors to upload at the same time
+    :param sync: only upload the new/modified files of the resources
     :return: None
     """
     if len(os.listdir(RESULTS_DIR)) == 0:
@@ -1246,36 +1751,121 @@ def upload_results(upload_settings, emailaddress):
 
     warnings = list()
 
+    metrics.start_pass('upload')
     for upload_dict in upload_settings:
         with XnatUtils.get_interface(host=upload_dict['host'],
                                      user=upload_dict['username'],
                                      pwd=upload_dict['password']) as xnat:
-            LOGGER.info('===================================================\
+            warnings.extend(upload_host(xnat, upload_dict, workers, sync))
+    metrics.end_pass()
+
+    send_warning_emails(warnings, emailaddress)
+
+
+def upload_host(xnat, upload_dict, workers=1, sync=False,
+                assessors_list=None):
+    """
+    Upload the results / PBS / OUTLOG of the assessors for one XNAT host
+
+    :param xnat: pyxnat.Interface object connected to the host
+    :param upload_dict: dictionary defining the upload information
+    :param workers: number of assessors to upload at the same time
+    :param sync: only upload the new/modified files of the resources
+    :param assessors_list: labels of the assessors to upload (default: all
+     the assessors ready in the upload folder)
+    :return: list of warnings
+    """
+    LOGGER.info('===================================================\
 ================')
-            proj_str = (upload_dict['projects'] if upload_dict['projects']
-                        else 'all')
-            LOGGER.info('Connecting to XNAT <%s> to start uploading processes \
+    proj_str = (upload_dict['projects'] if upload_dict['projects']
+                else 'all')
+    LOGGER.info('Connecting to XNAT <%s> to start uploading processes \
 for projects: %s' % (upload_dict['host'], proj_str))
-            if not XnatUtils.has_dax_datatypes(xnat):
-                msg = 'Error: dax datatypes are not installed on xnat <%s>.'
-                raise DaxUploadError(msg % (upload_dict['host']))
-
-            # 1) Upload the assessor data
-            # For each assessor label that need to be upload :
-            LOGGER.info(' - Uploading results for assessors')
-            warnings.extend(upload_assessors(xnat, upload_dict['projects']))
-
-            # 2) Upload the PBS files
-            # For each file, upload it to the PBS resource
-            LOGGER.info(' - Uploading PBS files ...')
-            upload_pbs(xnat, upload_dict['projects'])
-
-            # 3) Upload the OUTLOG files not uploaded with processes
-            LOGGER.info(' - Checking OUTLOG files to upload them for JOB_FAILED \
+    if not XnatUtils.has_dax_datatypes(xnat):
+        msg = 'Error: dax datatypes are not installed on xnat <%s>.'
+        raise DaxUploadError(msg % (upload_dict['host']))
+
+    # 1) Upload the assessor data
+    # For each assessor label that need to be upload :
+    LOGGER.info(' - Uploading results for assessors')
+    ready_info = None
+    if metrics.get_pass() is not None:
+        if assessors_list is None:
+            assessors_list = get_assessor_list(upload_dict['projects'])
+        ready_info = get_ready_info(assessors_list)
+    with profiling.phase('assessors'):
+        warnings = upload_assessors(xnat, upload_dict['projects'], workers,
+                                    upload_dict, sync, assessors_list)
+    if ready_info is not None:
+        add_upload_metrics(upload_dict['host'], ready_info)
+
+    # 2) Upload the PBS files
+    # For each file, upload it to the PBS resource
+    LOGGER.info(' - Uploading PBS files ...')
+    with profiling.phase('pbs'):
+        upload_pbs(xnat, upload_dict['projects'])
+
+    # 3) Upload the OUTLOG files not uploaded with processes
+    LOGGER.info(' - Checking OUTLOG files to upload them for JOB_FAILED \
 jobs ...')
-            upload_outlog(xnat, upload_dict['projects'])
+    with profiling.phase('outlog'):
+        upload_outlog(xnat, upload_dict['projects'])
+    return warnings
 
-    send_warning_emails(warnings, emailaddress)
+
+def get_ready_info(assessors_list):
+    """
+    Get the size of the assessors to upload and the time since their spider
+     wrote the flag file.
+
+    :param assessors_list: labels of the assessors to upload
+    :return: dictionary {label: (size in bytes, seconds waiting)}
+    """
+    now = time.time()
+    ready_info = dict()
+    for assessor_label in assessors_list:
+        assessor_path = os.path.join(RESULTS_DIR, assessor_label)
+        waiting = 0
+        for flag_file in [_READY_FLAG_FILE, _FAILED_FLAG_FILE]:
+            try:
+                waiting = now - os.path.getmtime(os.path.join(assessor_path,
+                                                              flag_file))
+                break
+            except OSError:
+                continue
+        try:
+            size = get_folder_size(assessor_path)
+        except OSError:
+            size = 0
+        ready_info[assessor_label] = (size, max(0, waiting))
+    return ready_info
+
+
+def add_upload_metrics(host, ready_info):
+    """
+    Add the metrics of the upload of the assessors to the metrics pass: the
+     folders of the assessors uploaded are removed from the upload folder.
+
+    :param host: XNAT host
+    :param ready_info: dictionary {label: (size, seconds waiting)} before
+     the upload (get_ready_info)
+    :return: None
+    """
+    uploaded = [label for label in ready_info
+                if not os.path.isdir(os.path.join(RESULTS_DIR, label))]
+    failed = [label for label in ready_info if label not in uploaded]
+    metrics.add_counter('dax_uploaded_assessors_total', len(uploaded),
+                        'Assessors uploaded to XNAT.', host=host)
+    metrics.add_counter('dax_uploaded_bytes_total',
+                        sum(ready_info[label][0] for label in uploaded),
+                        'Bytes of the assessors uploaded to XNAT.', host=host)
+    metrics.add('dax_upload_failed_assessors', len(failed),
+                'Assessors of the last upload still in the upload folder.',
+                host=host)
+    metrics.add('dax_oldest_task_age_seconds',
+                max([ready_info[label][1] for label in ready_info] or [0]),
+                'Age of the oldest task in a status (day resolution for \
+NEED_TO_RUN).', procstatus=READY_TO_UPLOAD, host=host)
 
 
 def load_upload_settings(f_settings, host, username, password, projects):
@@ -1326,14 +1916,11 @@ Missing args. 4 needed, %s found at line %s." % (str(len(row)), str(index)))
             raise DaxError("error: doesn't recognize the file format for the \
 settings file. Please use either JSON/PYTHON/CSV format.")
     else:  # if not file, use the environment variables and options
-        _host = os.environ['XNAT_HOST']
-        username = None
-        password = None
-        projects = []
-        if host:
-            _host = host
+        _host = host or os.environ['XNAT_HOST']
         if projects:
             projects = projects.split(',')
+        else:
+            projects = []
         if username:
             username = username
             if not password:
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" dependencies.py
+
+Dependency graph between the processors of a project.
+
+A processor depends on the processors producing the assessors listed in its
+YAML inputs (inputs: xnat: assessors: proctypes). The graph is used by the
+launcher to re-evaluate the downstream tasks of a session as soon as an
+upstream assessor is COMPLETE (or passes QC) instead of waiting for the next
+dax build.
+"""
+
+from builtins import object
+
+from collections import defaultdict
+import logging
+
+from . import XnatUtils
+from .errors import DaxLauncherError
+
+
+__copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
+# Logger to print logs
+LOGGER = logging.getLogger('dax')
+
+
+def get_assessor_inputs(proc):
+    """
+    Get the assessor inputs of a processor from its YAML inputs.
+
+    :param proc: processor object (only AutoProcessor have YAML inputs)
+    :return: list of dictionaries (proctypes list, needs_qc)
+    """
+    xnat_inputs = getattr(proc, 'xnat_inputs', None) or dict()
+    assr_inputs = list()
+    for assr_in in xnat_inputs.get('assessors', list()):
+        proctypes = assr_in.get('proctypes')
+        if not proctypes:
+            continue
+        assr_inputs.append({
+            'proctypes': [ptype.strip() for ptype in proctypes.split(',')],
+            'needs_qc': assr_in.get('needs_qc', True)})
+    return assr_inputs
+
+
+class ProcessorGraph(object):
+    """ Class for the dependencies between the processors of a project """
+    def __init__(self, processors):
+        """
+        Entry point for the ProcessorGraph class.
+
+        :param processors: list of processors of the project
+        :raises: DaxLauncherError if the dependencies have a cycle
+        :return: None
+        """
+        self.processors = dict((proc.name, proc) for proc in processors)
+        self.upstream = defaultdict(set)
+        self.downstream = defaultdict(set)
+        # (downstream, upstream) -> the upstream assessor must pass QC
+        self.edges_qc = dict()
+        for proc in processors:
+            for assr_in in get_assessor_inputs(proc):
+                matcher = XnatUtils.get_types_matcher(assr_in['proctypes'])
+                for name in self.processors:
+                    if name != proc.name and matcher.match(name):
+                        self.upstream[proc.name].add(name)
+                        self.downstream[name].add(proc.name)
+                        self.edges_qc[(proc.name, name)] = \
+                            self.edges_qc.get((proc.name, name), False) or \
+                            bool(assr_in['needs_qc'])
+        self.order = self.sort()
+
+    def sort(self):
+        """
+        Sort the proctypes with the upstream processors first.
+
+        :raises: DaxLauncherError if the dependencies have a cycle
+        :return: list of proctypes
+        """
+        remaining = dict((name, set(self.upstream[name]))
+                         for name in self.processors)
+        order = list()
+        while remaining:
+            ready = sorted(name for name, ups in list(remaining.items())
+                           if not ups)
+            if not ready:
+                err = 'cycle in the processor dependencies: %s'
+                raise DaxLauncherError(err % ', '.join(sorted(remaining)))
+            for name in ready:
+                del remaining[name]
+                for ups in list(remaining.values()):
+                    ups.discard(name)
+            order.extend(ready)
+        return order
+
+    def get_upstream(self, proctype):
+        """Proctypes of the processors a proctype depends on."""
+        return sorted(self.upstream.get(proctype, set()))
+
+    def get_downstream(self, proctype):
+        """Proctypes of the processors depending directly on a proctype."""
+        return sorted(self.downstream.get(proctype, set()),
+                      key=self.order.index)
+
+    def has_upstream(self, proctype):
+        """True if the processor of the proctype uses other assessors."""
+        return bool(self.upstream.get(proctype))
+
+    def needs_qc(self, proctype, upstream):
+        """True if the upstream assessors must pass QC for the proctype."""
+        return self.edges_qc.get((proctype, upstream), True)
+
+    def get_sessions_ready(self, assr_list):
+        """
+        Get the sessions with tasks waiting for inputs (NEED_INPUTS) and an
+         upstream assessor now usable: COMPLETE with its QC passed or not
+         needed.
+
+        :param assr_list: list of assessors info (XnatUtils.list_assessors)
+        :return: dictionary {(subject, session): proctypes to re-evaluate}
+        """
+        waiting = defaultdict(set)
+        complete = defaultdict(list)
+        for assr_info in assr_list:
+            key = (assr_info['subject_label'], assr_info['session_label'])
+            proctype = assr_info['proctype']
+            if assr_info['procstatus'] == 'NEED_INPUTS' and \
+               self.has_upstream(proctype):
+                waiting[key].add(proctype)
+            elif assr_info['procstatus'] == 'COMPLETE':
+                qc_passed = XnatUtils.is_bad_qa(assr_info['qcstatus']) == 1
+                complete[key].append((proctype, qc_passed))
+
+        sessions = dict()
+        for key, proctypes in list(waiting.items()):
+            ready = set()
+            for proctype in proctypes:
+                for upstream, qc_passed in complete[key]:
+                    if upstream in self.upstream[proctype] and \
+                       (qc_passed or not self.needs_qc(proctype, upstream)):
+                        ready.add(proctype)
+            if ready:
+                sessions[key] = ready
+        return sessions
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" input_cache.py
+
+Node-local cache of the XNAT resources downloaded by the spiders.
+
+The cache is enabled by setting the environment variable DAX_INPUT_CACHE to a
+directory on the compute node (e.g: /scratch/dax_cache). Each resource is
+stored once, keyed by its URI and the digest of its catalog (files, sizes and
+MD5), and linked into the INPUTS folder of every job using it. The least
+recently used resources are removed when the cache is bigger than
+DAX_INPUT_CACHE_SIZE (GB, default 50).
+"""
+
+from builtins import object
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from .staging import stage_file
+
+
+__copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
+INPUT_CACHE_ENV = 'DAX_INPUT_CACHE'
+INPUT_CACHE_SIZE_ENV = 'DAX_INPUT_CACHE_SIZE'
+DEFAULT_INPUT_CACHE_SIZE = 50  # GB
+INPUT_CACHE = None
+# Logger to print logs
+LOGGER = logging.getLogger('dax')
+
+
+def get_input_cache():
+    """
+    Get the input cache of the node if enabled (DAX_INPUT_CACHE).
+
+    :return: InputCache object or None
+    """
+    global INPUT_CACHE
+    cache_dir = os.environ.get(INPUT_CACHE_ENV)
+    if not cache_dir:
+        return None
+    if INPUT_CACHE is None or INPUT_CACHE.cache_dir != cache_dir:
+        size = float(os.environ.get(INPUT_CACHE_SIZE_ENV,
+                                    DEFAULT_INPUT_CACHE_SIZE))
+        INPUT_CACHE = InputCache(cache_dir, int(size * 1024 ** 3))
+    return INPUT_CACHE
+
+
+class InputCache(object):
+    """ Class for the node-local cache of XNAT resources """
+    def __init__(self, cache_dir, max_size):
+        """
+        Entry point for the InputCache class.
+
+        :param cache_dir: directory of the cache on the node
+        :param max_size: maximum size of the cache in bytes
+        :return: None
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                if not os.path.isdir(cache_dir):
+                    raise
+
+    @staticmethod
+    def get_key(resource_uri, catalog):
+        """
+        Get the key of a resource: digest of its URI and catalog.
+
+        :param resource_uri: URI of the resource on XNAT
+        :param catalog: resource catalog {path: (size, digest)}
+        :return: key string
+        """
+        content = json.dumps([resource_uri, sorted(catalog.items())])
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def _path(self, key, ext=''):
+        return os.path.join(self.cache_dir, key + ext)
+
+    def _lock(self, key, blocking=True):
+        """
+        Lock a key of the cache for this process (None if busy).
+
+        The lock file is removed with the entry (see _unlock): the lock is
+        taken again if the file was removed while waiting for it.
+        """
+        lock_path = self._path(key, '.lock')
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        while True:
+            lock_obj = open(lock_path, 'a')
+            try:
+                fcntl.flock(lock_obj, flags)
+            except IOError:
+                lock_obj.close()
+                return None
+            try:
+                if os.stat(lock_path).st_ino == \
+                   os.fstat(lock_obj.fileno()).st_ino:
+                    return lock_obj
+            except OSError:
+                pass
+            lock_obj.close()
+
+    def _unlock(self, key, lock_obj, remove=False):
+        """Release the lock of a key, removing the lock file if asked."""
+        try:
+            if remove:
+                os.remove(self._path(key, '.lock'))
+        except OSError:
+            pass
+        finally:
+            lock_obj.close()
+
+    def get_files(self, resource_uri, catalog, resource_dir, download):
+        """
+        Materialize a resource in resource_dir from the cache.
+
+        On a miss, download(directory) is called to download the resource
+        files into directory before adding them to the cache.
+
+        :param resource_uri: URI of the resource on XNAT
+        :param catalog: resource catalog {path: (size, digest)}
+        :param resource_dir: local directory of the resource for the job
+        :param download: function downloading the resource in a directory
+        :return: list of the files in resource_dir
+        """
+        key = self.get_key(resource_uri, catalog)
+        entry_dir = self._path(key)
+        lock_obj = self._lock(key)
+        try:
+            if os.path.isdir(entry_dir):
+                self.hits += 1
+                LOGGER.info('input cache hit: %s' % resource_uri)
+            else:
+                self.misses += 1
+                LOGGER.info('input cache miss: %s' % resource_uri)
+                self._add(key, catalog, download)
+            fpaths = self._materialize(entry_dir, resource_dir, catalog)
+            # last use of the entry for the LRU eviction
+            os.utime(self._path(key, '.json'), None)
+        finally:
+            # no lock file left behind by a failed download
+            self._unlock(key, lock_obj, not os.path.isdir(entry_dir))
+        self.evict(keep=key)
+        return fpaths
+
+    def _add(self, key, catalog, download):
+        """Download the resource in a temporary folder and add it."""
+        tmp_dir = tempfile.mkdtemp(prefix='.%s.' % key, dir=self.cache_dir)
+        try:
+            download(tmp_dir)
+            for root, _, filenames in os.walk(tmp_dir):
+                for filename in filenames:
+                    # Shared between jobs: read-only
+                    os.chmod(os.path.join(root, filename), 0o444)
+            size = sum(fsize or 0 for fsize, _ in catalog.values())
+            with open(self._path(key, '.json'), 'w') as f_obj:
+                json.dump({'size': size, 'time': time.time()}, f_obj)
+            os.rename(tmp_dir, self._path(key))
+        finally:
+            if os.path.isdir(tmp_dir):
+                shutil.rmtree(tmp_dir)
+
+    @staticmethod
+    def _materialize(entry_dir, resource_dir, catalog):
+        """Link the files of the entry in the job resource folder."""
+        fpaths = list()
+        for filename in sorted(catalog):
+            src = os.path.join(entry_dir, filename)
+            dst = os.path.join(resource_dir, filename)
+            if not os.path.isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            if os.path.exists(dst):
+                os.remove(dst)
+            stage_file(src, dst, 'link')
+            fpaths.append(dst)
+        return fpaths
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used resources above the size limit.
+
+        Resources in use by another process are skipped.
+
+        :param keep: key of the resource not to remove
+        :return: None
+        """
+        entries = list()
+        for fname in os.listdir(self.cache_dir):
+            if not fname.endswith('.json'):
+                continue
+            key = fname[:-len('.json')]
+            meta_path = self._path(key, '.json')
+            try:
+                with open(meta_path, 'r') as f_obj:
+                    size = json.load(f_obj)['size']
+                entries.append((os.path.getmtime(meta_path), size, key))
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            lock_obj = self._lock(key, blocking=False)
+            if not lock_obj:
+                continue
+            try:
+                shutil.rmtree(self._path(key), ignore_errors=True)
+                os.remove(self._path(key, '.json'))
+                total -= size
+                LOGGER.info('input cache: removed %s' % key)
+            finally:
+                self._unlock(key, lock_obj, remove=True)
+
+    def stats(self):
+        """
+        Get the statistics of the cache for this process.
+
+        :return: string with the number of hits and misses
+        """
+        return 'Input cache %s: %s hit(s), %s miss(es)' % (
+            self.cache_dir, self.hits, self.misses)
@@ -8,14 +8,20 @@ from builtins import str
 from builtins import object
 from past.builtins import basestring
 
+from collections import defaultdict
 from datetime import datetime, timedelta
+import json
 import logging
-import redcap
+from multiprocessing.pool import ThreadPool
 import sys
 import os
+import threading
 import traceback
 
-from . import processors, modules, XnatUtils, task, cluster
+from . import (processors, modules, XnatUtils, task, cluster, metrics,
+               profiling)
+from .dependencies import ProcessorGraph
+from .scheduler import LaunchScheduler, get_age_days
 from .task import Task, ClusterTask, XnatTask
 from .dax_settings import DAX_Settings, DAX_Netrc
 from .errors import (ClusterCountJobsException, ClusterLaunchException,
@@ -35,6 +41,15 @@ UPDATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 BUILD_SUFFIX = 'BUILD_RUNNING.txt'
 UPDATE_SUFFIX = 'UPDATE_RUNNING.txt'
 LAUNCH_SUFFIX = 'LAUNCHER_RUNNING.txt'
+# High-water marks of the incremental builds (FlagFiles/<prefix>_<suffix>)
+BUILD_STATE_SUFFIX = 'BUILD_STATE.json'
+# Hours between two full builds of a project in incremental mode
+FULL_BUILD_HOURS = 24
+# Sessions modified shortly before the high-water mark are listed again
+# (clock difference with XNAT, sessions modified during the listing)
+CHANGE_FEED_MARGIN = timedelta(minutes=10)
+# Number of assessors created at the same time for new processors
+BULK_CREATE_THREADS = 8
 # Logger to print logs
 LOGGER = logging.getLogger('dax')
 
@@ -76,7 +91,11 @@ class Launcher(object):
                  xnat_user=None, xnat_pass=None, xnat_host=None,
                  job_email=None, job_email_options='bae', max_age=7,
                  launcher_type=DAX_SETTINGS.get_launcher_type(),
-                 skip_lastupdate=None):
+                 skip_lastupdate=None,
+                 project_weights=None, project_limits=None,
+                 proctype_limits=None, priorities=None,
+                 incremental_build=None,
+                 full_build_hours=FULL_BUILD_HOURS):
 
         """
         Entry point for the Launcher class
@@ -92,6 +111,16 @@ class Launcher(object):
         :param job_email: job email address for report
         :param job_email_options: email options for the jobs
         :param max_age: maximum time before updating again a session
+        :param project_weights: dictionary {project: weight} for the fair
+                                share of the queue between projects
+        :param project_limits: dictionary {project: maximum running jobs}
+        :param proctype_limits: dictionary {proctype: maximum running jobs}
+        :param priorities: dictionary {project or proctype: priority} to
+                           launch first (higher first)
+        :param incremental_build: dax build only lists the sessions modified
+                                  since the previous build of the project
+        :param full_build_hours: hours between two full builds of a project
+                                 in incremental mode
         :return: None
         """
         self.queue_limit = queue_limit
@@ -128,20 +157,33 @@ name as a key and list of yaml filepaths as values.'
                 if isinstance(yaml_obj, processors.AutoProcessor):
                     proc = yaml_obj
                 else:
-                    proc = processors.AutoProcessor(yaml_obj)
+                    proc = processors.get_auto_processor(yaml_obj)
                 if project not in self.project_process_dict:
                     self.project_process_dict[project] = [proc]
                 else:
                     self.project_process_dict[project].append(proc)
 
+        # Dependencies between the processors of each project:
+        self.processor_graphs = dict()
+        for project, proc_list in list(self.project_process_dict.items()):
+            self.processor_graphs[project] = ProcessorGraph(proc_list)
+        self.incremental_build = str(incremental_build).lower() in \
+            ['true', 'yes', 'y', '1']
+        self.full_build_hours = float(full_build_hours)
+
         if isinstance(priority_project, list):
             self.priority_project = priority_project
         elif isinstance(priority_project, basestring):
             self.priority_project = priority_project.split(',')
         else:
             self.priority_project = None
+        self.scheduler = LaunchScheduler(project_weights, project_limits,
+                                         proctype_limits, priorities,
+                                         self.priority_project)
         self.job_email = job_email
         self.job_email_options = job_email_options
+        # Connection to XNAT kept between the runs (dax daemon)
+        self.interface = None
         self.max_age = DAX_SETTINGS.get_max_age()
         self.launcher_type = launcher_type
         if not skip_lastupdate or not skip_lastupdate.lower().startswith('y'):
@@ -181,6 +223,18 @@ name as a key and list of yaml filepaths as values.'
             else:
                 self.xnat_pass = xnat_pass
 
+    def get_interface(self):
+        """
+        Get the connection to XNAT for build/update/launch
+
+        :return: the connection kept by dax daemon if set, a new
+         XnatUtils.InterfaceTemp otherwise (use with the with statement)
+        """
+        if self.interface is not None:
+            return self.interface
+        return XnatUtils.get_interface(self.xnat_host, self.xnat_user,
+                                       self.xnat_pass)
+
     # LAUNCH Main Method
     def launch_jobs(self, lockfile_prefix, project_local, sessions_local,
                     writeonly=False, pbsdir=None, force_no_qsub=False):
@@ -211,39 +265,50 @@ name as a key and list of yaml filepaths as values.'
 
         project_list = self.init_script(flagfile, project_local,
                                         type_update=3, start_end=1)
+        metrics.start_pass('launch', lockfile_prefix)
 
         if self.launcher_type in ['diskq-cluster', 'diskq-combined']:
             msg = 'Loading task queue from: %s'
             LOGGER.info(msg % os.path.join(res_dir, 'DISKQ'))
-            task_list = load_task_queue(
-                status=task.NEED_TO_RUN,
-                proj_filter=list(set(self.project_process_dict.keys()+self.project_modules_dict.keys())))
+            proj_filter = list(set(list(self.project_process_dict.keys()) +
+                                   list(self.project_modules_dict.keys())))
+            task_list = load_task_queue(status=task.NEED_TO_RUN,
+                                        proj_filter=proj_filter)
+            running = defaultdict(int)
+            for cur_task in load_task_queue(status=task.JOB_RUNNING,
+                                            proj_filter=proj_filter):
+                running[get_task_keys(cur_task)] += 1
 
             msg = '%s tasks that need to be launched found'
             LOGGER.info(msg % str(len(task_list)))
-            self.launch_tasks(task_list, force_no_qsub=force_no_qsub)
+            self.launch_tasks(task_list, force_no_qsub=force_no_qsub,
+                              running=running)
         else:
             LOGGER.info('Connecting to XNAT at %s' % self.xnat_host)
-            with XnatUtils.get_interface(self.xnat_host, self.xnat_user,
-                                         self.xnat_pass) as xnat:
+            with self.get_interface() as xnat:
 
                 if not XnatUtils.has_dax_datatypes(xnat):
                     err = 'dax datatypes are not installed on xnat <%s>'
                     raise DaxXnatError(err % (self.xnat_host))
 
                 LOGGER.info('Getting launchable tasks list...')
+                running = defaultdict(int)
                 task_list = self.get_tasks(xnat,
                                            self.is_launchable_tasks,
                                            project_list,
-                                           sessions_local)
+                                           sessions_local,
+                                           running)
 
                 msg = '%s tasks that need to be launched found'
                 LOGGER.info(msg % str(len(task_list)))
 
                 # Launch the task that need to be launch
-                self.launch_tasks(task_list, writeonly, pbsdir,
-                                  force_no_qsub=force_no_qsub)
+                with profiling.phase('launch_tasks'):
+                    self.launch_tasks(task_list, writeonly, pbsdir,
+                                      force_no_qsub=force_no_qsub,
+                                      running=running)
 
+        metrics.end_pass()
         self.finish_script(flagfile, project_list, 3, 2, project_local)
 
     @staticmethod
@@ -257,17 +322,22 @@ name as a key and list of yaml filepaths as values.'
         return assr_info['procstatus'] == task.NEED_TO_RUN
 
     def launch_tasks(self, task_list, writeonly=False, pbsdir=None,
-                     force_no_qsub=False):
+                     force_no_qsub=False, running=None):
         """
         Launch tasks from the passed list until the queue is full or
          the list is empty
 
+        The tasks are launched in the order given by the scheduler
+         (fair share between projects, caps, age and priorities).
+
         :param task_list: list of task to launch
         :param writeonly: write the job files without submitting them
         :param pbsdir: folder to store the pbs file
         :param force_no_qsub: run the job locally on the computer (serial mode)
+        :param running: dictionary {(project, proctype): running jobs}
         :return: None
         """
+        cjobs = 0
         if force_no_qsub:
             LOGGER.info('No qsub - Running job locally on your computer.')
         else:
@@ -281,14 +351,18 @@ name as a key and list of yaml filepaths as values.'
                 LOGGER.info('%s jobs currently in queue' % str(cjobs))
 
         # Launch until we reach cluster limit or no jobs left to launch
-        while (cjobs < self.queue_limit or writeonly) and len(task_list) > 0:
-            cur_task = task_list.pop()
-
-            # Confirm task is still ready to run
-            # I don't think that we need to make this get here.
-            # We've already filtered the assessors as need to run.
-            # if cur_task.get_status() != task.NEED_TO_RUN:
-            #     continue
+        task_infos = [(cur_task,) + get_task_keys(cur_task) +
+                      (get_task_age(cur_task),) for cur_task in task_list]
+        ages = [task_info[3] for task_info in task_infos]
+        metrics.add('dax_oldest_task_age_seconds',
+                    max(ages) * 86400 if ages else 0,
+                    'Age of the oldest task in a status (day resolution for \
+NEED_TO_RUN).', procstatus=task.NEED_TO_RUN)
+        launched = 0
+        ordered_tasks = self.scheduler.order(task_infos, running)
+        for cur_task, reason in ordered_tasks:
+            if not writeonly and cjobs >= self.queue_limit:
+                break
 
             if writeonly:
                 msg = "  +Writing PBS file for job:%s, currently %s jobs in \
@@ -298,6 +372,7 @@ cluster queue"
             else:
                 msg = '  +Launching job:%s, currently %s jobs in cluster queue'
                 LOGGER.info(msg % (cur_task.assessor_label, str(cjobs)))
+            LOGGER.info('   picked: %s' % reason)
 
             try:
                 if self.launcher_type in ['diskq-cluster',
@@ -323,12 +398,20 @@ cluster queue"
                 LOGGER.error('ERROR: failed to launch job')
                 raise ClusterLaunchException
 
+            launched += 1
             cjobs = cluster.count_jobs()
 
             if cjobs == -1:
                 LOGGER.error('ERROR: cannot get count of jobs from cluster')
                 raise ClusterCountJobsException
 
+        metrics.add_counter('dax_launched_tasks_total', launched,
+                            'Tasks launched (or written with writeonly).')
+        metrics.add('dax_queue_jobs', cjobs,
+                    'Jobs in the cluster queue at the end of the launch.')
+        metrics.add('dax_queue_limit', self.queue_limit,
+                    'Maximum number of jobs in the cluster queue.')
+
     # UPDATE Main Method
     def update_tasks(self, lockfile_prefix, project_local, sessions_local):
         """
@@ -354,6 +437,8 @@ cluster queue"
                                 '%s_%s' % (lockfile_prefix, UPDATE_SUFFIX))
         project_list = self.init_script(flagfile, project_local,
                                         type_update=2, start_end=1)
+        metrics.start_pass('update', lockfile_prefix)
+        statuses = defaultdict(int)
 
         if self.launcher_type in ['diskq-cluster', 'diskq-combined']:
             msg = 'Loading task queue from: %s'
@@ -367,10 +452,11 @@ cluster queue"
             for cur_task in task_list:
                 LOGGER.info('Updating task: %s' % cur_task.assessor_label)
                 cur_task.update_status()
+                statuses[(get_task_keys(cur_task)[0],
+                          cur_task.get_status())] += 1
         else:
             LOGGER.info('Connecting to XNAT at %s' % self.xnat_host)
-            with XnatUtils.get_interface(self.xnat_host, self.xnat_user,
-                                         self.xnat_pass) as xnat:
+            with self.get_interface() as xnat:
 
                 if not XnatUtils.has_dax_datatypes(xnat):
                     err = 'error: dax datatypes are not installed on xnat <%s>'
@@ -380,17 +466,71 @@ cluster queue"
                 task_list = self.get_tasks(xnat,
                                            self.is_updatable_tasks,
                                            project_list,
-                                           sessions_local)
+                                           sessions_local,
+                                           statuses=statuses)
 
                 LOGGER.info('%s open tasks found' % str(len(task_list)))
                 LOGGER.info('Updating tasks...')
-                for cur_task in task_list:
-                    msg = '     Updating task: %s'
-                    LOGGER.info(msg % cur_task.assessor_label)
-                    cur_task.update_status()
-
+                with profiling.phase('update_status'):
+                    for cur_task in task_list:
+                        msg = '     Updating task: %s'
+                        LOGGER.info(msg % cur_task.assessor_label)
+                        cur_task.update_status()
+
+                with profiling.phase('queue_downstream'):
+                    self.queue_downstream_tasks(xnat, project_list,
+                                                sessions_local)
+
+        for (project_id, procstatus), count in sorted(statuses.items()):
+            metrics.add('dax_tasks', count,
+                        'Assessors by project and procstatus (before the \
+update for XNAT).', project=project_id, procstatus=procstatus)
+        metrics.end_pass()
         self.finish_script(flagfile, project_list, 2, 2, project_local)
 
+    def queue_downstream_tasks(self, xnat, project_list=None,
+                               sessions_local=None):
+        """
+        Re-evaluate the tasks waiting for inputs in the sessions where an
+         upstream assessor is now COMPLETE (and passed QC if needed) so they
+         can be launched without waiting for the next build
+
+        :param xnat: pyxnat.Interface object
+        :param project_list: List of projects to search tasks from
+        :param sessions_local: list of sessions to update tasks associated
+         to the project locally
+        :return: None
+        """
+        if not project_list:
+            project_list = list(self.project_process_dict.keys())
+
+        for project_id in project_list:
+            graph = self.processor_graphs.get(project_id)
+            if not graph or not graph.downstream:
+                continue
+
+            assr_list = self.get_assessors_list(xnat, project_id,
+                                                sessions_local)
+            sessions = graph.get_sessions_ready(assr_list)
+            if not sessions:
+                continue
+
+            msg = 'Queueing downstream tasks for %s: %s session(s)'
+            LOGGER.info(msg % (project_id, len(sessions)))
+            proc_list = self.project_process_dict[project_id]
+            for (subj_label, sess_label), proctypes in \
+                    sorted(sessions.items()):
+                LOGGER.debug('  %s: %s' % (sess_label, ', '.join(proctypes)))
+                sess_procs, scan_procs = processors.processors_by_type(
+                    [proc for proc in proc_list if proc.name in proctypes])
+                csess = XnatUtils.CachedImageSession(xnat, project_id,
+                                                     subj_label, sess_label)
+                if scan_procs:
+                    for cscan in csess.scans():
+                        self.build_scan_processors(xnat, cscan, scan_procs)
+                if sess_procs:
+                    self.build_session_processors(xnat, csess, sess_procs)
+
     @staticmethod
     def is_updatable_tasks(assr_info):
         """
@@ -406,7 +546,7 @@ cluster queue"
 
     # BUILD Main Method
     def build(self, lockfile_prefix, project_local, sessions_local,
-              mod_delta=None, proj_lastrun=None):
+              mod_delta=None, proj_lastrun=None, incremental=None):
         """
         Main method to build the tasks and the sessions
 
@@ -414,6 +554,8 @@ cluster queue"
         :param project_local: project to run locally
         :param sessions_local: list of sessions to launch tasks
          associated to the project locally
+        :param incremental: only build the sessions modified since the last
+         build (default: incremental_build setting)
         :return: None
 
         """
@@ -430,10 +572,20 @@ cluster queue"
                                 '%s_%s' % (lockfile_prefix, BUILD_SUFFIX))
         project_list = self.init_script(flagfile, project_local,
                                         type_update=1, start_end=1)
+        metrics.start_pass('build', lockfile_prefix)
+        project_errors = 0
+
+        if incremental is None:
+            incremental = self.incremental_build
+        incremental = incremental and not sessions_local and not mod_delta \
+            and not proj_lastrun
+        state_file = os.path.join(os.path.join(res_dir, 'FlagFiles'),
+                                  '%s_%s' % (lockfile_prefix,
+                                             BUILD_STATE_SUFFIX))
+        build_state = load_build_state(state_file) if incremental else dict()
 
         LOGGER.info('Connecting to XNAT at %s' % self.xnat_host)
-        with XnatUtils.get_interface(self.xnat_host, self.xnat_user,
-                                     self.xnat_pass) as xnat:
+        with self.get_interface() as xnat:
 
             if not XnatUtils.has_dax_datatypes(xnat):
                 err = 'error: dax datatypes are not installed on xnat <%s>'
@@ -453,23 +605,48 @@ cluster queue"
                        (project_id in proj_lastrun) and
                        (proj_lastrun[project_id] is not None)):
                         lastrun = proj_lastrun[project_id]
+                        since = lastrun - CHANGE_FEED_MARGIN
                     else:
                         lastrun = None
-
-                    self.build_project(xnat, project_id, lockfile_prefix,
-                                       sessions_local,
-                                       mod_delta=mod_delta, lastrun=lastrun)
+                        since = None
+
+                    project_start = datetime.now()
+                    proj_state = build_state.get(project_id, dict())
+                    if incremental:
+                        since = self.get_build_since(proj_state,
+                                                     project_start)
+
+                    with profiling.phase('project:%s' % project_id):
+                        self.build_project(xnat, project_id, lockfile_prefix,
+                                           sessions_local,
+                                           mod_delta=mod_delta,
+                                           lastrun=lastrun, since=since)
+
+                    if incremental:
+                        proj_state['last_build'] = \
+                            project_start.strftime(UPDATE_FORMAT)
+                        if since is None:
+                            proj_state['last_full'] = \
+                                proj_state['last_build']
+                        build_state[project_id] = proj_state
+                        save_build_state(state_file, build_state)
                 except Exception as E:
+                    project_errors += 1
                     err1 = 'Caught exception building project %s'
                     err2 = 'Exception class %s caught with message %s'
                     LOGGER.critical(err1 % project_id)
                     LOGGER.critical(err2 % (E.__class__, E.message))
                     LOGGER.critical(traceback.format_exc())
 
+        metrics.add('dax_build_projects', len(project_list),
+                    'Projects in the last build.')
+        metrics.add('dax_build_project_errors', project_errors,
+                    'Projects of the last build that failed.')
+        metrics.end_pass()
         self.finish_script(flagfile, project_list, 1, 2, project_local)
 
     def build_project(self, xnat, project_id, lockfile_prefix, sessions_local,
-                      mod_delta=None, lastrun=None):
+                      mod_delta=None, lastrun=None, since=None):
         """
         Build the project
 
@@ -477,6 +654,7 @@ cluster queue"
         :param project_id: project ID on XNAT
         :param lockfile_prefix: prefix for flag file to lock the launcher
         :param sessions_local: list of sessions to launch tasks
+        :param since: only list the sessions modified since this datetime
         :return: None
         """
         # Modules prerun
@@ -504,8 +682,26 @@ cluster queue"
         has_new = self.has_new_processors(xnat, project_id, exp_procs,
                                           scan_procs)
 
-        # Get the list of sessions:
-        sessions = self.get_sessions_list(xnat, project_id, sessions_local)
+        # Get the list of sessions (all of them for the new processors):
+        if has_new and since:
+            LOGGER.info('  * New processors, listing all the sessions')
+            since = None
+        with profiling.phase('list_sessions'):
+            sessions = self.get_sessions_list(xnat, project_id,
+                                              sessions_local, since)
+
+        # Create the assessors for the new processors in bulk:
+        if has_new:
+            LOGGER.info('  * Creating assessors for new processors')
+            try:
+                self.create_new_assessors(xnat, project_id, sessions,
+                                          exp_procs, scan_procs)
+            except Exception as E:
+                err1 = 'Caught exception creating assessors for project %s'
+                err2 = 'Exception class %s caught with message %s'
+                LOGGER.critical(err1 % project_id)
+                LOGGER.critical(err2 % (E.__class__, E))
+                LOGGER.critical(traceback.format_exc())
 
         # Update each session from the list:
         for sess_info in sessions:
@@ -552,8 +748,9 @@ cluster queue"
                 update_start_time = datetime.now()
 
             try:
-                self.build_session(xnat, sess_info, exp_procs, scan_procs,
-                                   exp_mods, scan_mods)
+                with profiling.phase('session:%s' % sess_info['label']):
+                    self.build_session(xnat, sess_info, exp_procs,
+                                       scan_procs, exp_mods, scan_mods)
             except Exception as E:
                 err1 = 'Caught exception building sessions %s'
                 err2 = 'Exception class %s caught with message %s'
@@ -583,6 +780,97 @@ cluster queue"
                 LOGGER.critical(err2 % (E.__class__, E.message))
                 LOGGER.critical(traceback.format_exc())
 
+    def create_new_assessors(self, xnat, project_id, sessions,
+                             sess_proc_list, scan_proc_list):
+        """
+        Create in bulk the missing assessors of the project.
+
+        Gather all the assessors that the processors would create on the
+        sessions of the project and create them concurrently, each with its
+        initial attributes in one request (see task.create_assessor).
+        Each thread creates its assessors with its own connection to XNAT.
+        Sessions shared from other projects are left to build_session.
+
+        :param xnat: pyxnat.Interface object
+        :param project_id: project ID on XNAT
+        :param sessions: list of sessions from get_sessions_list
+        :param sess_proc_list: list of processors running on a session
+        :param scan_proc_list: list of processors running on a scan
+        :return: number of assessors created
+        """
+        existing = set([assr['label'] for assr in
+                        XnatUtils.list_project_assessors(xnat, project_id)])
+        scans = XnatUtils.list_project_scans(xnat, project_id,
+                                             include_shared=False)
+        session_labels = set([sess['label'] for sess in sessions])
+        native_labels = set([scan['session_label'] for scan in scans])
+
+        new_assessors = list()
+        for sess_info in sessions:
+            if sess_info['label'] not in native_labels:
+                continue
+            for sess_proc in sess_proc_list:
+                if not sess_proc.should_run(sess_info):
+                    continue
+                labels = [project_id, sess_info['subject_label'],
+                          sess_info['label'], sess_proc.name]
+                new_assessors.append((sess_info, labels, sess_proc))
+
+        for scan_info in scans:
+            if scan_info['session_label'] not in session_labels:
+                continue
+            for scan_proc in scan_proc_list:
+                if not scan_proc.should_run(scan_info):
+                    continue
+                labels = [project_id, scan_info['subject_label'],
+                          scan_info['session_label'], scan_info['ID'],
+                          scan_proc.name]
+                new_assessors.append((scan_info, labels, scan_proc))
+
+        local = threading.local()
+        interfaces = list()
+        interfaces_lock = threading.Lock()
+
+        def worker_interface():
+            if not hasattr(local, 'xnat'):
+                local.xnat = XnatUtils.get_interface(
+                    self.xnat_host, self.xnat_user, self.xnat_pass)
+                with interfaces_lock:
+                    interfaces.append(local.xnat)
+            return local.xnat
+
+        def _create(args):
+            obj_info, labels, proc = args
+            assr_label = '-x-'.join(labels)
+            xpath = XnatUtils.A_XPATH.format(
+                project=project_id, subject=obj_info['subject_label'],
+                session=obj_info['session_label'], assessor=assr_label)
+            try:
+                task.create_assessor(worker_interface().select(xpath), proc)
+                return True
+            except Exception as E:
+                err = 'Caught exception creating assessor %s: %s'
+                LOGGER.error(err % (assr_label, E))
+                return False
+
+        to_create = [args for args in new_assessors
+                     if '-x-'.join(args[1]) not in existing]
+        if not to_create:
+            return 0
+
+        LOGGER.info('    creating %d assessors' % len(to_create))
+        pool = ThreadPool(BULK_CREATE_THREADS)
+        try:
+            results = pool.map(profiling.inherit_rest_counters(_create),
+                               to_create)
+        finally:
+            pool.close()
+            pool.join()
+            for intf in interfaces:
+                intf.disconnect()
+
+        return sum(results)
+
     def build_session(self, xnat, sess_info, sess_proc_list,
                       scan_proc_list, sess_mod_list, scan_mod_list):
         """
@@ -952,7 +1240,7 @@ The project is not part of the settings."""
             os.remove(lock_file)
 
     def get_tasks(self, xnat, is_valid_assessor, project_list=None,
-                  sessions_local=None):
+                  sessions_local=None, running=None, statuses=None):
         """
         Get list of tasks for a projects list
 
@@ -961,6 +1249,10 @@ The project is not part of the settings."""
         :param project_list: List of projects to search tasks from
         :param sessions_local: list of sessions to update tasks associated
          to the project locally
+        :param running: dictionary {(project, proctype): count} to count the
+         assessors with a job running
+        :param statuses: dictionary {(project, procstatus): count} to count
+         the assessors by procstatus
         :return: list of tasks
         """
         task_list = list()
@@ -976,15 +1268,17 @@ The project is not part of the settings."""
         # iterate projects
         for project_id in project_list:
             LOGGER.info('===== PROJECT:%s =====' % project_id)
-            task_list.extend(self.get_project_tasks(xnat,
-                                                    project_id,
-                                                    sessions_local,
-                                                    is_valid_assessor))
+            with profiling.phase('project:%s' % project_id):
+                task_list.extend(self.get_project_tasks(xnat,
+                                                        project_id,
+                                                        sessions_local,
+                                                        is_valid_assessor,
+                                                        running, statuses))
 
         return task_list
 
     def get_project_tasks(self, xnat, project_id, sessions_local,
-                          is_valid_assessor):
+                          is_valid_assessor, running=None, statuses=None):
         """
         Get list of tasks for a specific project where each task agrees
          the is_valid_assessor conditions
@@ -994,6 +1288,10 @@ The project is not part of the settings."""
         :param sessions_local: list of sessions to update tasks associated
          to the project locally
         :param is_valid_assessor: method to validate the assessor
+        :param running: dictionary {(project, proctype): count} to count the
+         assessors with a job running
+        :param statuses: dictionary {(project, procstatus): count} to count
+         the assessors by procstatus
         :return: list of tasks
         """
         task_list = list()
@@ -1007,6 +1305,11 @@ The project is not part of the settings."""
 
         # Match each assessor to a processor, get a task, and add to list
         for assr_info in assr_list:
+            if running is not None and \
+               assr_info['procstatus'] == task.JOB_RUNNING:
+                running[(project_id, assr_info['proctype'])] += 1
+            if statuses is not None:
+                statuses[(project_id, assr_info['procstatus'])] += 1
             if is_valid_assessor(assr_info):
                 cur_task = self.generate_task(xnat, assr_info, sess_procs,
                                               scan_procs)
@@ -1060,7 +1363,8 @@ The project is not part of the settings."""
         else:
             # Get a new task with the matched processor
             assr = XnatUtils.get_full_object(xnat, assr_info)
-            cur_task = Task(task_proc, assr, DAX_SETTINGS.get_results_dir())
+            cur_task = Task(task_proc, assr, DAX_SETTINGS.get_results_dir(),
+                            assr_info.get('createdate'))
             return cur_task
 
     @staticmethod
@@ -1089,7 +1393,7 @@ The project is not part of the settings."""
         return assr_list
 
     @staticmethod
-    def get_sessions_list(xnat, project_id, slocal):
+    def get_sessions_list(xnat, project_id, slocal, since=None):
         """
         Get the sessions list from XNAT and sort it.
          Move the new sessions to the front.
@@ -1097,9 +1401,21 @@ The project is not part of the settings."""
         :param xnat: pyxnat.Interface object
         :param project_id: project ID on XNAT
         :param slocal: session selected by user
+        :param since: only list the sessions modified since this datetime
         :return: list of sessions sorted for a project
         """
-        list_sessions = XnatUtils.list_sessions(xnat, project_id)
+        list_sessions = None
+        if since:
+            try:
+                list_sessions = XnatUtils.list_modified_sessions(
+                    xnat, project_id, since)
+                LOGGER.info('  * %d session(s) modified since %s'
+                            % (len(list_sessions), since))
+            except Exception as E:
+                LOGGER.warn('cannot search the sessions modified since %s, \
+listing all the sessions: %s' % (since, E))
+        if list_sessions is None:
+            list_sessions = XnatUtils.list_sessions(xnat, project_id)
         if slocal and slocal.lower() != 'all':
             # filter the list and keep the match between both list:
             val = slocal.split(',')
@@ -1117,6 +1433,29 @@ The project is not part of the settings."""
 
         return sorted_list
 
+    def get_build_since(self, proj_state, now):
+        """
+        Get the date since when the sessions of a project are built in
+         incremental mode.
+
+        :param proj_state: dictionary with the dates of the last build and of
+         the last full build of the project
+        :param now: datetime of the start of the build
+        :return: datetime, None for a full build
+        """
+        try:
+            last_build = datetime.strptime(proj_state['last_build'],
+                                           UPDATE_FORMAT)
+            last_full = datetime.strptime(proj_state['last_full'],
+                                          UPDATE_FORMAT)
+        except (KeyError, TypeError, ValueError):
+            LOGGER.info('  * No previous build, full build')
+            return None
+        if now - last_full >= timedelta(hours=self.full_build_hours):
+            LOGGER.info('  * Last full build on %s, full build' % last_full)
+            return None
+        return last_build - CHANGE_FEED_MARGIN
+
     def get_project_list(self, all_projects):
         """
         Get project list from the file priority + the other ones
@@ -1207,6 +1546,36 @@ The project is not part of the settings."""
         return len(diff_list) > 0
 
 
+def get_task_keys(cur_task):
+    """
+    Get the project and proctype of a task from its assessor label.
+
+    :param cur_task: Task or ClusterTask object
+    :return: (project, proctype)
+    """
+    labels = cur_task.assessor_label.split('-x-')
+    return labels[0], labels[-1]
+
+
+def get_task_age(cur_task):
+    """
+    Get the number of days a task has been waiting to run.
+
+    :param cur_task: Task or ClusterTask object
+    :return: age in days
+    """
+    if isinstance(cur_task, ClusterTask):
+        try:
+            date_str = datetime.fromtimestamp(
+                os.path.getmtime(cur_task.batch_path())).strftime('%Y-%m-%d')
+        except OSError:
+            date_str = None
+    else:
+        # Date from the listing of the assessors (no request to XNAT)
+        date_str = cur_task.createdate
+    return get_age_days(date_str)
+
+
 def load_task_queue(status=None, proj_filter=None):
     """ Load the task queue for DiskQ"""
     task_list = list()
@@ -1232,6 +1601,37 @@ def load_task_queue(status=None, proj_filter=None):
     return task_list
 
 
+def load_build_state(state_file):
+    """
+    Load the high-water marks of the incremental builds.
+
+    :param state_file: json file
+    :return: dictionary {project: {'last_build', 'last_full'}}
+    """
+    if not os.path.isfile(state_file):
+        return dict()
+    try:
+        with open(state_file, 'r') as f_obj:
+            return json.load(f_obj)
+    except (IOError, ValueError) as err:
+        LOGGER.warn('cannot read %s, full build: %s' % (state_file, err))
+        return dict()
+
+
+def save_build_state(state_file, build_state):
+    """
+    Save the high-water marks of the incremental builds.
+
+    :param state_file: json file
+    :param build_state: dictionary {project: {'last_build', 'last_full'}}
+    :return: None
+    """
+    tmp_file = '%s.tmp' % state_file
+    with open(tmp_file, 'w') as f_obj:
+        json.dump(build_state, f_obj, indent=2, sort_keys=True)
+    os.rename(tmp_file, state_file)
+
+
 def get_sess_lastmod(xnat, sess_info):
     """ Get the session last modified date."""
     xsi_type = sess_info['xsiType']
@@ -1282,6 +1682,8 @@ def upload_update_date_redcap(project_list, type_update, start_end):
     if DAX_SETTINGS.get_api_url() and \
        DAX_SETTINGS.get_api_key_dax() and \
        dax_config:
+        import redcap
+
         redcap_project = None
         try:
             redcap_project = redcap.Project(DAX_SETTINGS.get_api_url(),
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" metrics.py
+
+Metrics of the dax passes in the Prometheus textfile collector format.
+
+When metrics_dir is set in the cluster section of the settings, each build,
+update, launch and upload pass writes <metrics_dir>/dax_<name>_<phase>.prom
+when it ends (node_exporter --collector.textfile.directory=<metrics_dir>):
+    - duration and end time of the pass,
+    - REST calls, errors and bytes sent/received,
+    - tasks by project and procstatus (update),
+    - jobs in the queue vs queue_limit, tasks launched and the age of the
+      oldest NEED_TO_RUN task (launch),
+    - assessors uploaded, bytes uploaded and the age of the oldest
+      READY_TO_UPLOAD assessor (upload).
+The *_total counters carry on from the previous file of the phase so the
+throughputs and error rates can be computed with rate()/increase(). A pass
+that fails does not write its file: alert on the age of
+dax_pass_last_success_timestamp_seconds to catch the passes stuck or failing.
+"""
+
+from builtins import object
+from builtins import str
+
+from collections import OrderedDict
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from .dax_settings import DAX_Settings
+from .profiling import new_rest_counters, set_rest_counters
+
+
+__copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
+DAX_SETTINGS = DAX_Settings()
+METRICS_EXT = '.prom'
+# Pass running in each thread (daemon: upload runs next to the launcher)
+LOCAL = threading.local()
+INVALID_CHARS_RE = re.compile(r'[^a-zA-Z0-9_]')
+SAMPLE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*(?:\{.*\})?)\s+(\S+)$')
+# Logger to print logs
+LOGGER = logging.getLogger('dax')
+
+
+def escape_label(value):
+    """Escape a label value (backslash, double quote and new line)."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')\
+        .replace('\n', '\\n')
+
+
+def format_value(value):
+    """Format a sample value."""
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return '+Inf' if value > 0 else '-Inf'
+    if isinstance(value, float) and value != int(value):
+        return repr(value)
+    return str(int(value))
+
+
+def format_sample(metric, labels):
+    """
+    Format the name and labels of a sample.
+
+    :param metric: name of the metric
+    :param labels: OrderedDict of the labels
+    :return: string metric{label="value",...}
+    """
+    return '%s{%s}' % (metric, ','.join(
+        '%s="%s"' % (key, escape_label(value))
+        for key, value in list(labels.items())))
+
+
+class MetricsPass(object):
+    """ Class collecting the metrics of one pass of a dax phase """
+    def __init__(self, phase, name, metrics_dir):
+        """
+        Entry point for the MetricsPass class.
+
+        :param phase: build, update, launch or upload
+        :param name: name of the settings (prefix of the flag files)
+        :param metrics_dir: folder read by the textfile collector
+        :return: None
+        """
+        self.phase = phase
+        self.name = name
+        self.metrics_dir = metrics_dir
+        self.start_time = time.time()
+        # REST calls of the pass (threads of the pass, see profiling.py)
+        self.rest = new_rest_counters()
+        # metric -> (type, help, list of (labels, value))
+        self.metrics = OrderedDict()
+        self.previous = None
+
+    def add(self, metric, value, help_str, metric_type='gauge', **labels):
+        """
+        Add a sample to the pass.
+
+        :param metric: name of the metric (e.g: dax_tasks)
+        :param value: value of the sample
+        :param help_str: description of the metric
+        :param metric_type: gauge or counter
+        :param labels: labels of the sample (settings and phase are added)
+        :return: None
+        """
+        _labels = OrderedDict([('settings', self.name),
+                               ('phase', self.phase)])
+        _labels.update(sorted(labels.items()))
+        self.metrics.setdefault(metric, (metric_type, help_str, list()))[2]\
+            .append((_labels, value))
+
+    def add_counter(self, metric, increment, help_str, **labels):
+        """
+        Add a counter (*_total) increased by the pass: the value is added to
+         the value in the previous file of the phase.
+
+        :param metric: name of the metric (e.g: dax_launched_tasks_total)
+        :param increment: count of the pass
+        :param help_str: description of the metric
+        :param labels: labels of the sample (settings and phase are added)
+        :return: None
+        """
+        if self.previous is None:
+            self.previous = self.read_previous()
+        self.add(metric, increment, help_str, 'counter', **labels)
+        samples = self.metrics[metric][2]
+        _labels, _ = samples[-1]
+        samples[-1] = (_labels, self.previous.get(
+            format_sample(metric, _labels), 0) + increment)
+
+    def read_previous(self):
+        """
+        Read the samples of the previous file of the phase.
+
+        :return: dictionary {metric{labels}: value}
+        """
+        samples = dict()
+        try:
+            with open(self.get_path(), 'r') as f_obj:
+                for line in f_obj:
+                    match = SAMPLE_RE.match(line.strip())
+                    if match and not line.startswith('#'):
+                        try:
+                            samples[match.group(1)] = float(match.group(2))
+                        except ValueError:
+                            continue
+        except (IOError, OSError):
+            pass
+        return samples
+
+    def add_pass_metrics(self):
+        """Add the duration, end time and REST traffic of the pass."""
+        end_time = time.time()
+        self.add('dax_pass_duration_seconds', end_time - self.start_time,
+                 'Duration of the last pass.')
+        self.add('dax_pass_last_success_timestamp_seconds', end_time,
+                 'End time of the last pass that succeeded.')
+        rest = self.rest
+        ratio = float(rest['errors']) / rest['requests'] \
+            if rest['requests'] else 0.0
+        self.add('dax_pass_rest_error_ratio', ratio,
+                 'Share of the REST calls of the last pass that failed.')
+        self.add_counter('dax_rest_requests_total', rest['requests'],
+                         'REST calls to XNAT.')
+        self.add_counter('dax_rest_errors_total', rest['errors'],
+                         'REST calls to XNAT answered with an HTTP error.')
+        self.add_counter('dax_rest_sent_bytes_total', rest['bytes_sent'],
+                         'Bytes sent to XNAT in the REST requests (file \
+uploads streamed from disk are not counted).')
+        self.add_counter('dax_rest_received_bytes_total',
+                         rest['bytes_received'],
+                         'Bytes received from XNAT (Content-Length).')
+
+    def to_text(self):
+        """
+        Metrics of the pass in the Prometheus text format.
+
+        :return: string
+        """
+        lines = list()
+        for metric, (metric_type, help_str, samples) in \
+                list(self.metrics.items()):
+            lines.append('# HELP %s %s' % (metric, help_str))
+            lines.append('# TYPE %s %s' % (metric, metric_type))
+            for labels, value in samples:
+                lines.append('%s %s' % (format_sample(metric, labels),
+                                        format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def get_path(self):
+        """Path of the metrics file of the pass."""
+        name = INVALID_CHARS_RE.sub('_', '%s_%s' % (self.name, self.phase))
+        return os.path.join(self.metrics_dir,
+                            'dax_%s%s' % (name, METRICS_EXT))
+
+    def write(self):
+        """
+        Write the metrics file: the temporary file is renamed so the
+         collector never reads a partial file.
+
+        :return: None
+        """
+        self.add_pass_metrics()
+        if not os.path.isdir(self.metrics_dir):
+            os.makedirs(self.metrics_dir)
+        fdesc, tmp_path = tempfile.mkstemp(prefix='.dax_',
+                                           dir=self.metrics_dir)
+        try:
+            with os.fdopen(fdesc, 'w') as f_obj:
+                f_obj.write(self.to_text())
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, self.get_path())
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def start_pass(phase, name='dax'):
+    """
+    Start collecting the metrics of a pass in the current thread.
+
+    :param phase: build, update, launch or upload
+    :param name: name of the settings (prefix of the flag files)
+    :return: MetricsPass object, None if metrics_dir is not set
+    """
+    metrics_dir = DAX_SETTINGS.get_metrics_dir()
+    LOCAL.current = MetricsPass(phase, name, metrics_dir) \
+        if metrics_dir else None
+    set_rest_counters(LOCAL.current.rest if LOCAL.current else None)
+    return LOCAL.current
+
+
+def get_pass():
+    """Pass running in the current thread (None if no metrics)."""
+    return getattr(LOCAL, 'current', None)
+
+
+def add(metric, value, help_str, **labels):
+    """Add a sample to the pass running in the thread (no-op otherwise)."""
+    mpass = get_pass()
+    if mpass is not None:
+        mpass.add(metric, value, help_str, **labels)
+
+
+def add_counter(metric, increment, help_str, **labels):
+    """Add a counter to the pass running in the thread (no-op otherwise)."""
+    mpass = get_pass()
+    if mpass is not None:
+        mpass.add_counter(metric, increment, help_str, **labels)
+
+
+def end_pass():
+    """Write the metrics of the pass running in the thread."""
+    mpass = get_pass()
+    LOCAL.current = None
+    set_rest_counters(None)
+    if mpass is None:
+        return
+    try:
+        mpass.write()
+    except (IOError, OSError) as err:
+        LOGGER.warn('cannot write the metrics %s: %s'
+                    % (mpass.get_path(), err))
@@ -3,12 +3,16 @@
 from builtins import object
 from past.builtins import basestring
 
+import copy
+import json
 import logging
 import re
 import os
 
 from . import XnatUtils, task
-from .errors import AutoProcessorError
+from .dax_settings import DAX_Settings
+from .errors import (AutoProcessorError, NeedInputsException,
+                     NoDataException)
 
 
 try:
@@ -18,8 +22,12 @@ except NameError:
 
 __copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
 __all__ = ['Processor', 'ScanProcessor', 'SessionProcessor', 'AutoProcessor']
+DAX_SETTINGS = DAX_Settings()
 # Logger for logs
 LOGGER = logging.getLogger('dax')
+# File storing the YAML processor definitions between runs
+YAML_CACHE_FILE = os.path.join(DAX_SETTINGS.get_results_dir(), 'CACHE',
+                               'yaml_processors.json')
 
 
 class Processor(object):
@@ -189,6 +197,9 @@ class ScanProcessor(Processor):
                 self.scan_types = scan_types.split(',')
         else:
             self.scan_types = []
+        if self.scan_types != 'all':
+            self.types_matcher = XnatUtils.get_types_matcher(
+                self.scan_types, self.full_regex)
 
     def has_inputs(self):
         """
@@ -285,11 +296,7 @@ class ScanProcessor(Processor):
         if self.scan_types == 'all':
             return True
         else:
-            for expression in self.scan_types:
-                regex = XnatUtils.extract_exp(expression, self.full_regex)
-                if regex.match(scan_dict['scan_type']):
-                    return True
-            return False
+            return self.types_matcher.match(scan_dict['scan_type'])
 
 
 class SessionProcessor(Processor):
@@ -445,6 +452,9 @@ class AutoProcessor(Processor):
 No xnat.scans.{} in inputs found.'
                 raise AutoProcessorError(err.format(yaml_file,
                                                     self.scan_nb))
+            scantypes = self.scaninfo.get('types', '').split(',')
+            self.types_matcher = XnatUtils.get_types_matcher(
+                scantypes, self.full_regex)
 
     def edit_inputs(self, user_inputs, yaml_file):
         """
@@ -501,7 +511,7 @@ defined by yaml file {}'
             err = 'Path not found for {}'
             raise AutoProcessorError(err.format(yaml_file))
 
-        doc = XnatUtils.read_yaml(yaml_file)
+        doc = YAML_CACHE.get_doc(yaml_file)
 
         # Set Inputs from Yaml
         self._check_default_keys(yaml_file, doc)
@@ -659,15 +669,7 @@ defined by yaml file {}'
 
         """
         if 'scan_type' in obj_dict:
-            scantypes = self.scaninfo.get('types', '').split(',')
-            if scantypes == 'all':
-                return True
-            else:
-                for expression in scantypes:
-                    regex = XnatUtils.extract_exp(expression, self.full_regex)
-                    if regex.match(obj_dict['scan_type']):
-                        return True
-                return False
+            return self.types_matcher.match(obj_dict['scan_type'])
         else:
             # By definition, this should always run, so it just returns true
             # with no checks for session
@@ -816,6 +818,30 @@ resource/{4}'
                                         obj_info['session_label']))
         return filepaths
 
+    def build_cmds(self, cobj, jobdir):
+        """Method to generate the spider command from the cached objects.
+
+        Use the CachedImageSession/Scan already loaded by the build to avoid
+        requesting the session XML again.
+
+        :param cobj: CachedImageSession or CachedImageScan from XnatUtils
+        :param jobdir: jobdir where the job's output will be generated
+        :raises: NoDataException or NeedInputsException if inputs missing
+        :return: command to execute the spider in the job script
+        """
+        has_inputs, qcstatus = self.has_inputs(cobj)
+        if has_inputs == -1:
+            raise NoDataException(qcstatus)
+        elif has_inputs != 1:
+            raise NeedInputsException(qcstatus)
+
+        if isinstance(cobj, XnatUtils.CachedImageScan):
+            csess = cobj.parent()
+        else:
+            csess = cobj
+        assr_label = self.get_assessor_name(cobj)
+        return self._generate_cmds(csess, assr_label, jobdir)
+
     def get_cmds(self, assessor, jobdir):
         """Method to generate the spider command for cluster job.
 
@@ -828,11 +854,21 @@ resource/{4}'
         proj_label = assessor.parent().parent().parent().label()
         subj_label = assessor.parent().parent().label()
         sess_label = assessor.parent().label()
-        scan_label = assr_label.split('-x-')[3]
 
         # Get the csess:
         csess = XnatUtils.CachedImageSession(assessor._intf, proj_label,
                                              subj_label, sess_label)
+        return self._generate_cmds(csess, assr_label, jobdir)
+
+    def _generate_cmds(self, csess, assr_label, jobdir):
+        """Method to generate the spider command from a CachedImageSession.
+
+        :param csess: CachedImageSession of the assessor's session
+        :param assr_label: label of the assessor
+        :param jobdir: jobdir where the job's output will be generated
+        :return: command to execute the spider in the job script
+        """
+        scan_label = assr_label.split('-x-')[3]
 
         # Get the data from xnat for the xnat_inputs:
         # Scans:
@@ -908,6 +944,139 @@ resource/{4}'
                 self.inputs[res_info.get('varname')] = ','.join(_in)
 
 
+class YamlProcessorCache(object):
+    """ Cache of the YAML processor definitions.
+
+    The documents read from the YAML files are kept in memory and in a JSON
+    file between runs, keyed by file path, mtime and size. The AutoProcessor
+    objects are shared within a run for the same file and user inputs.
+    """
+    def __init__(self, cache_file=None):
+        """
+        Entry point of the YamlProcessorCache class.
+
+        :param cache_file: JSON file to persist the documents (optional)
+        :return: None
+
+        """
+        self.cache_file = cache_file
+        self.docs = None
+        self.processors = dict()
+        self.modified = False
+
+    def load(self):
+        """
+        Load the documents saved in the cache file.
+
+        :return: None
+
+        """
+        self.docs = dict()
+        if not self.cache_file or not os.path.isfile(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r') as f_cache:
+                self.docs = json.load(f_cache)
+        except (IOError, OSError, ValueError) as err:
+            msg = 'could not read the YAML processors cache %s: %s'
+            LOGGER.debug(msg % (self.cache_file, err))
+
+    def save(self):
+        """
+        Save the documents in the cache file if some were added.
+
+        :return: None
+
+        """
+        if not self.cache_file or not self.modified:
+            return
+        tmp_file = '%s.%d.tmp' % (self.cache_file, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(self.cache_file)):
+                os.makedirs(os.path.dirname(self.cache_file))
+            with open(tmp_file, 'w') as f_cache:
+                json.dump(self.docs, f_cache)
+            os.rename(tmp_file, self.cache_file)
+            self.modified = False
+        except (IOError, OSError, TypeError, ValueError) as err:
+            msg = 'could not write the YAML processors cache %s: %s'
+            LOGGER.debug(msg % (self.cache_file, err))
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+
+    @staticmethod
+    def get_key(yaml_file):
+        """
+        Get the path and the stamp (mtime, size) of the YAML file.
+
+        :param yaml_file: path to the YAML file
+        :return: absolute path, [mtime, size]
+
+        """
+        yaml_path = os.path.abspath(yaml_file)
+        stat = os.stat(yaml_path)
+        return yaml_path, [stat.st_mtime, stat.st_size]
+
+    def get_doc(self, yaml_file):
+        """
+        Get a copy of the document read from the YAML file.
+
+        :param yaml_file: path to the YAML file
+        :return: dictionary of the YAML document
+
+        """
+        if self.docs is None:
+            self.load()
+
+        yaml_path, stamp = self.get_key(yaml_file)
+        entry = self.docs.get(yaml_path)
+        if entry is None or entry.get('stamp') != stamp:
+            doc = XnatUtils.read_yaml(yaml_file)
+            try:
+                # Only keep documents that can be saved as JSON
+                json.dumps(doc)
+                self.docs[yaml_path] = {'stamp': stamp, 'doc': doc}
+                self.modified = True
+            except (TypeError, ValueError):
+                self.docs.pop(yaml_path, None)
+                return doc
+            entry = self.docs[yaml_path]
+
+        # AutoProcessor edits its documents: never return the cached one
+        return copy.deepcopy(entry['doc'])
+
+    def get_processor(self, yaml_file, user_inputs=None):
+        """
+        Get the AutoProcessor for the YAML file and the user inputs.
+
+        :param yaml_file: path to the YAML file
+        :param user_inputs: dictionary of the user inputs (see AutoProcessor)
+        :return: AutoProcessor object
+
+        """
+        yaml_path, stamp = self.get_key(yaml_file)
+        inputs_key = json.dumps(user_inputs, sort_keys=True, default=str)
+        key = (yaml_path, tuple(stamp), inputs_key)
+        if key not in self.processors:
+            self.processors[key] = AutoProcessor(yaml_file, user_inputs)
+        return self.processors[key]
+
+
+YAML_CACHE = YamlProcessorCache(YAML_CACHE_FILE)
+
+
+def get_auto_processor(yaml_file, user_inputs=None):
+    """
+    Get the AutoProcessor for a YAML file from the processors cache.
+
+    :param yaml_file: path to the YAML file defining the processor
+    :param user_inputs: dictionary of the user inputs (see AutoProcessor)
+    :return: AutoProcessor object
+
+    """
+    return YAML_CACHE.get_processor(yaml_file, user_inputs)
+
+
 def processors_by_type(proc_list):
     """
     Organize the processor types and return a list of session processors
@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" profiling.py
+
+Profiling of the dax commands (--profile option).
+
+When a profile is started, dax records:
+    - the wall time of the phases (command, project, session, ...),
+    - the REST calls made through XnatUtils.InterfaceTemp grouped by the URI
+      templates of XnatUtils (*_URI) with a latency histogram,
+    - the cluster commands run by dax.cluster,
+    - optionally a cProfile dump (--cprofile).
+The report is written as JSON next to the log file when the command ends.
+Nothing is recorded when no profile is started, except the counters of the
+REST calls of the pass running in the thread read by the metrics
+(metrics.py). The worker threads of a pass record their REST calls in the
+counters of the pass with inherit_rest_counters.
+"""
+
+from builtins import object
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import cProfile
+from datetime import datetime
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+
+__copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
+# Upper bounds of the latency histogram (seconds)
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                   30.0, float('inf')]
+PROFILE_EXT = '.profile.json'
+CPROFILE_EXT = '.prof'
+# Logger to print logs
+LOGGER = logging.getLogger('dax')
+# Profile running (None if --profile is not set)
+PROFILER = None
+# REST calls through XnatUtils.InterfaceTemp of the pass running in each
+# thread (metrics.py): the daemon uploads next to build/update/launch
+REST_LOCAL = threading.local()
+REST_LOCK = threading.Lock()
+URI_TEMPLATES = None
+URI_TEMPLATE_ARG_RE = re.compile(r'\{\w+\}')
+
+
+def get_uri_templates():
+    """
+    Get the URI templates of XnatUtils (*_URI constants) as regexes, the
+     most specific first.
+
+    :return: list of (template, compiled regex)
+    """
+    global URI_TEMPLATES
+    if URI_TEMPLATES is None:
+        from . import XnatUtils
+        templates = set(value for name, value in list(vars(XnatUtils).items())
+                        if name.endswith('_URI') and
+                        isinstance(value, str) and value.startswith('/'))
+        URI_TEMPLATES = list()
+        for template in sorted(templates, key=lambda tpl: (-len(tpl), tpl)):
+            pattern = '[^/]+'.join(
+                re.escape(part)
+                for part in URI_TEMPLATE_ARG_RE.split(template))
+            URI_TEMPLATES.append((template,
+                                  re.compile(r'^%s(/.*)?$' % pattern)))
+    return URI_TEMPLATES
+
+
+def get_uri_template(uri):
+    """
+    Get the XnatUtils template of a REST URI.
+
+    :param uri: URL or URI (e.g: https://xnat/data/projects/P/subjects?x=1)
+    :return: template (e.g: /REST/projects/{project}/subjects), followed by
+             /... when the URI goes deeper than the template (files)
+    """
+    path = re.sub(r'^[a-z]+://[^/]+', '', uri).split('?')[0].rstrip('/')
+    path = re.sub(r'^/data(/|$)', r'/REST\1', path)
+    for template, regex in get_uri_templates():
+        match = regex.match(path)
+        if match:
+            return template + ('/...' if match.group(1) else '')
+    return '/'.join(path.split('/')[:3]) + '/...'
+
+
+def get_histogram(values):
+    """
+    Count the values in LATENCY_BUCKETS.
+
+    :param values: list of seconds
+    :return: OrderedDict {upper bound: count}
+    """
+    histogram = OrderedDict((str(bucket), 0) for bucket in LATENCY_BUCKETS)
+    for value in values:
+        for bucket in LATENCY_BUCKETS:
+            if value <= bucket:
+                histogram[str(bucket)] += 1
+                break
+    return histogram
+
+
+class Profiler(object):
+    """ Class recording the timings of a dax command """
+    def __init__(self, command, output_path, cprofile=False):
+        """
+        Entry point for the Profiler class.
+
+        :param command: name of the command (e.g: build)
+        :param output_path: path of the JSON report
+        :param cprofile: also run cProfile (dump next to the report)
+        :return: None
+        """
+        self.command = command
+        self.output_path = output_path
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # path of the phase -> [count, seconds]
+        self.phases = OrderedDict()
+        # (method, template) -> list of (seconds, status)
+        self.rest_calls = OrderedDict()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        # executable -> list of seconds
+        self.commands = OrderedDict()
+        self.cprofile = cProfile.Profile() if cprofile else None
+        if self.cprofile:
+            self.cprofile.enable()
+
+    def get_stack(self):
+        """Phases running in the current thread."""
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = [self.command]
+        return self.local.stack
+
+    @contextmanager
+    def phase(self, name):
+        """Time a phase nested in the phases running in the thread."""
+        stack = self.get_stack()
+        stack.append(name)
+        path = '/'.join(stack)
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            stack.pop()
+            with self.lock:
+                count, seconds = self.phases.get(path, (0, 0.0))
+                self.phases[path] = (count + 1, seconds + duration)
+
+    def add_rest_call(self, method, url, seconds, status, sent=0,
+                      received=0):
+        """
+        Record a REST call.
+
+        :param method: HTTP method
+        :param url: URL of the call
+        :param seconds: latency
+        :param status: HTTP status code
+        :param sent: bytes of the request body
+        :param received: bytes of the response body
+        :return: None
+        """
+        key = (method, get_uri_template(url))
+        with self.lock:
+            self.rest_calls.setdefault(key, list()).append((seconds, status))
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+    def add_command(self, cmd, seconds):
+        """
+        Record a command run in a subprocess.
+
+        :param cmd: command line
+        :param seconds: time to run it
+        :return: None
+        """
+        executable = os.path.basename(cmd.split()[0]) if cmd.split() else cmd
+        with self.lock:
+            self.commands.setdefault(executable, list()).append(seconds)
+
+    def to_dict(self):
+        """
+        Report of the profile.
+
+        :return: dictionary
+        """
+        with self.lock:
+            rest = list()
+            for (method, template), calls in list(self.rest_calls.items()):
+                latencies = [call[0] for call in calls]
+                rest.append(OrderedDict([
+                    ('method', method), ('uri', template),
+                    ('count', len(calls)),
+                    ('errors', len([call for call in calls
+                                    if call[1] >= 400])),
+                    ('total', round(sum(latencies), 4)),
+                    ('max', round(max(latencies), 4)),
+                    ('histogram', get_histogram(latencies))]))
+            rest.sort(key=lambda call: -call['total'])
+            commands = OrderedDict(
+                (executable, OrderedDict([('count', len(times)),
+                                          ('total', round(sum(times), 4)),
+                                          ('max', round(max(times), 4))]))
+                for executable, times in list(self.commands.items()))
+            phases = OrderedDict(
+                (path, OrderedDict([('count', count),
+                                    ('total', round(seconds, 4))]))
+                for path, (count, seconds) in list(self.phases.items()))
+            return OrderedDict([
+                ('command', self.command),
+                ('pid', os.getpid()),
+                ('start', datetime.fromtimestamp(
+                    self.start_time).isoformat()),
+                ('wall_time', round(time.time() - self.start_time, 4)),
+                ('phases', phases),
+                ('rest', OrderedDict([
+                    ('count', sum(call['count'] for call in rest)),
+                    ('errors', sum(call['errors'] for call in rest)),
+                    ('total', round(sum(call['total'] for call in rest), 4)),
+                    ('bytes_sent', self.bytes_sent),
+                    ('bytes_received', self.bytes_received),
+                    ('calls', rest)])),
+                ('commands', commands),
+                ('cprofile', self.get_cprofile_path())])
+
+    def get_cprofile_path(self):
+        """Path of the cProfile dump (None without --cprofile)."""
+        if not self.cprofile:
+            return None
+        return re.sub(r'%s$' % re.escape(PROFILE_EXT), '',
+                      self.output_path) + CPROFILE_EXT
+
+    def write(self):
+        """Write the report (and the cProfile dump)."""
+        if self.cprofile:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.get_cprofile_path())
+        with open(self.output_path, 'w') as f_obj:
+            json.dump(self.to_dict(), f_obj, indent=2)
+        LOGGER.info('profile written to %s' % self.output_path)
+
+
+def get_output_path(command, logfile=None):
+    """
+    Path of the report: next to the log file or in the current directory.
+
+    :param command: name of the command
+    :param logfile: log file of the command
+    :return: path
+    """
+    if logfile:
+        return os.path.splitext(logfile)[0] + PROFILE_EXT
+    return os.path.abspath('dax_%s_%s%s' % (
+        command, datetime.now().strftime('%Y%m%d-%H%M%S'), PROFILE_EXT))
+
+
+def start(command, logfile=None, cprofile=False):
+    """
+    Start profiling the command.
+
+    :param command: name of the command (e.g: build)
+    :param logfile: log file of the command (the report is written next to
+                    it)
+    :param cprofile: also dump cProfile statistics
+    :return: Profiler object
+    """
+    global PROFILER
+    PROFILER = Profiler(command, get_output_path(command, logfile), cprofile)
+    return PROFILER
+
+
+def stop():
+    """Stop profiling and write the report."""
+    global PROFILER
+    if PROFILER is None:
+        return
+    profiler, PROFILER = PROFILER, None
+    try:
+        profiler.write()
+    except (IOError, OSError) as err:
+        LOGGER.warn('cannot write the profile %s: %s'
+                    % (profiler.output_path, err))
+
+
+@contextmanager
+def profile(command, logfile=None, enabled=True, cprofile=False):
+    """
+    Profile a block of code when enabled (--profile).
+
+    :param command: name of the command
+    :param logfile: log file of the command
+    :param enabled: False to run the block without profiling
+    :param cprofile: also dump cProfile statistics
+    """
+    if not enabled and not cprofile:
+        yield
+        return
+    start(command, logfile, cprofile)
+    try:
+        yield
+    finally:
+        stop()
+
+
+@contextmanager
+def phase(name):
+    """Time a phase of the command if profiling (no-op otherwise)."""
+    if PROFILER is None:
+        yield
+    else:
+        with PROFILER.phase(name):
+            yield
+
+
+@contextmanager
+def command(cmd):
+    """Time a command run in a subprocess if profiling."""
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        if PROFILER is not None:
+            PROFILER.add_command(cmd, time.time() - start_time)
+
+
+def get_body_size(body):
+    """Size of a request body (0 if streamed from a file)."""
+    if isinstance(body, (bytes, str)):
+        return len(body)
+    return 0
+
+
+def new_rest_counters():
+    """Counters of REST calls set to zero."""
+    return OrderedDict([('requests', 0), ('errors', 0),
+                        ('bytes_sent', 0), ('bytes_received', 0)])
+
+
+def set_rest_counters(counters):
+    """
+    Record the REST calls of the current thread in counters.
+
+    :param counters: OrderedDict from new_rest_counters, None to stop
+    :return: None
+    """
+    REST_LOCAL.counters = counters
+
+
+def get_rest_counters():
+    """
+    Get the REST counters of the current thread (see metrics.py).
+
+    :return: OrderedDict {counter: value}, None if not recording
+    """
+    return getattr(REST_LOCAL, 'counters', None)
+
+
+def inherit_rest_counters(function):
+    """
+    Record the REST calls of a function run by worker threads in the
+     counters of the current thread.
+
+    :param function: function called by the workers (e.g: ThreadPool.map)
+    :return: wrapped function
+    """
+    counters = get_rest_counters()
+
+    def wrapper(*args, **kwargs):
+        set_rest_counters(counters)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            set_rest_counters(None)
+    return wrapper
+
+
+def record_response(response, *args, **kwargs):
+    """
+    requests hook recording the REST calls of an Interface: in the counters
+     of the thread and in the profile if started.
+    """
+    try:
+        received = int(response.headers.get('Content-Length') or 0)
+    except ValueError:
+        received = 0
+    request = response.request
+    sent = get_body_size(request.body)
+    counters = get_rest_counters()
+    if counters is not None:
+        with REST_LOCK:
+            counters['requests'] += 1
+            if response.status_code >= 400:
+                counters['errors'] += 1
+            counters['bytes_sent'] += sent
+            counters['bytes_received'] += received
+    if PROFILER is not None:
+        PROFILER.add_rest_call(request.method, request.url,
+                               response.elapsed.total_seconds(),
+                               response.status_code, sent, received)
+
+
+def instrument_interface(intf):
+    """
+    Record the REST calls of a pyxnat Interface (requests session hook).
+
+    :param intf: pyxnat.Interface object
+    :return: None
+    """
+    session = getattr(intf, '_http', None)
+    if session is None:
+        return
+    hooks = session.hooks.setdefault('response', list())
+    if record_response not in hooks:
+        hooks.append(record_response)
+
+
+def add_profile_arguments(parser):
+    """
+    Add --profile/--cprofile to the parser of a command.
+
+    :param parser: argparse parser
+    :return: None
+    """
+    _help = 'Write a JSON report of the wall time of the phases, the REST \
+calls and the cluster commands next to the log file.'
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        help=_help)
+    _help = 'With --profile, also dump cProfile statistics (.prof).'
+    parser.add_argument('--cprofile', dest='cprofile', action='store_true',
+                        help=_help)
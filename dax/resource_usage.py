@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" resource_usage.py
+
+Resource usage of the commands run by a spider (wall time, CPU, peak memory
+of the process tree and I/O), written in a JSON file in the assessor upload
+directory so dax upload can set memused/walltimeused/jobnode without asking
+the scheduler (sacct/tracejob).
+"""
+
+import json
+import logging
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+
+
+__copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
+USAGE_FILE = 'resource_usage.json'
+POLL_INTERVAL = 1.0  # seconds
+# Start of the spider process for the elapsed time of the job
+JOB_START = time.time()
+# Commands run by this process
+JOB_STEPS = list()
+# Logger to print logs
+LOGGER = logging.getLogger('dax')
+
+
+def get_maxrss_kb(who):
+    """
+    Get the peak resident memory from getrusage in kB.
+
+    :param who: resource.RUSAGE_SELF or resource.RUSAGE_CHILDREN
+    :return: peak RSS in kB
+    """
+    maxrss = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes on MacOS
+        maxrss = maxrss // 1024
+    return maxrss
+
+
+def get_children_pids(pid):
+    """
+    Get the pids of all the descendants of a process from /proc.
+
+    :param pid: pid of the process
+    :return: list of pids (including pid)
+    """
+    children = dict()
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry, 'r') as f_obj:
+                stat = f_obj.read()
+        except (IOError, OSError):
+            continue
+        # the command name between parentheses can hold spaces
+        ppid = int(stat[stat.rfind(')') + 2:].split()[1])
+        children.setdefault(ppid, list()).append(int(entry))
+
+    pids = [pid]
+    for _pid in pids:
+        pids.extend(children.get(_pid, list()))
+    return pids
+
+
+def get_process_usage(pid):
+    """
+    Get the current RSS (kB) and I/O bytes of a process from /proc.
+
+    :param pid: pid of the process
+    :return: (rss_kb, read_bytes, write_bytes), None if the process is gone
+    """
+    rss = 0
+    read_bytes = write_bytes = 0
+    try:
+        with open('/proc/%s/status' % pid, 'r') as f_obj:
+            for line in f_obj:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1])
+                    break
+        with open('/proc/%s/io' % pid, 'r') as f_obj:
+            for line in f_obj:
+                if line.startswith('read_bytes:'):
+                    read_bytes = int(line.split()[1])
+                elif line.startswith('write_bytes:'):
+                    write_bytes = int(line.split()[1])
+    except (IOError, OSError, ValueError, IndexError):
+        if not os.path.isdir('/proc/%s' % pid):
+            return None
+    return rss, read_bytes, write_bytes
+
+
+class ProcessTreeMonitor(threading.Thread):
+    """ Thread polling the memory and I/O of a process and its children """
+    def __init__(self, pid, cmd=None):
+        """
+        Entry point for the ProcessTreeMonitor class.
+
+        :param pid: pid of the process to follow
+        :param cmd: command run by the process (for the report)
+        :return: None
+        """
+        super(ProcessTreeMonitor, self).__init__()
+        self.daemon = True
+        self.pid = pid
+        self.cmd = cmd
+        self.peak_rss = 0
+        # last I/O counters seen for each process of the tree
+        self.io_bytes = dict()
+        self.use_proc = os.path.isdir('/proc/%s' % pid)
+        self.stopped = threading.Event()
+        self.start_time = time.time()
+        self.start_rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.start_maxrss = get_maxrss_kb(resource.RUSAGE_CHILDREN)
+
+    def poll(self):
+        """Read the usage of the process tree once."""
+        rss = 0
+        for pid in get_children_pids(self.pid):
+            usage = get_process_usage(pid)
+            if usage:
+                rss += usage[0]
+                self.io_bytes[pid] = usage[1:]
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def run(self):
+        while self.use_proc and not self.stopped.is_set():
+            try:
+                self.poll()
+            except (IOError, OSError):
+                self.use_proc = False
+            self.stopped.wait(POLL_INTERVAL)
+
+    def stop(self, returncode=None):
+        """
+        Stop the monitor once the process finished and get the usage.
+
+        The process must have been waited for: its CPU time and peak memory
+        are then counted in getrusage(RUSAGE_CHILDREN).
+
+        :param returncode: exit code of the process
+        :return: dictionary with the usage of the step
+        """
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        end_rusage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        read_bytes = sum(io[0] for io in self.io_bytes.values())
+        write_bytes = sum(io[1] for io in self.io_bytes.values())
+        # block I/O counted by the kernel for the processes waited for
+        read_bytes = max(read_bytes, 512 * (end_rusage.ru_inblock -
+                                            self.start_rusage.ru_inblock))
+        write_bytes = max(write_bytes, 512 * (end_rusage.ru_oublock -
+                                              self.start_rusage.ru_oublock))
+        # peak of the biggest child waited for if it ran during this step
+        children_maxrss = get_maxrss_kb(resource.RUSAGE_CHILDREN)
+        if children_maxrss > self.start_maxrss:
+            self.peak_rss = max(self.peak_rss, children_maxrss)
+        return {
+            'cmd': self.cmd,
+            'start': self.start_time,
+            'walltime': time.time() - self.start_time,
+            'user_cpu': end_rusage.ru_utime - self.start_rusage.ru_utime,
+            'system_cpu': end_rusage.ru_stime - self.start_rusage.ru_stime,
+            'max_rss_kb': self.peak_rss,
+            'read_bytes': read_bytes,
+            'write_bytes': write_bytes,
+            'returncode': returncode}
+
+
+def monitor_process(pid, cmd=None):
+    """
+    Start following the usage of a process and its children.
+
+    :param pid: pid of the process
+    :param cmd: command run by the process
+    :return: ProcessTreeMonitor object (call stop() once the process ended)
+    """
+    monitor = ProcessTreeMonitor(pid, cmd)
+    monitor.start()
+    return monitor
+
+
+def record_step(step):
+    """
+    Add the usage of a command to the usage of the job.
+
+    :param step: dictionary returned by ProcessTreeMonitor.stop()
+    :return: None
+    """
+    JOB_STEPS.append(step)
+
+
+def get_job_usage(steps=None):
+    """
+    Get the usage of the job from the usage of its steps.
+
+    :param steps: list of steps (default: the steps run by this process)
+    :return: dictionary with the summary and the steps
+    """
+    if steps is None:
+        steps = JOB_STEPS
+    max_rss = max([get_maxrss_kb(resource.RUSAGE_SELF)] +
+                  [step['max_rss_kb'] for step in steps])
+    return {
+        'node': socket.gethostname(),
+        'start': JOB_START,
+        'walltime': time.time() - JOB_START,
+        'user_cpu': sum(step['user_cpu'] for step in steps),
+        'system_cpu': sum(step['system_cpu'] for step in steps),
+        'max_rss_kb': max_rss,
+        'read_bytes': sum(step['read_bytes'] for step in steps),
+        'write_bytes': sum(step['write_bytes'] for step in steps),
+        'steps': steps}
+
+
+def write_usage_file(directory, steps=None):
+    """
+    Write the usage of the job in the upload directory of the assessor.
+
+    :param directory: assessor upload directory
+    :param steps: list of steps (default: the steps run by this process)
+    :return: path to the file
+    """
+    fpath = os.path.join(directory, USAGE_FILE)
+    tmp_path = '%s.tmp' % fpath
+    with open(tmp_path, 'w') as f_obj:
+        json.dump(get_job_usage(steps), f_obj, indent=2)
+    os.rename(tmp_path, fpath)
+    return fpath
+
+
+def read_usage_file(directory):
+    """
+    Read the usage of the job written in the assessor upload directory.
+
+    :param directory: assessor upload directory
+    :return: dictionary with the usage, None if no file or unreadable
+    """
+    fpath = os.path.join(directory, USAGE_FILE)
+    if not os.path.isfile(fpath):
+        return None
+    try:
+        with open(fpath, 'r') as f_obj:
+            return json.load(f_obj)
+    except (IOError, ValueError) as err:
+        LOGGER.warn('cannot read %s: %s' % (fpath, err))
+        return None
+
+
+def format_walltime(seconds):
+    """
+    Format a duration like the scheduler (HH:MM:SS).
+
+    :param seconds: duration in seconds
+    :return: string
+    """
+    seconds = int(round(seconds))
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60,
+                               seconds % 60)
+
+
+def get_xnat_usage(directory):
+    """
+    Get memused/walltimeused/jobnode for XNAT from the usage file.
+
+    The memory is in kB like the values from sacct/tracejob.
+
+    :param directory: assessor upload directory
+    :return: dictionary {'memused', 'walltimeused', 'jobnode'} or None
+    """
+    usage = read_usage_file(directory)
+    if not usage:
+        return None
+    return {'memused': str(int(usage['max_rss_kb'])),
+            'walltimeused': format_walltime(usage['walltime']),
+            'jobnode': usage['node']}
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" scheduler.py
+
+Order in which dax launch submits the tasks that need to run.
+
+The tasks are picked one at a time:
+    - tasks of a project or proctype at its concurrency cap are held,
+    - the highest explicit priority (project + proctype) goes first,
+    - then the project with the lowest share of the queue:
+        (running + launched jobs) / weight - age_weight * age (days)
+      so every project gets jobs in proportion of its weight and old
+      tasks are not starved,
+    - ties go to the oldest task, then to the order of priority_project.
+"""
+
+from builtins import object
+
+from collections import defaultdict
+from datetime import datetime
+import logging
+
+
+__copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
+# Jobs of share forgiven for each day a task waits
+DEFAULT_AGE_WEIGHT = 0.5
+DEFAULT_WEIGHT = 1.0
+DATE_FORMAT = '%Y-%m-%d'
+# Logger to print logs
+LOGGER = logging.getLogger('dax')
+
+
+def get_age_days(date_str, now=None):
+    """
+    Get the age in days of a task from its date.
+
+    :param date_str: date of the task (starting with %Y-%m-%d)
+    :param now: datetime of reference (default: now)
+    :return: age in days (0 if unknown)
+    """
+    if not date_str:
+        return 0.0
+    try:
+        date = datetime.strptime(str(date_str)[:10], DATE_FORMAT)
+    except ValueError:
+        return 0.0
+    now = now or datetime.now()
+    return max(0.0, (now - date).total_seconds() / 86400.0)
+
+
+class LaunchScheduler(object):
+    """ Class to order the tasks to launch between projects/proctypes """
+    def __init__(self, project_weights=None, project_limits=None,
+                 proctype_limits=None, priorities=None,
+                 priority_project=None, age_weight=DEFAULT_AGE_WEIGHT):
+        """
+        Entry point for the LaunchScheduler class.
+
+        :param project_weights: dictionary {project: weight} (default 1)
+        :param project_limits: dictionary {project: maximum running jobs}
+        :param proctype_limits: dictionary {proctype: maximum running jobs}
+        :param priorities: dictionary {project or proctype: priority}
+                           (default 0, higher first)
+        :param priority_project: list of projects breaking the ties
+        :param age_weight: share forgiven for each day a task waits
+        :return: None
+        """
+        self.project_weights = project_weights or dict()
+        self.project_limits = project_limits or dict()
+        self.proctype_limits = proctype_limits or dict()
+        self.priorities = priorities or dict()
+        self.priority_project = priority_project or list()
+        self.age_weight = age_weight
+
+    def get_weight(self, project):
+        """Weight of a project for the fair share."""
+        return float(self.project_weights.get(project, DEFAULT_WEIGHT))
+
+    def get_priority(self, project, proctype):
+        """Explicit priority of a task."""
+        return (int(self.priorities.get(project, 0)) +
+                int(self.priorities.get(proctype, 0)))
+
+    def get_rank(self, project):
+        """Rank of the project in priority_project (tie breaker)."""
+        if project in self.priority_project:
+            return self.priority_project.index(project)
+        return len(self.priority_project)
+
+    def order(self, tasks, running=None):
+        """
+        Generate the tasks in the order to launch them with the reason.
+
+        The caller stops iterating when the queue is full: the shares
+        account for the tasks already generated.
+
+        :param tasks: list of tuples (task, project, proctype, age in days)
+        :param running: dictionary {(project, proctype): running jobs}
+        :return: generator of (task, reason)
+        """
+        running_project = defaultdict(int)
+        running_proctype = defaultdict(int)
+        for (project, proctype), count in list((running or dict()).items()):
+            running_project[project] += count
+            running_proctype[proctype] += count
+
+        # One queue per project/proctype, oldest task first
+        queues = defaultdict(list)
+        for task_info in tasks:
+            queues[(task_info[1], task_info[2])].append(task_info)
+        for queue in list(queues.values()):
+            queue.sort(key=lambda info: info[3])
+
+        while queues:
+            candidates = list()
+            for (project, proctype), queue in list(queues.items()):
+                held = self.is_held(project, proctype, running_project,
+                                    running_proctype)
+                if held:
+                    LOGGER.info('  holding %d task(s) of %s/%s: %s'
+                                % (len(queue), project, proctype, held))
+                    del queues[(project, proctype)]
+                    continue
+                age = queue[-1][3]
+                share = running_project[project] / self.get_weight(project)
+                candidates.append((-self.get_priority(project, proctype),
+                                   share - self.age_weight * age, -age,
+                                   self.get_rank(project), project, proctype,
+                                   share))
+            if not candidates:
+                return
+
+            candidate = min(candidates)
+            project, proctype, share = candidate[4:]
+            task_info = queues[(project, proctype)].pop()
+            if not queues[(project, proctype)]:
+                del queues[(project, proctype)]
+            reason = 'project %s: %d running/launched, weight %s \
+(share %.2f); age %.1fd; priority %d' % (
+                project, running_project[project], self.get_weight(project),
+                share, task_info[3], -candidate[0])
+            running_project[project] += 1
+            running_proctype[proctype] += 1
+            yield task_info[0], reason
+
+    def is_held(self, project, proctype, running_project, running_proctype):
+        """
+        Check the concurrency caps of a project/proctype.
+
+        :return: reason string if held, None otherwise
+        """
+        limit = self.project_limits.get(project)
+        if limit is not None and running_project[project] >= int(limit):
+            return 'project limit %s reached' % limit
+        limit = self.proctype_limits.get(proctype)
+        if limit is not None and running_proctype[proctype] >= int(limit):
+            return 'proctype limit %s reached' % limit
+        return None
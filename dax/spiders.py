@@ -21,21 +21,19 @@ import collections
 import csv
 from datetime import datetime
 import glob
-import matplotlib.pyplot as plt
-import nibabel as nib
-import numpy as np
 import os
 import re
-from scipy.misc import imresize
-from shutil import copyfile, copytree
 from stat import S_IXUSR, ST_MODE
 from string import Template
 import subprocess as sb
 import sys
 import time
 
+from . import resource_usage
 from . import XnatUtils
 from .errors import SpiderError, AutoSpiderError
+from .input_cache import get_input_cache
+from .staging import check_staging, stage_path
 
 
 try:
@@ -62,11 +60,6 @@ Spider information:
 {extra}
 """
 
-FSLSWAP_VAL = {0: 'x',
-               1: 'y',
-               2: 'z'}
-
-
 class Spider(object):
     """ Base class for spider """
     def __init__(self, spider_path, jobdir,
@@ -267,18 +260,13 @@ your spider.')
                     xnat_dict = self.get_xnat_dict(data_dict, res)
                     res_str = self.select_str(xnat_dict)
                     resource_obj = xnat.select(res_str)
-                    resource_obj.get(data_folder, extract=True)
-                    resource_dir = os.path.join(data_folder,
-                                                resource_obj.label())
-                    list_files = list()
-                    for root, _, filenames in os.walk(resource_dir):
-                        list_files.extend([os.path.join(root, filename)
-                                           for filename in filenames])
-                    list_inputs[res] = list_files
+                    list_inputs[res] = XnatUtils.download_files_from_obj(
+                        data_folder, resource_obj)
                 if data_dict['label'] in list(self.data.keys()):
                     self.data[data_dict['label']].update(list_inputs)
                 else:
                     self.data[data_dict['label']] = list_inputs
+        print_input_cache_stats(self.time_writer)
         self.time_writer('-----------------------------------')
 
     def get_xnat_dict(self, data_dict, resource):
@@ -602,6 +590,13 @@ for resource %s : %s"
             vmins=vmins, vmaxs=vmaxs, volume_ind=volume_ind, orient=orient,
             time_writer=self.time_writer)
 
+    def plot_images_pages(self, pages, workers=None):
+        """Plot several PDF pages of images in a pool of processes.
+
+        See function at the end of the file.
+        """
+        return plot_images_pages(pages, workers, self.time_writer)
+
     def plot_stats_page(self, pdf_path, page_index, stats_dict, title,
                         tables_number=3, columns_header=['Header', 'Value'],
                         limit_size_text_column1=30,
@@ -868,7 +863,8 @@ UNICODE_AUTOSPIDER = """AutoSpider information:
 class AutoSpider(object):
     """ Class for Autospider """
     def __init__(self, name, params, outputs, template, version=None,
-                 exe_lang=None):
+                 exe_lang=None, input_staging='reflink',
+                 output_staging='link'):
         """
         Entry point for Autospider class
 
@@ -878,7 +874,19 @@ class AutoSpider(object):
         :param template: template to run
         :param version: spider version
         :param exe_lang: executable language (python, matlab, bash, ruby)
-        """
+        :param input_staging: how to copy the local inputs: reflink, link,
+                              copy or symlink for inputs never modified
+                              (see dax.staging)
+        :param output_staging: how to copy the outputs to the upload queue:
+                               move, link, reflink or copy
+        """
+        check_staging(input_staging)
+        check_staging(output_staging)
+        if input_staging == 'move':
+            raise AutoSpiderError('inputs can not be moved, use link/reflink/\
+copy/symlink for input_staging.')
+        self.input_staging = input_staging
+        self.output_staging = output_staging
         self.name = name
         self.params = params
         self.outputs = list()
@@ -1049,6 +1057,7 @@ The format {} can not be read by the spider because {} is not an input.'
         Implemented in derived class objects."""
         self.time_writer('AutoSpider pre_run(): Download/copy inputs...')
         self.copy_inputs()
+        print_input_cache_stats(self.time_writer)
 
     def run(self):
         """Run method to execute the template for AutoSpider."""
@@ -1095,7 +1104,8 @@ GeneratorAutoSpider.')
             self.spider_name, self.suffix,
             assessor_handler=self.ahandler,
             time_writer=self.time_writer,
-            host=self.src_inputs.get('host', os.environ['XNAT_HOST']))
+            host=self.src_inputs.get('host', os.environ['XNAT_HOST']),
+            staging=self.output_staging)
 
         self.time_writer('AutoSpider finish(): Copying outputs...')
 
@@ -1215,12 +1225,9 @@ GeneratorAutoSpider.')
         dst_dir = os.path.join(self.input_dir, input_name)
         os.makedirs(dst_dir)
 
-        if os.path.isdir(src):
+        if os.path.exists(src):
             dst = os.path.join(dst_dir, os.path.basename(src))
-            copytree(src, dst)
-        elif os.path.isfile(src):
-            dst = os.path.join(dst_dir, os.path.basename(src))
-            copyfile(src, dst)
+            stage_path(src, dst, self.input_staging)
         else:
             raise AutoSpiderError('input does not exist: %s' % src)
 
@@ -1297,6 +1304,18 @@ XNAT+REST+API+Directory for the path.'
         self.time_writer("-----------------------------------")
 
 
+def print_input_cache_stats(time_writer):
+    """
+    Print the hits/misses of the node input cache if enabled.
+
+    :param time_writer: function to print the message
+    :return: None
+    """
+    cache = get_input_cache()
+    if cache:
+        time_writer(cache.stats())
+
+
 # class to display time
 class TimedWriter(object):
     '''
@@ -1559,19 +1578,27 @@ def execute_cmd(cmd, time_writer=None):
     """
     Execute a command and print in time the output using subprocess
 
+    The resource usage of the command (see dax.resource_usage) is recorded
+    and written with the results by SpiderProcessHandler.done().
+
     :param cmd: command to run
     :return: True if succeeded, False otherwise
     """
-    process = sb.Popen(cmd, shell=True, stdout=sb.PIPE, stderr=sb.STDOUT)
+    process = sb.Popen(cmd, shell=True, stdout=sb.PIPE, stderr=sb.STDOUT,
+                       universal_newlines=True)
+    monitor = resource_usage.monitor_process(process.pid, cmd)
 
-    # Poll process for new output until finished
-    while True:
-        nextline = process.stdout.readline().rstrip()
-        if nextline == '' and process.poll() is not None:
-            break
-        use_time_writer(time_writer, nextline)
+    # Print the output of the process until finished
+    for nextline in iter(process.stdout.readline, ''):
+        use_time_writer(time_writer, nextline.rstrip())
 
     output, error = process.communicate()
+    step = monitor.stop(process.returncode)
+    resource_usage.record_step(step)
+    use_time_writer(time_writer, 'INFO: resource usage: walltime %.1fs, \
+cpu %.1fs user %.1fs system, peak memory %dkB' % (
+        step['walltime'], step['user_cpu'], step['system_cpu'],
+        step['max_rss_kb']))
 
     if process.returncode:
         return False
@@ -1579,6 +1606,99 @@ def execute_cmd(cmd, time_writer=None):
 
 
 # PDF Generator for spiders:
+class NiftiSliceReader(object):
+    """Read 2D slices of a NIfTI image in the closest RAS orientation.
+
+    The image is not loaded: nibabel memory-maps it (or reads the gzip
+    stream) and only the slices asked are read. The reorientation is
+    computed from the affine (no fslswapdim, no temporary file).
+    """
+    def __init__(self, image, volume_ind=None):
+        """
+        Entry point for NiftiSliceReader class
+
+        :param image: path to the NIfTI image
+        :param volume_ind: volume to display for 4D images (default: middle)
+        """
+        import nibabel as nib
+
+        self.img = nib.load(image)
+        img_shape = self.img.shape
+        # for each axis of the image: (RAS axis, flip)
+        ornt = nib.orientations.io_orientation(self.img.affine)
+        self.axes = [int(axis) for axis in ornt[:, 0]]
+        self.flips = [flip < 0 for flip in ornt[:, 1]]
+        self.volume = None
+        if len(img_shape) > 3:
+            if isinstance(volume_ind, int):
+                self.volume = volume_ind
+            else:
+                self.volume = old_div(img_shape[3], 2)
+        self.shape = [0, 0, 0]
+        for axis in range(3):
+            self.shape[self.axes[axis]] = img_shape[axis]
+
+    def get_slice(self, ras_axis, index):
+        """
+        Read one slice of the reoriented volume.
+
+        :param ras_axis: axis of the slice in the reoriented volume (0, 1, 2)
+        :param index: index of the slice on this axis
+        :return: 2D numpy array
+        """
+        import numpy as np
+
+        axis = self.axes.index(ras_axis)
+        slicer = [slice(None)] * len(self.img.shape)
+        if self.flips[axis]:
+            index = self.img.shape[axis] - 1 - index
+        slicer[axis] = index
+        if self.volume is not None:
+            slicer[3] = self.volume
+        for dim in range(len(self.img.shape))[4:]:
+            slicer[dim] = 0
+        dslice = np.asanyarray(self.img.dataobj[tuple(slicer)])
+        others = [ind for ind in range(3) if ind != axis]
+        for pos, ind in enumerate(others):
+            if self.flips[ind]:
+                dslice = np.flip(dslice, pos)
+        if self.axes[others[0]] > self.axes[others[1]]:
+            dslice = dslice.T
+        return dslice
+
+
+def _plot_images_kwargs(kwargs):
+    """Run plot_images with a dictionary of arguments (process pool)."""
+    return plot_images(**kwargs)
+
+
+def plot_images_pages(pages, workers=None, time_writer=None):
+    """Plot several PDF pages of images in a pool of processes.
+
+    :param pages: list of dictionaries with the arguments of plot_images
+                  for each page (without time_writer)
+    :param workers: number of processes (default: the CPUs of the job)
+    :param time_writer: function to print with time (default using print)
+    :return: list of the pdf paths created
+    """
+    from multiprocessing import Pool
+    from .compression import get_cpus
+
+    if not workers:
+        workers = get_cpus()
+    workers = min(workers, len(pages))
+    use_time_writer(time_writer, 'INFO: generating %d pdf pages with %d \
+processes.' % (len(pages), max(workers, 1)))
+    if workers <= 1:
+        return [_plot_images_kwargs(page) for page in pages]
+    pool = Pool(workers)
+    try:
+        return pool.map(_plot_images_kwargs, pages)
+    finally:
+        pool.close()
+        pool.join()
+
+
 # Display images:
 def plot_images(pdf_path, page_index, nii_images, title,
                 image_labels, slices=None, cmap='gray',
@@ -1623,6 +1743,10 @@ def plot_images(pdf_path, page_index, nii_images, title,
     vmaxs = {'0':100,
              '1':150}
     """
+    import matplotlib.pyplot as plt
+    import numpy as np
+    from scipy.misc import imresize
+
     plt.ioff()
     use_time_writer(time_writer, 'INFO: generating pdf page %d with images.'
                                  % page_index)
@@ -1651,50 +1775,9 @@ Using default.")
         use_time_writer(time_writer, 'INFO: display different plan view \
 (ax/sag/cor) of the mid slice.')
     for index, image in enumerate(nii_images):
-        # Open niftis with nibabel
-        f_img_ori = nib.load(image)
-        # Reorient for display with python if fslswapdim exists:
-        if True in [os.path.isfile(os.path.join(path, 'fslswapdim')) and
-                    os.access(os.path.join(path, 'fslswapdim'), os.X_OK)
-                    for path in os.environ["PATH"].split(os.pathsep)]:
-            if image.endswith('.nii.gz'):
-                ext = '.nii.gz'
-            else:
-                ext = '.nii'
-            image_name = ('%s_reorient%s'
-                          % (os.path.basename(image).split('.')[0], ext))
-            image_reorient = os.path.join(os.path.dirname(image),
-                                          image_name)
-            qform = f_img_ori.header.get_qform()
-            v = np.argmax(np.absolute(qform[0:3, 0:3]), axis=0)
-            neg = {0: '', 1: '', 2: ''}
-            if qform[v[0]][0] < 0:
-                neg[0] = '-'
-            if qform[v[1]][1] < 0:
-                neg[1] = '-'
-            if qform[v[2]][2] < 0:
-                neg[2] = '-'
-            args = '%s%s %s%s %s%s' % (neg[np.where(v == 0)[0][0]],
-                                       FSLSWAP_VAL[np.where(v == 0)[0][0]],
-                                       neg[np.where(v == 1)[0][0]],
-                                       FSLSWAP_VAL[np.where(v == 1)[0][0]],
-                                       neg[np.where(v == 2)[0][0]],
-                                       FSLSWAP_VAL[np.where(v == 2)[0][0]])
-            cmd = 'fslswapdim %s %s %s' % (image, args, image_reorient)
-            use_time_writer(time_writer, 'INFO: command: %s' % cmd)
-            os.system(cmd)
-
-            if not os.path.exists(image_reorient) and \
-               image_reorient.endswith('.nii'):
-                image_reorient = '%s.gz' % image_reorient
-            data = nib.load(image_reorient).get_data()
-        else:
-            data = f_img_ori.get_data()
-        if len(data.shape) > 3:
-            if isinstance(volume_ind, int):
-                data = data[:, :, :, volume_ind]
-            else:
-                data = data[:, :, :, old_div(data.shape[3], 2)]
+        # Memory-mapped image reoriented in-process: only the slices
+        # displayed are read from the file
+        data = NiftiSliceReader(image, volume_ind)
         default_slices = [old_div(data.shape[2], 4), old_div(data.shape[2], 2),
                           3 * old_div(data.shape[2], 4)]
         default_label = 'Line %s' % index
@@ -1709,11 +1792,11 @@ dictionary. Using default.")
                 ind = slices_number * index + slice_ind + 1
                 ax = fig.add_subplot(number_im, slices_number, ind)
                 if orient == 'cor':
-                    dslice = data[:, slice_value, :]
+                    dslice = data.get_slice(1, slice_value)
                 elif orient == 'ax':
-                    dslice = data[:, :, slice_value]
+                    dslice = data.get_slice(2, slice_value)
                 else:
-                    dslice = data[slice_value, :, :]
+                    dslice = data.get_slice(0, slice_value)
                 ax.imshow(np.rot90(np.transpose(dslice), 2),
                           cmap=cmap.get(str(index), default_cmap),
                           vmin=vmins.get(str(index), None),
@@ -1728,15 +1811,15 @@ dictionary. Using default.")
         else:
             # Fix Orientation:
             dslice = []
-            dslice_z = data[:, :, old_div(data.shape[2], 2)]
+            dslice_z = data.get_slice(2, old_div(data.shape[2], 2))
             if dslice_z.shape[0] != dslice_z.shape[1]:
                 dslice_z = imresize(dslice_z, (max(dslice_z.shape),
                                                max(dslice_z.shape)))
-            dslice_y = data[:, old_div(data.shape[1], 2), :]
+            dslice_y = data.get_slice(1, old_div(data.shape[1], 2))
             if dslice_y.shape[0] != dslice_y.shape[1]:
                 dslice_y = imresize(dslice_y, (max(dslice_y.shape),
                                                max(dslice_y.shape)))
-            dslice_x = data[old_div(data.shape[0], 2), :, :]
+            dslice_x = data.get_slice(0, old_div(data.shape[0], 2))
             if dslice_x.shape[0] != dslice_x.shape[1]:
                 dslice_x = imresize(dslice_x, (max(dslice_x.shape),
                                                max(dslice_x.shape)))
@@ -1805,6 +1888,8 @@ def plot_stats(pdf_path, page_index, stats_dict, title,
     :param time_writer: function to print with time (default using print)
     :return: pdf path created
     """
+    import matplotlib.pyplot as plt
+
     plt.ioff()
     use_time_writer(time_writer,
                     'INFO: generating pdf page %d with stats.' % page_index)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" staging.py
+
+Stage files and folders (inputs of a job, outputs into the upload queue)
+without copying the data when possible.
+
+Staging methods, from the cheapest to the most expensive:
+    move:    os.rename (same filesystem, the source is gone)
+    link:    hardlink (same filesystem, the source is kept)
+    reflink: copy-on-write clone (cp --reflink=always, btrfs/XFS/...)
+    copy:    full copy of the data
+A method falls back on the methods after it when it is not possible. The
+method symlink only creates a symbolic link to the source (for inputs that
+are never modified: nothing is read before the job needs it).
+"""
+
+import errno
+import os
+import shutil
+import subprocess as sb
+
+
+__copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
+STAGING_METHODS = ['move', 'link', 'reflink', 'copy']
+STAGING_CHOICES = STAGING_METHODS + ['symlink']
+
+
+def check_staging(method):
+    """
+    Check that the staging method is known.
+
+    :param method: staging method
+    :return: None
+    """
+    if method not in STAGING_CHOICES:
+        err = 'unknown staging method %s, choose from: %s'
+        raise ValueError(err % (method, ', '.join(STAGING_CHOICES)))
+
+
+def reflink_file(src, dst):
+    """
+    Clone a file with copy-on-write if the filesystem supports it.
+
+    :param src: path to the source file
+    :param dst: path to the new file
+    :return: True if the clone was created, False otherwise
+    """
+    try:
+        ret = sb.call(['cp', '--reflink=always', src, dst],
+                      stdout=sb.PIPE, stderr=sb.PIPE)
+    except OSError:
+        return False
+    if ret != 0 and os.path.exists(dst):
+        os.remove(dst)
+    return ret == 0
+
+
+def stage_file(src, dst, method='link'):
+    """
+    Stage a file to dst using the method or the fallbacks after it.
+
+    :param src: path to the source file
+    :param dst: path to the destination file
+    :param method: staging method (see STAGING_CHOICES)
+    :return: the method used
+    """
+    check_staging(method)
+    if method == 'symlink':
+        os.symlink(os.path.abspath(src), dst)
+        return method
+    for _method in STAGING_METHODS[STAGING_METHODS.index(method):]:
+        if _method == 'move':
+            try:
+                os.rename(src, dst)
+                return _method
+            except OSError as err:
+                if err.errno != errno.EXDEV:
+                    raise
+        elif _method == 'link':
+            try:
+                os.link(src, dst)
+                return _method
+            except OSError:
+                pass
+        elif _method == 'reflink':
+            if reflink_file(src, dst):
+                return _method
+    shutil.copy2(src, dst)
+    return 'copy'
+
+
+def stage_path(src, dst, method='link'):
+    """
+    Stage a file or a folder to dst using the method or its fallbacks.
+
+    For a folder, the tree is recreated in dst and each file is staged.
+
+    :param src: path to the source file/folder
+    :param dst: path to the destination (must not exist)
+    :param method: staging method (see STAGING_CHOICES)
+    :return: the methods used (set)
+    """
+    check_staging(method)
+    if not os.path.isdir(src) or method == 'symlink':
+        return set([stage_file(src, dst, method)])
+    if method == 'move':
+        try:
+            os.rename(src, dst)
+            return set([method])
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                raise
+
+    methods = set()
+    for root, _, filenames in os.walk(src, followlinks=True):
+        dst_root = os.path.join(dst, os.path.relpath(root, src))
+        if not os.path.isdir(dst_root):
+            os.makedirs(dst_root)
+        for filename in filenames:
+            methods.add(stage_file(os.path.join(root, filename),
+                                   os.path.join(dst_root, filename), method))
+    return methods
@@ -10,7 +10,14 @@ import os
 import shutil
 import time
 
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
 from . import cluster
+from . import resource_usage
+from . import usage_history
 from .cluster import PBS
 from .errors import (NeedInputsException, NoDataException,
                      ClusterLaunchException)
@@ -112,15 +119,43 @@ def create_flag(flag_path):
     open(flag_path, 'w').close()
 
 
+def create_assessor(assessor, processor):
+    """
+    Create the assessor on XNAT with its initial attributes.
+
+    The creation date, proctype/procversion and the initial procstatus and
+    qcstatus are sent in the creation request itself.
+
+    :param assessor: pyxnat assessor EObject that does not exist yet
+    :param processor: processor used to generate the assessor
+    :return: None
+
+    """
+    atype = processor.xsitype.lower()
+    params = {'%s/date' % atype: str(date.today()),
+              '%s/procstatus' % atype: NEED_INPUTS,
+              '%s/validation/status' % atype: JOB_PENDING}
+    if atype == DEFAULT_FS_DATATYPE.lower():
+        params['%s/fsversion' % atype] = '0'
+    elif atype == DEFAULT_DATATYPE.lower():
+        params['%s/proctype' % atype] = processor.name
+        params['%s/procversion' % atype] = processor.version
+
+    kwargs = dict((key, quote(str(value))) for key, value in params.items())
+    assessor.create(assessors=atype, **kwargs)
+
+
 class Task(object):
     """ Class Task to generate/manage the assessor with the cluster """
-    def __init__(self, processor, assessor, upload_dir):
+    def __init__(self, processor, assessor, upload_dir, createdate=None):
         """
         Init of class Task
 
         :param processor: processor used
         :param assessor: assessor dict ?
         :param upload_dir: upload directory to copy data after job finished.
+        :param createdate: date the assessor was created if already listed
+         (see XnatUtils.list_project_assessors)
         :return: None
 
         """
@@ -128,24 +163,11 @@ class Task(object):
         self.assessor = assessor
         self.upload_dir = upload_dir
         self.atype = processor.xsitype.lower()
+        self.createdate = createdate
 
         # Create assessor if needed
         if not assessor.exists():
-            if self.atype == DEFAULT_FS_DATATYPE.lower():
-                kwargs = {'%s/fsversion' % DEFAULT_FS_DATATYPE.lower(): '0'}
-                assessor.create(assessors=DEFAULT_FS_DATATYPE.lower(),
-                                **kwargs)
-            else:
-                assessor.create(assessors=self.atype)
-
-            self.set_createdate_today()
-            atype = self.atype.lower()
-            if atype == DEFAULT_DATATYPE.lower():
-                assessor.attrs.mset(
-                    {'%s/proctype' % atype: self.get_processor_name(),
-                     '%s/procversion' % atype: self.get_processor_version()})
-
-            self.set_proc_and_qc_status(NEED_INPUTS, JOB_PENDING)
+            create_assessor(assessor, processor)
 
         # Cache for convenience
         self.assessor_id = assessor.id()
@@ -246,6 +268,9 @@ class Task(object):
             self.set_jobnode(jobinfo['jobnode'])
         else:
             self.set_jobnode('NotFound')
+        usage_history.record_usage(
+            self.assessor_label, self.get_processor_version(), COMPLETE,
+            jobinfo['mem_used'], jobinfo['walltime_used'], jobinfo['jobnode'])
 
     def get_memused(self):
         """
@@ -422,6 +447,11 @@ undo_processing...')
             pass
         elif old_status == JOB_RUNNING:
             new_status = self.check_running(jobid)
+            if new_status == JOB_FAILED:
+                # The next job of the assessor is not right sized
+                usage_history.record_usage(
+                    self.assessor_label, self.get_processor_version(),
+                    JOB_FAILED, None, None)
         elif old_status == READY_TO_UPLOAD:
             # TODO: let upload spider handle it???
             # self.check_date()
@@ -504,7 +534,9 @@ undo_processing...')
         pbs = PBS(pbsfile, outlog, cmds, self.processor.walltime_str,
                   self.processor.memreq_mb, self.processor.ppn,
                   self.processor.env, job_email,
-                  job_email_options, xnat_host)
+                  job_email_options, xnat_host,
+                  self.get_processor_name(), self.get_processor_version(),
+                  self.assessor_label)
         pbs.write()
         if writeonly:
             mes_format = """   filepath: {path}"""
@@ -904,6 +936,15 @@ class ClusterTask(Task):
                     self.set_jobnode('NotFound')
             return
 
+        # Usage recorded by the spider with the results
+        usage = resource_usage.get_xnat_usage(
+            os.path.join(self.upload_dir, self.assessor_label))
+        if usage:
+            self.set_memused(usage['memused'])
+            self.set_walltime(usage['walltimeused'])
+            self.set_jobnode(usage['jobnode'])
+            return
+
         # We can't get info from cluster if job too old
         if not cluster.is_traceable_date(jobstrdate):
             self.set_walltime('NotFound')
@@ -1544,7 +1585,10 @@ undo_processing...')
                         self.processor.env,
                         job_email,
                         job_email_options,
-                        xnat_host)
+                        xnat_host,
+                        self.get_processor_name(),
+                        self.get_processor_version(),
+                        self.assessor_label)
             LOGGER.info('writing:' + batch_file)
             batch.write()
 
@@ -0,0 +1,517 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" benchmark.py
+
+Offline benchmarks of dax against the fake XNAT of fake_xnat.py.
+
+A generated project (subjects, sessions, scans and assessors) is served by
+the fake XNAT with an optional latency per request. Each scenario runs in a
+new python process with HOME set to a work folder holding the dax settings
+(.dax_settings.ini, .daxnetrc), the processors and the settings YAML:
+    - list_sessions and list_project_assessors (XnatUtils),
+    - build: one new processor to create on all the sessions,
+    - update, then launch (job files written, nothing submitted),
+    - upload of assessors prepared in RESULTS_DIR.
+The scenarios run in this order on the same fake XNAT. For each one, the
+wall time, the peak memory (max RSS) of the process and the REST calls by
+method and XnatUtils URI template are compared to the baseline:
+    - more REST calls than the baseline is a regression,
+    - the time and the memory can exceed the baseline by a factor set with
+      DAX_BENCHMARK_TIME_FACTOR (default: 3, plus one second) and
+      DAX_BENCHMARK_MEMORY_FACTOR (default: 1.5).
+The time and the memory depend on the machine and the packages installed,
+so only this command compares them (test_benchmark.py checks the REST
+calls). The REST calls depend on the version of pyxnat: write the baseline
+again (--write-baseline) when the dependencies change. The versions of
+python, pyxnat and PyYAML used are saved with the baseline (the current one
+was written with pyxnat 1.6.4, which also needs pandas, and PyYAML 6.0.3).
+
+Usage:
+    python -m dax.tests.benchmark [--scale medium] [--latency 20]
+    python -m dax.tests.benchmark --scale small --write-baseline
+"""
+
+from __future__ import print_function
+
+from future import standard_library
+standard_library.install_aliases()
+
+import argparse
+from collections import OrderedDict
+import configparser
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from dax.tests.fake_xnat import FakeXnat, FakeXnatServer
+
+
+__copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
+PROJECT = 'BENCH'
+XNAT_USER = 'bench'
+XNAT_PASS = 'bench'
+# Size of the generated project
+SCALES = OrderedDict([
+    ('small', OrderedDict([('subjects', 4), ('sessions', 2), ('scans', 3),
+                           ('assessors', 3), ('uploads', 4)])),
+    ('medium', OrderedDict([('subjects', 50), ('sessions', 2), ('scans', 4),
+                            ('assessors', 5), ('uploads', 20)])),
+    ('large', OrderedDict([('subjects', 500), ('sessions', 2), ('scans', 6),
+                           ('assessors', 10), ('uploads', 100)]))])
+SCENARIOS = ['list_sessions', 'list_project_assessors', 'build', 'update',
+             'launch', 'upload']
+# Processors of the project: Proc0_v1 has assessors on all the sessions,
+# Bench_v1 is created by the build
+PROCESSORS = ['Proc0_v1', 'Bench_v1']
+UPLOAD_PROCTYPE = 'Upload_v1'
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'benchmark_baseline.json')
+TIME_FACTOR = float(os.environ.get('DAX_BENCHMARK_TIME_FACTOR', 3.0))
+MEMORY_FACTOR = float(os.environ.get('DAX_BENCHMARK_MEMORY_FACTOR', 1.5))
+# Seconds allowed on top of the time factor (start of the processes)
+TIME_MARGIN = 1.0
+RESULT_MARKER = 'DAX_BENCHMARK_RESULT:'
+# Key of the versions in the baseline file
+VERSIONS_KEY = 'versions'
+PROCESSOR_TEMPLATE = """---
+inputs:
+  default:
+    spider_path: {spider_path}
+    working_dir: {workdir}
+    nb_threads: 1
+  xnat:
+    scans:
+      - scan1:
+        types: T1
+        resources:
+          - resource: NIFTI
+            varname: t1
+command: python {{spider_path}} --t1 {{t1}} --working_dir {{working_dir}}
+attrs:
+  suffix:
+  xsitype: proc:genProcData
+  walltime: 01:00:00
+  memory: 1024
+  ppn: 1
+  type: session
+"""
+JOB_TEMPLATE = """#!/bin/bash
+#PBS -M ${job_email}
+#PBS -l nodes=1:ppn=${job_ppn}
+#PBS -l walltime=${job_walltime}
+#PBS -l mem=${job_memory}mb
+#PBS -o ${job_output_file}
+#PBS -j ${job_output_file_options}
+export XNAT_HOST=${xnat_host}
+${job_cmds}
+"""
+# Cluster settings and command templates answering without a scheduler
+CLUSTER_SETTINGS = {'cmd_submit': 'true',
+                    'queue_status': 'Q',
+                    'running_status': 'R',
+                    'complete_status': 'C'}
+CLUSTER_COMMANDS = {'cmd_count_nb_jobs': 'echo 0',
+                    'cmd_get_job_status': 'echo R',
+                    'cmd_get_job_memory': 'echo 1024',
+                    'cmd_get_job_walltime': 'echo 00:10:00',
+                    'cmd_get_job_node': 'echo node1'}
+
+
+def prepare_workdir(workdir, host, scale):
+    """
+    Write the dax settings, processors and upload folders of the benchmark.
+
+    :param workdir: folder used as HOME by the scenarios
+    :param host: URL of the fake XNAT
+    :param scale: dictionary of the size of the project
+    :return: path of the settings YAML
+    """
+    results_dir = os.path.join(workdir, 'RESULTS_XNAT_SPIDER')
+    for folder in ['spiders', 'processors', 'templates', 'jobs', 'pbs',
+                   results_dir]:
+        os.makedirs(os.path.join(workdir, folder))
+
+    # ~/.dax_settings.ini from the default one
+    config = configparser.RawConfigParser(allow_no_value=True)
+    config.read(os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'dax_settings.ini'))
+    config.set('admin', 'user_home', workdir)
+    for key, value in list(CLUSTER_SETTINGS.items()):
+        config.set('cluster', key, value)
+    for key, cmd in list(CLUSTER_COMMANDS.items()):
+        cmd_path = os.path.join(workdir, 'templates', '%s.txt' % key)
+        with open(cmd_path, 'w') as f_obj:
+            f_obj.write(cmd)
+        config.set('cluster', key, cmd_path)
+    config.set('cluster', 'job_template',
+               os.path.join(workdir, 'job_template.txt'))
+    config.set('cluster', 'root_job_dir', os.path.join(workdir, 'jobs'))
+    config.set('cluster', 'results_dir', results_dir)
+    config.set('cluster', 'usage_db', os.path.join(workdir, 'usage.db'))
+    with open(os.path.join(workdir, '.dax_settings.ini'), 'w') as f_obj:
+        config.write(f_obj)
+    with open(os.path.join(workdir, 'job_template.txt'), 'w') as f_obj:
+        f_obj.write(JOB_TEMPLATE)
+    netrc_path = os.path.join(workdir, '.daxnetrc')
+    with open(netrc_path, 'w') as f_obj:
+        f_obj.write('machine %s\n    login %s\n    password %s\n'
+                    % (host, XNAT_USER, XNAT_PASS))
+    os.chmod(netrc_path, 0o600)
+
+    # processors and settings
+    yamlprocs = list()
+    for proctype in PROCESSORS:
+        name, version = proctype.rsplit('_v', 1)
+        spider_path = os.path.join(workdir, 'spiders', 'Spider_%s_v%s_0_0.py'
+                                   % (name, version))
+        with open(spider_path, 'w') as f_obj:
+            f_obj.write('# benchmark spider\n')
+        yaml_path = os.path.join(workdir, 'processors', '%s.yaml' % proctype)
+        with open(yaml_path, 'w') as f_obj:
+            f_obj.write(PROCESSOR_TEMPLATE.format(spider_path=spider_path,
+                                                  workdir=workdir))
+        yamlprocs.append({'name': proctype, 'filepath': yaml_path})
+    settings = OrderedDict([
+        ('attrs', {'xnat_host': host, 'xnat_user': XNAT_USER,
+                   'xnat_pass': XNAT_PASS, 'queue_limit': 10000,
+                   'root_job_dir': os.path.join(workdir, 'jobs')}),
+        ('yamlprocessors', yamlprocs),
+        ('projects', [{'project': PROJECT,
+                       'yamlprocessors': ','.join(PROCESSORS)}])])
+    settings_path = os.path.join(workdir, 'settings.yaml')
+    with open(settings_path, 'w') as f_obj:
+        # JSON is valid YAML
+        json.dump(settings, f_obj, indent=2)
+
+    # assessors ready to upload: one per session
+    uploads = 0
+    for subj_nb in range(scale['subjects']):
+        subject = '%s_S%04d' % (PROJECT, subj_nb + 1)
+        for sess_nb in range(scale['sessions']):
+            if uploads >= scale['uploads']:
+                return settings_path
+            session = '%s_E%d' % (subject, sess_nb + 1)
+            label = '-x-'.join([PROJECT, subject, session, UPLOAD_PROCTYPE])
+            write_assessor_folder(os.path.join(results_dir, label))
+            uploads += 1
+    return settings_path
+
+
+def write_assessor_folder(assessor_path):
+    """Write the folder of an assessor finished by its spider."""
+    for resource, files in [('STATS', ['stats.txt']),
+                            ('DATA', ['data1.txt', 'data2.txt'])]:
+        os.makedirs(os.path.join(assessor_path, resource))
+        for fname in files:
+            with open(os.path.join(assessor_path, resource, fname),
+                      'w') as f_obj:
+                f_obj.write('benchmark\n' * 100)
+    with open(os.path.join(assessor_path, 'version.txt'), 'w') as f_obj:
+        f_obj.write('1.0.0\n')
+    open(os.path.join(assessor_path, 'READY_TO_UPLOAD.txt'), 'w').close()
+
+
+def check_dependencies(host):
+    """
+    Check that the installed pyxnat and PyYAML can be used by dax.
+
+    :param host: URL of the fake XNAT running
+    :return: error message, None if the benchmarks can run
+    """
+    from dax import XnatUtils
+
+    tmp_dir = tempfile.mkdtemp(prefix='dax_benchmark_')
+    try:
+        with XnatUtils.get_interface(host, XNAT_USER, XNAT_PASS):
+            pass
+        yaml_path = os.path.join(tmp_dir, 'check.yaml')
+        with open(yaml_path, 'w') as f_obj:
+            f_obj.write('check: true\n')
+        XnatUtils.read_yaml(yaml_path)
+    except (ImportError, TypeError) as err:
+        return '%s: %s' % (err.__class__.__name__, err)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return None
+
+
+def run_scenario(scenario, workdir, host):
+    """
+    Run a scenario in this process (HOME must be the work folder).
+
+    :param scenario: name of the scenario
+    :param workdir: work folder of the benchmark
+    :param host: URL of the fake XNAT
+    :return: None
+    """
+    from dax import bin, dax_tools_utils, XnatUtils
+
+    settings_path = os.path.join(workdir, 'settings.yaml')
+    logfile = os.path.join(workdir, '%s.log' % scenario)
+    if scenario == 'list_sessions':
+        with XnatUtils.get_interface(host, XNAT_USER, XNAT_PASS) as intf:
+            XnatUtils.list_sessions(intf, PROJECT)
+    elif scenario == 'list_project_assessors':
+        with XnatUtils.get_interface(host, XNAT_USER, XNAT_PASS) as intf:
+            XnatUtils.list_project_assessors(intf, PROJECT)
+    elif scenario == 'build':
+        bin.build(settings_path, logfile, False)
+    elif scenario == 'update':
+        bin.update_tasks(settings_path, logfile, False)
+    elif scenario == 'launch':
+        bin.launch_jobs(settings_path, logfile, False,
+                        writeonly=True, pbsdir=os.path.join(workdir, 'pbs'))
+    elif scenario == 'upload':
+        dax_tools_utils.upload_tasks(logfile, False, host=host,
+                                     username=XNAT_USER, password=XNAT_PASS,
+                                     projects=PROJECT)
+    else:
+        raise ValueError('unknown scenario: %s' % scenario)
+
+
+def run_child(scenario, workdir, host):
+    """Run a scenario and print its time and memory (child process)."""
+    import resource
+
+    start = time.time()
+    run_scenario(scenario, workdir, host)
+    duration = time.time() - start
+    # KB on Linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss /= 1024.0
+    result = json.dumps({'time': duration, 'memory_mb': maxrss / 1024.0})
+    sys.stdout.write('\n%s%s\n' % (RESULT_MARKER, result))
+
+
+def time_scenario(server, scenario, workdir):
+    """
+    Run a scenario in a new process.
+
+    :param server: FakeXnatServer running
+    :param scenario: name of the scenario
+    :param workdir: work folder of the benchmark (HOME of the process)
+    :return: dictionary with the time, memory and REST calls
+    """
+    env = dict(os.environ, HOME=workdir, XNAT_HOST=server.host)
+    cmd = [sys.executable, '-m', 'dax.tests.benchmark', '--child', scenario,
+           '--workdir', workdir, '--host', server.host]
+    server.reset_counts()
+    proc = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    output = proc.communicate()[0].decode('utf-8', 'replace')
+    counts, errors = server.reset_counts()
+    if proc.returncode != 0 or RESULT_MARKER not in output:
+        raise RuntimeError('benchmark %s failed:\n%s' % (scenario, output))
+    result = json.loads(output.rsplit(RESULT_MARKER, 1)[1].strip())
+    result['rest_calls'] = sum(counts.values())
+    result['rest_errors'] = errors
+    result['rest'] = counts
+    return result
+
+
+def run_benchmarks(scale, latency=0.0, scenarios=None, workdir=None):
+    """
+    Run the scenarios against a fake XNAT.
+
+    :param scale: dictionary of the size of the project (see SCALES)
+    :param latency: seconds added to every REST call
+    :param scenarios: names of the scenarios (default: all, in order)
+    :param workdir: work folder kept after the run (default: temporary)
+    :return: OrderedDict {scenario: result}
+    """
+    xnat = FakeXnat()
+    xnat.generate_project(PROJECT, scale['subjects'], scale['sessions'],
+                          scale['scans'], scale['assessors'])
+    server = FakeXnatServer(xnat, latency).start()
+    tmp_dir = None
+    if workdir is None:
+        workdir = tmp_dir = tempfile.mkdtemp(prefix='dax_benchmark_')
+    try:
+        prepare_workdir(workdir, server.host, scale)
+        results = OrderedDict()
+        for scenario in scenarios or SCENARIOS:
+            results[scenario] = time_scenario(server, scenario, workdir)
+        return results
+    finally:
+        server.stop()
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def check_regressions(results, baseline, resources=True):
+    """
+    Compare the results to the baseline.
+
+    :param results: results of run_benchmarks
+    :param baseline: results of the baseline {scenario: result}
+    :param resources: also compare the time and memory (they depend on the
+                      machine and the packages installed)
+    :return: list of the regressions (strings)
+    """
+    regressions = list()
+    for scenario, result in list(results.items()):
+        base = baseline.get(scenario)
+        if base is None:
+            continue
+        if result['rest_calls'] > base['rest_calls']:
+            calls = ['%s: %s (baseline %s)' % (uri, count,
+                                               base['rest'].get(uri, 0))
+                     for uri, count in list(result['rest'].items())
+                     if count > base['rest'].get(uri, 0)]
+            regressions.append('%s: %s REST calls instead of %s [%s]' % (
+                scenario, result['rest_calls'], base['rest_calls'],
+                ', '.join(calls)))
+        if result['rest_errors'] > base['rest_errors']:
+            regressions.append('%s: %s REST errors instead of %s' % (
+                scenario, result['rest_errors'], base['rest_errors']))
+        if not resources:
+            continue
+        if result['time'] > base['time'] * TIME_FACTOR + TIME_MARGIN:
+            regressions.append('%s: %.2fs instead of %.2fs (x%s allowed)' % (
+                scenario, result['time'], base['time'], TIME_FACTOR))
+        if result['memory_mb'] > base['memory_mb'] * MEMORY_FACTOR:
+            regressions.append('%s: %.1fMB instead of %.1fMB (x%s allowed)'
+                               % (scenario, result['memory_mb'],
+                                  base['memory_mb'], MEMORY_FACTOR))
+    return regressions
+
+
+def load_baseline(scale_name, latency, path=BASELINE_FILE):
+    """
+    Load the baseline of a scale.
+
+    :param scale_name: name of the scale (see SCALES)
+    :param latency: seconds added to every REST call
+    :param path: baseline file
+    :return: dictionary {scenario: result}, empty if none
+    """
+    if not os.path.isfile(path):
+        return dict()
+    with open(path, 'r') as f_obj:
+        baselines = json.load(f_obj)
+    return baselines.get(get_baseline_key(scale_name, latency), dict())
+
+
+def save_baseline(scale_name, latency, results, path=BASELINE_FILE):
+    """Save the results as the baseline of a scale."""
+    baselines = OrderedDict()
+    if os.path.isfile(path):
+        with open(path, 'r') as f_obj:
+            baselines = json.load(f_obj, object_pairs_hook=OrderedDict)
+    baselines[VERSIONS_KEY] = get_versions()
+    baselines[get_baseline_key(scale_name, latency)] = OrderedDict(
+        (scenario, OrderedDict([
+            ('time', round(result['time'], 3)),
+            ('memory_mb', round(result['memory_mb'], 1)),
+            ('rest_calls', result['rest_calls']),
+            ('rest_errors', result['rest_errors']),
+            ('rest', result['rest'])]))
+        for scenario, result in list(results.items()))
+    with open(path, 'w') as f_obj:
+        json.dump(baselines, f_obj, indent=2)
+        f_obj.write('\n')
+
+
+def get_versions():
+    """Versions of python and of the dependencies changing the results."""
+    import pyxnat
+    import yaml
+
+    return OrderedDict([('python', '%d.%d.%d' % sys.version_info[:3]),
+                        ('pyxnat', pyxnat.__version__),
+                        ('PyYAML', yaml.__version__)])
+
+
+def load_versions(path=BASELINE_FILE):
+    """Versions saved with the baseline, empty if none."""
+    if not os.path.isfile(path):
+        return dict()
+    with open(path, 'r') as f_obj:
+        return json.load(f_obj).get(VERSIONS_KEY, dict())
+
+
+def get_baseline_key(scale_name, latency):
+    """Key of the baseline of a scale and latency."""
+    return '%s-%sms' % (scale_name, int(round(latency * 1000)))
+
+
+def print_results(results):
+    """Print a table of the results."""
+    print('%-24s %10s %10s %6s %6s' % ('scenario', 'time (s)', 'memory',
+                                       'REST', 'errors'))
+    for scenario, result in list(results.items()):
+        print('%-24s %10.2f %8.1fMB %6d %6d' % (
+            scenario, result['time'], result['memory_mb'],
+            result['rest_calls'], result['rest_errors']))
+
+
+def parse_args():
+    """Arguments of the benchmark."""
+    parser = argparse.ArgumentParser(description='Offline benchmarks of dax \
+against a fake XNAT.')
+    parser.add_argument('--scale', choices=list(SCALES.keys()),
+                        default='small', help='Size of the project.')
+    for key in SCALES['small']:
+        parser.add_argument('--%s' % key, type=int, default=None,
+                            help='Override the number of %s.' % key)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Milliseconds added to every REST call.')
+    parser.add_argument('--scenarios', default=None,
+                        help='Scenarios to run (comma separated): %s.'
+                        % ','.join(SCENARIOS))
+    parser.add_argument('--workdir', default=None,
+                        help='Work folder kept after the run.')
+    parser.add_argument('--write-baseline', dest='write_baseline',
+                        action='store_true',
+                        help='Save the results as the baseline.')
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--host', default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.child:
+        run_child(args.child, args.workdir, args.host)
+        return 0
+
+    scale = OrderedDict(SCALES[args.scale])
+    scale_name = args.scale
+    for key in scale:
+        if getattr(args, key) is not None:
+            scale[key] = getattr(args, key)
+            scale_name = 'custom'
+    latency = args.latency / 1000.0
+    scenarios = args.scenarios.split(',') if args.scenarios else None
+    if args.workdir:
+        os.makedirs(args.workdir)
+    print('Project: %s - latency: %sms' % (
+        ', '.join('%s=%s' % item for item in list(scale.items())),
+        args.latency))
+    results = run_benchmarks(scale, latency, scenarios, args.workdir)
+    print_results(results)
+    if args.write_baseline:
+        save_baseline(scale_name, latency, results)
+        print('Baseline written to %s' % BASELINE_FILE)
+        return 0
+    versions = get_versions()
+    baseline_versions = load_versions()
+    if baseline_versions and baseline_versions != versions:
+        print('Warning: baseline written with %s, running with %s' % (
+            ', '.join('%s %s' % item for item in baseline_versions.items()),
+            ', '.join('%s %s' % item for item in versions.items())))
+    regressions = check_regressions(results,
+                                    load_baseline(scale_name, latency))
+    for regression in regressions:
+        print('REGRESSION %s' % regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
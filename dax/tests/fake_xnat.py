@@ -0,0 +1,762 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" fake_xnat.py
+
+Stand-in XNAT REST server for the offline benchmarks (see benchmark.py).
+
+The server keeps generated projects in memory and answers the URIs used by
+XnatUtils and pyxnat under /data and /REST:
+    - listings (projects, subjects, experiments, scans, assessors, resources,
+      files, archive/experiments) in CSV with the columns, the xsiType,
+      project and ID filters and one row per scan/resource like XNAT,
+    - session XML (CachedImageSession),
+    - PUT/POST/DELETE of the subjects, sessions, assessors, resources and files
+      (the content of the files is not kept, only their size).
+Every request is counted by method and XnatUtils URI template and can be
+delayed to simulate the latency of a real XNAT.
+"""
+
+from future import standard_library
+standard_library.install_aliases()
+from builtins import object
+from builtins import str
+
+from collections import OrderedDict
+import csv
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import io
+import itertools
+import re
+from socketserver import ThreadingMixIn
+import threading
+import time
+from urllib.parse import parse_qsl, unquote, urlsplit
+from xml.sax.saxutils import quoteattr, escape
+
+from dax import profiling
+
+
+__copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
+SESSION_TYPE = 'xnat:mrSessionData'
+SCAN_TYPE = 'xnat:mrScanData'
+ASSESSOR_TYPE = 'proc:genProcData'
+DATATYPES = ['xnat:projectData', 'xnat:subjectData', SESSION_TYPE,
+             SCAN_TYPE, ASSESSOR_TYPE]
+# Statuses of the generated assessors (cycled)
+ASSESSOR_STATUSES = ['COMPLETE', 'COMPLETE', 'NEED_TO_RUN', 'JOB_RUNNING',
+                     'READY_TO_COMPLETE', 'JOB_FAILED', 'NEED_INPUTS']
+SCAN_TYPES = ['T1', 'fMRI', 'DTI', 'FLAIR']
+GENERATED_DATE = '2020-01-01'
+GENERATED_MODIFIED = '2020-01-01 00:00:00.0'
+NAMESPACES = ' '.join([
+    'xmlns:xnat="http://nrg.wustl.edu/xnat"',
+    'xmlns:proc="http://nrg.wustl.edu/proc"',
+    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"'])
+# Query parameters that are not filters or attributes
+RESERVED_PARAMS = ['format', 'columns', 'xsiType', 'project', 'ID',
+                   'removeFiles', 'allowDataDeletion', 'overwrite',
+                   'extract', 'content', 'tags', 'inbody', 'event_reason',
+                   'event_type', 'event_action']
+# Child collections of each kind of object
+COLLECTIONS = {'root': ['projects'],
+               'project': ['subjects', 'resources'],
+               'subject': ['experiments', 'resources'],
+               'session': ['scans', 'assessors', 'resources'],
+               'scan': ['resources'],
+               'assessor': ['resources'],
+               'resource': ['files']}
+CHILD_KINDS = {'projects': 'project', 'subjects': 'subject',
+               'experiments': 'session', 'scans': 'scan',
+               'assessors': 'assessor', 'resources': 'resource',
+               'files': 'file'}
+PREFIX_RE = re.compile(r'^/(data|REST)(/|$)')
+
+
+class FakeObject(object):
+    """ Object of the fake XNAT (project, subject, session, ...) """
+    def __init__(self, kind, obj_id, label, xsitype=None, parent=None):
+        """
+        Entry point for the FakeObject class.
+
+        :param kind: project, subject, session, scan, assessor, resource or
+                     file
+        :param obj_id: XNAT ID
+        :param label: label (name of the file for a file)
+        :param xsitype: datatype
+        :param parent: parent FakeObject
+        :return: None
+        """
+        self.kind = kind
+        self.id = obj_id
+        self.label = label
+        self.xsitype = xsitype
+        self.parent = parent
+        # field path (lower case, without the datatype) -> value
+        self.fields = dict()
+        # collection -> OrderedDict {label: FakeObject}
+        self.children = dict((name, OrderedDict())
+                             for name in COLLECTIONS.get(kind, list()))
+        self.size = 0
+
+    def get_ancestor(self, kind):
+        """Ancestor of a kind (or the object itself)."""
+        obj = self
+        while obj is not None and obj.kind != kind:
+            obj = obj.parent
+        return obj
+
+    def get_uri(self):
+        """URI of the object under /data."""
+        if self.kind == 'project':
+            return '/data/projects/%s' % self.label
+        if self.kind == 'file':
+            return '%s/files/%s' % (self.parent.get_uri(), self.label)
+        if self.kind == 'session':
+            return '/data/experiments/%s' % self.id
+        if self.kind == 'assessor':
+            return '%s/assessors/%s' % (self.parent.get_uri(), self.id)
+        collection = [name for name, kind in list(CHILD_KINDS.items())
+                      if kind == self.kind][0]
+        if self.parent.kind == 'assessor':
+            collection = 'out/' + collection
+        return '%s/%s/%s' % (self.parent.get_uri(), collection, self.id)
+
+    def get_field(self, path):
+        """
+        Value of a field.
+
+        :param path: field path in lower case without the datatype (e.g:
+                     procstatus, meta/last_modified)
+        :return: string
+        """
+        project = self.get_ancestor('project')
+        subject = self.get_ancestor('subject')
+        session = self.get_ancestor('session')
+        values = {'id': self.id, 'label': self.label, 'uri': self.get_uri(),
+                  'xsitype': self.xsitype or '',
+                  'project': project.label if project else '',
+                  'subject_id': subject.id if subject else '',
+                  'subject_label': subject.label if subject else '',
+                  'session_id': session.id if session else '',
+                  'session_label': session.label if session else ''}
+        if self.kind == 'resource':
+            values.update({'xnat_abstractresource_id': self.id,
+                           'file_count': str(len(self.children['files'])),
+                           'file_size': str(sum(
+                               fobj.size for fobj in
+                               list(self.children['files'].values())))})
+        elif self.kind == 'file':
+            values.update({'path': self.label, 'name': self.label,
+                           'size': str(self.size)})
+        if path in self.fields:
+            return self.fields[path]
+        return values.get(path, '')
+
+    def get_child(self, collection, key):
+        """Child of a collection by label or ID."""
+        children = self.children.get(collection)
+        if children is None:
+            return None
+        if key in children:
+            return children[key]
+        for child in list(children.values()):
+            if child.id == key:
+                return child
+        return None
+
+    def get_out_labels(self):
+        """Labels of the resources of the object."""
+        return list(self.children.get('resources', dict()).keys())
+
+
+def get_datatype(xsitype):
+    """Datatype with the case used by XNAT (e.g: proc:genProcData)."""
+    for datatype in DATATYPES:
+        if xsitype and xsitype.lower() == datatype.lower():
+            return datatype
+    return xsitype
+
+
+def get_header(column):
+    """Header returned by XNAT for a column (xpath in lower case)."""
+    return column.lower() if ':' in column else column
+
+
+class FakeXnat(object):
+    """ In-memory XNAT database """
+    def __init__(self):
+        """
+        Entry point for the FakeXnat class.
+
+        :return: None
+        """
+        self.root = FakeObject('root', None, None)
+        self.lock = threading.RLock()
+        self.counters = dict((kind, itertools.count(1))
+                             for kind in CHILD_KINDS.values())
+
+    def new_id(self, kind):
+        """Generate the ID of a new object."""
+        if kind == 'assessor':
+            # sessions and assessors are both experiments
+            kind = 'session'
+        number = next(self.counters[kind])
+        if kind == 'subject':
+            return 'FAKE_S%05d' % number
+        if kind == 'session':
+            return 'FAKE_E%05d' % number
+        return str(number)
+
+    def add(self, parent, kind, label, xsitype=None, obj_id=None, **fields):
+        """
+        Add an object.
+
+        :param parent: parent FakeObject
+        :param kind: kind of the new object
+        :param label: label of the new object
+        :param xsitype: datatype
+        :param obj_id: ID (generated if None)
+        :param fields: fields of the object (path without the datatype)
+        :return: FakeObject
+        """
+        collection = [name for name in COLLECTIONS[parent.kind]
+                      if CHILD_KINDS[name] == kind][0]
+        if obj_id is None:
+            obj_id = label if kind in ['project', 'scan', 'file'] \
+                else self.new_id(kind)
+        obj = FakeObject(kind, obj_id, label, xsitype, parent)
+        obj.fields.update(fields)
+        parent.children[collection][label] = obj
+        return obj
+
+    def generate_project(self, project, subjects=10, sessions=2, scans=4,
+                         assessors=3):
+        """
+        Generate a project.
+
+        The first scan of each session is a T1 with a NIFTI resource. The
+        assessors of a session have the proctypes Proc0_v1, Proc1_v1, ...
+        with the statuses cycling through ASSESSOR_STATUSES.
+
+        :param project: project ID
+        :param subjects: number of subjects
+        :param sessions: number of sessions per subject
+        :param scans: number of scans per session
+        :param assessors: number of assessors per session
+        :return: FakeObject of the project
+        """
+        with self.lock:
+            proj_obj = self.add(self.root, 'project', project,
+                                'xnat:projectData')
+            statuses = itertools.cycle(ASSESSOR_STATUSES)
+            for subj_nb in range(subjects):
+                subj_label = '%s_S%04d' % (project, subj_nb + 1)
+                subj_obj = self.add(
+                    proj_obj, 'subject', subj_label, 'xnat:subjectData',
+                    last_modified=GENERATED_MODIFIED, gender='female',
+                    handedness='right', yob='1980')
+                for sess_nb in range(sessions):
+                    sess_obj = self.add(
+                        subj_obj, 'session',
+                        '%s_E%d' % (subj_label, sess_nb + 1), SESSION_TYPE,
+                        date=GENERATED_DATE, modality='MR', age='40',
+                        **{'meta/last_modified': GENERATED_MODIFIED})
+                    self.generate_scans(sess_obj, scans)
+                    for assr_nb in range(assessors):
+                        self.generate_assessor(
+                            sess_obj, 'Proc%d_v1' % assr_nb, next(statuses))
+            return proj_obj
+
+    def generate_scans(self, sess_obj, scans):
+        """Generate the scans of a session."""
+        for scan_nb in range(scans):
+            scan_type = SCAN_TYPES[scan_nb % len(SCAN_TYPES)]
+            scan_obj = self.add(
+                sess_obj, 'scan', str(scan_nb + 1), SCAN_TYPE, type=scan_type,
+                quality='usable', series_description=scan_type, frames='176',
+                note='')
+            for resource in ['NIFTI', 'DICOM']:
+                res_obj = self.add(scan_obj, 'resource', resource,
+                                   format=resource)
+                file_obj = self.add(res_obj, 'file', '%s.dat' % resource)
+                file_obj.size = 1024
+
+    def generate_assessor(self, sess_obj, proctype, procstatus):
+        """Generate an assessor of a session."""
+        project = sess_obj.get_ancestor('project').label
+        subject = sess_obj.get_ancestor('subject').label
+        label = '-x-'.join([project, subject, sess_obj.label, proctype])
+        qcstatus = 'Passed' if procstatus == 'COMPLETE' else 'Job Pending'
+        fields = {'procstatus': procstatus, 'proctype': proctype,
+                  'procversion': '1.0.0', 'validation/status': qcstatus,
+                  'date': GENERATED_DATE, 'jobstartdate': GENERATED_DATE,
+                  'jobid': '', 'jobnode': '', 'memused': '',
+                  'walltimeused': ''}
+        if procstatus in ['JOB_RUNNING', 'READY_TO_COMPLETE', 'COMPLETE',
+                          'JOB_FAILED']:
+            fields.update({'jobid': str(1000 + len(label)),
+                           'jobnode': 'node1', 'memused': '1024',
+                           'walltimeused': '00:10:00'})
+        assr_obj = self.add(sess_obj, 'assessor', label, ASSESSOR_TYPE,
+                            **fields)
+        if procstatus == 'COMPLETE':
+            res_obj = self.add(assr_obj, 'resource', 'PDF')
+            self.add(res_obj, 'file', 'report.pdf').size = 2048
+        return assr_obj
+
+    def resolve(self, parts):
+        """
+        Resolve the path of a request.
+
+        :param parts: segments of the path after /data or /REST
+        :return: tuple (parent FakeObject, collection, key, FakeObject):
+                 collection is None for an existing object, key None for a
+                 listing and the object None if it does not exist.
+                 None if an ancestor does not exist.
+        """
+        if parts[:1] == ['archive']:
+            parts = parts[1:]
+        obj = self.root
+        index = 0
+        while index < len(parts):
+            collection = parts[index]
+            if collection in ['out', 'in'] and obj.kind == 'assessor':
+                index += 1
+                continue
+            if collection == 'experiments' and obj.kind in ['root',
+                                                            'project']:
+                # sessions of all the subjects
+                if index + 1 == len(parts):
+                    return obj, collection, None, None
+                child = self.find_experiment(obj, parts[index + 1])
+            elif collection == 'files' and obj.kind == 'resource':
+                if index + 1 == len(parts):
+                    return obj, collection, None, None
+                key = unquote('/'.join(parts[index + 1:]))
+                return obj, collection, key, obj.get_child(collection, key)
+            elif collection not in obj.children and obj.kind != 'root':
+                return None
+            elif index + 1 == len(parts):
+                return obj, collection, None, None
+            else:
+                child = obj.get_child(collection, unquote(parts[index + 1]))
+            if child is None:
+                if index + 2 == len(parts):
+                    return obj, collection, unquote(parts[index + 1]), None
+                return None
+            obj = child
+            index += 2
+        return obj.parent, None, obj.label, obj
+
+    def find_experiment(self, obj, key):
+        """Find a session or assessor by ID or label under an object."""
+        for exp_obj in self.list_experiments(obj, assessors=True):
+            if key in [exp_obj.id, exp_obj.label]:
+                return exp_obj
+        return None
+
+    def list_experiments(self, obj, assessors=False):
+        """Sessions (and assessors) under the root or a project."""
+        projects = list(obj.children['projects'].values()) \
+            if obj.kind == 'root' else [obj]
+        for proj_obj in projects:
+            for subj_obj in list(proj_obj.children['subjects'].values()):
+                for sess_obj in list(subj_obj.children['experiments']
+                                     .values()):
+                    yield sess_obj
+                    if assessors:
+                        for assr_obj in list(sess_obj.children['assessors']
+                                             .values()):
+                            yield assr_obj
+
+    def list_collection(self, parent, collection, params):
+        """
+        Rows of a listing.
+
+        :param parent: FakeObject of the collection
+        :param collection: name of the collection
+        :param params: query parameters
+        :return: list of the headers, list of OrderedDict rows
+        """
+        if collection == 'experiments' and parent.kind in ['root',
+                                                           'project']:
+            xsitype = params.get('xsiType', '')
+            objs = list(self.list_experiments(
+                parent, assessors=parent.kind == 'root'))
+            if parent.kind == 'root' and 'project' in params:
+                objs = [obj for obj in objs if obj.get_field('project') ==
+                        params['project']]
+            elif parent.kind == 'root':
+                # shared projects (xnat:imagesessiondata/sharing/share/...)
+                objs = [obj for obj in objs
+                        if not [key for key in params if 'sharing' in key]]
+        else:
+            xsitype = ''
+            objs = list(parent.children[collection].values())
+        if xsitype:
+            xsitypes = [xtype.lower() for xtype in xsitype.split(',')]
+            if 'xnat:imagesessiondata' in xsitypes:
+                xsitypes.append(SESSION_TYPE.lower())
+            objs = [obj for obj in objs
+                    if (obj.xsitype or '').lower() in xsitypes]
+        if 'ID' in params:
+            ids = params['ID'].split(',')
+            objs = [obj for obj in objs if obj.id in ids]
+
+        columns = [col for col in params.get('columns', '').split(',') if col]
+        kind = CHILD_KINDS.get(collection, 'session')
+        default = {'project': ['ID', 'secondary_ID', 'name', 'URI'],
+                   'subject': ['ID', 'project', 'label', 'URI'],
+                   'session': ['ID', 'label', 'project', 'xsiType', 'URI',
+                               'subject_ID', 'subject_label', 'date',
+                               'session_ID', 'session_label'],
+                   'scan': ['ID', 'type', 'quality', 'series_description',
+                            'xsiType', 'URI'],
+                   'assessor': ['ID', 'label', 'project', 'xsiType', 'URI'],
+                   'resource': ['xnat_abstractresource_id', 'label',
+                                'format', 'file_count', 'file_size'],
+                   'file': ['Name', 'Size', 'URI', 'path']}[kind]
+        headers = list(default)
+        headers.extend(get_header(col) for col in columns
+                       if get_header(col) not in headers)
+        rows = list()
+        for obj in objs:
+            rows.extend(self.get_rows(obj, headers))
+        return headers, rows
+
+    def get_rows(self, obj, headers):
+        """
+        Rows of an object in a listing: one row per scan and per resource
+        when the columns include them.
+
+        :param obj: FakeObject
+        :param headers: headers of the listing
+        :return: list of OrderedDict
+        """
+        targets = [dict()]
+        if [col for col in headers if col.startswith('xnat:imagescandata/')
+                or col.startswith('xnat:imagesessiondata/scans/scan/')]:
+            targets = [{'scan': scan_obj} for scan_obj in
+                       list(obj.children.get('scans', dict()).values())]
+        if [col for col in headers if col.endswith('/file/label')]:
+            res_targets = list()
+            for target in targets:
+                labels = target.get('scan', obj).get_out_labels() or ['']
+                res_targets.extend(dict(target, resource=label)
+                                   for label in labels)
+            targets = res_targets
+
+        rows = list()
+        for target in targets:
+            row = OrderedDict()
+            for header in headers:
+                row[header] = self.get_value(obj, header, target)
+            rows.append(row)
+        return rows
+
+    def get_value(self, obj, header, target):
+        """Value of a column for an object."""
+        column = header.lower()
+        if column.endswith('/file/label'):
+            return target.get('resource', '')
+        if ':' not in column:
+            if column in ['name', 'size'] and obj.kind == 'file':
+                return obj.get_field(column)
+            if column == 'name' and obj.kind == 'project':
+                return obj.label
+            return obj.get_field(column)
+        datatype, path = column.split('/', 1)
+        if 'scan' in target and (datatype == 'xnat:imagescandata' or
+                                 path.startswith('scans/scan/')):
+            return target['scan'].get_field(path.replace('scans/scan/', ''))
+        if datatype == 'xnat:imagesessiondata' and obj.kind == 'assessor':
+            return obj.parent.get_field(path)
+        return obj.get_field(path)
+
+    def set_fields(self, obj, params):
+        """Set the fields of an object from the query parameters."""
+        for key, value in list(params.items()):
+            if key in RESERVED_PARAMS:
+                continue
+            path = key.lower().split('/', 1)[1] if '/' in key \
+                else key.lower()
+            obj.fields[path] = value
+
+    def put(self, parts, params, size):
+        """
+        Create or update an object.
+
+        :param parts: segments of the path
+        :param params: query parameters (attributes)
+        :param size: size of the body
+        :return: HTTP status
+        """
+        with self.lock:
+            resolved = self.resolve(parts)
+            if resolved is None:
+                return 404
+            parent, collection, key, obj = resolved
+            if collection == 'files' and key is None:
+                # zip uploaded in a resource
+                key = 'upload_%d.zip' % len(parent.children['files'])
+            elif key is None:
+                return 400
+            if obj is None:
+                kind = CHILD_KINDS[collection]
+                xsitype = get_datatype(params.get('xsiType'))
+                if kind == 'session' and parent.kind != 'subject':
+                    return 400
+                if kind == 'session' and xsitype and \
+                   xsitype.lower() == ASSESSOR_TYPE.lower():
+                    return 400
+                if kind == 'assessor' and not xsitype:
+                    xsitype = ASSESSOR_TYPE
+                obj = self.add(parent, kind, key, xsitype)
+            self.set_fields(obj, params)
+            if obj.kind == 'file':
+                obj.size = size
+            return 200
+
+    def delete(self, parts):
+        """Delete an object."""
+        with self.lock:
+            resolved = self.resolve(parts)
+            if resolved is None or resolved[3] is None:
+                return 404
+            parent, _, _, obj = resolved
+            for children in list(parent.children.values()):
+                if children.get(obj.label) is obj:
+                    del children[obj.label]
+            return 200
+
+    def get_session_xml(self, sess_obj):
+        """XML of a session (xnat:MRSession with its scans and assessors)."""
+        lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+                 '<xnat:MRSession %s ID=%s project=%s label=%s>' % (
+                     NAMESPACES, quoteattr(sess_obj.id),
+                     quoteattr(sess_obj.get_field('project')),
+                     quoteattr(sess_obj.label))]
+        lines.append('<xnat:date>%s</xnat:date>'
+                     % escape(sess_obj.get_field('date')))
+        lines.append('<xnat:subject_ID>%s</xnat:subject_ID>'
+                     % escape(sess_obj.get_field('subject_id')))
+        lines.append('<xnat:scans>')
+        for scan_obj in list(sess_obj.children['scans'].values()):
+            lines.append('<xnat:scan ID=%s type=%s xsi:type=%s>' % (
+                quoteattr(scan_obj.id), quoteattr(scan_obj.get_field('type')),
+                quoteattr(scan_obj.xsitype)))
+            for res_obj in list(scan_obj.children['resources'].values()):
+                lines.append(get_resource_xml(res_obj))
+            for field in ['quality', 'series_description', 'frames', 'note']:
+                lines.append('<xnat:%s>%s</xnat:%s>' % (
+                    field, escape(scan_obj.get_field(field)), field))
+            lines.append('</xnat:scan>')
+        lines.append('</xnat:scans>')
+        lines.append('<xnat:assessors>')
+        for assr_obj in list(sess_obj.children['assessors'].values()):
+            lines.append('<xnat:assessor ID=%s project=%s label=%s \
+xsi:type=%s>' % (quoteattr(assr_obj.id),
+                 quoteattr(assr_obj.get_field('project')),
+                 quoteattr(assr_obj.label), quoteattr(assr_obj.xsitype)))
+            lines.append('<xnat:validation status=%s/>' % quoteattr(
+                assr_obj.get_field('validation/status')))
+            lines.append('<xnat:out>')
+            for res_obj in list(assr_obj.children['resources'].values()):
+                lines.append(get_resource_xml(res_obj))
+            lines.append('</xnat:out>')
+            for field in ['procstatus', 'proctype', 'procversion', 'jobid',
+                          'jobstartdate', 'memused', 'walltimeused',
+                          'jobnode', 'date']:
+                lines.append('<proc:%s>%s</proc:%s>' % (
+                    field, escape(assr_obj.get_field(field)), field))
+            lines.append('</xnat:assessor>')
+        lines.append('</xnat:assessors>')
+        lines.append('</xnat:MRSession>')
+        return '\n'.join(lines)
+
+    def get_object_xml(self, obj):
+        """XML of an object."""
+        if obj.kind == 'session':
+            return self.get_session_xml(obj)
+        return '<?xml version="1.0" encoding="UTF-8"?>\n<xnat:%s %s ID=%s \
+label=%s/>' % (obj.kind, NAMESPACES, quoteattr(obj.id or ''),
+               quoteattr(obj.label or ''))
+
+
+def get_resource_xml(res_obj):
+    """XML element of a resource in the XML of its session."""
+    return '<xnat:file label=%s format=%s file_count=%s file_size=%s \
+xsi:type="xnat:resourceCatalog"/>' % tuple(
+        quoteattr(res_obj.get_field(field))
+        for field in ['label', 'format', 'file_count', 'file_size'])
+
+
+def to_csv(headers, rows):
+    """Format the rows of a listing in CSV."""
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator='\n')
+    writer.writerow(headers)
+    for row in rows:
+        writer.writerow([row[header] for header in headers])
+    return output.getvalue()
+
+
+class FakeXnatHandler(BaseHTTPRequestHandler):
+    """ Handler of the requests to the fake XNAT """
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately: no delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def get_request(self):
+        """Path segments and query parameters of the request."""
+        url = urlsplit(self.path)
+        path = PREFIX_RE.sub('/', url.path).strip('/')
+        parts = [part for part in path.split('/') if part]
+        params = dict(parse_qsl(url.query, keep_blank_values=True))
+        return parts, params
+
+    def read_body(self):
+        """Read the body of the request."""
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def send(self, status, body='', content_type='text/plain'):
+        """Send a response."""
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.status = status
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, method):
+        """Delay, dispatch and count a request."""
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.status = None
+        try:
+            self.dispatch(method)
+        except Exception as err:
+            if self.status is not None:
+                raise
+            self.send(500, 'error: %s' % err)
+        finally:
+            self.server.record(method, self.path, self.status or 500)
+
+    def dispatch(self, method):
+        """Answer a request."""
+        parts, params = self.get_request()
+        xnat = self.server.xnat
+        body = self.read_body()
+        if parts == ['JSESSION']:
+            return self.send(200, 'FAKESESSIONID')
+        if parts == ['search', 'elements']:
+            rows = [OrderedDict([('ELEMENT_NAME', datatype)])
+                    for datatype in DATATYPES]
+            return self.send(200, to_csv(['ELEMENT_NAME'], rows), 'text/csv')
+        if method in ['PUT', 'POST']:
+            return self.send(xnat.put(parts, params, len(body)))
+        if method == 'DELETE':
+            return self.send(xnat.delete(parts))
+        if method != 'GET':
+            return self.send(405, 'method not allowed')
+
+        with xnat.lock:
+            resolved = xnat.resolve(parts) if parts else None
+            if resolved is None:
+                return self.send(404, 'not found')
+            parent, collection, key, obj = resolved
+            if key is None:
+                headers, rows = xnat.list_collection(parent, collection,
+                                                     params)
+                return self.send(200, to_csv(headers, rows), 'text/csv')
+            if obj is None:
+                return self.send(404, 'not found')
+            if obj.kind == 'file':
+                return self.send(200, b'\0' * obj.size,
+                                 'application/octet-stream')
+            return self.send(200, xnat.get_object_xml(obj), 'text/xml')
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+
+class FakeXnatServer(ThreadingMixIn, HTTPServer):
+    """ HTTP server of the fake XNAT running in a thread """
+    daemon_threads = True
+
+    def __init__(self, xnat=None, latency=0.0, port=0):
+        """
+        Entry point for the FakeXnatServer class.
+
+        :param xnat: FakeXnat database (empty by default)
+        :param latency: seconds added to every request
+        :param port: port on 127.0.0.1 (0: any free port)
+        :return: None
+        """
+        HTTPServer.__init__(self, ('127.0.0.1', port), FakeXnatHandler)
+        self.xnat = xnat or FakeXnat()
+        self.latency = latency
+        self.counts_lock = threading.Lock()
+        # (method, URI template) -> number of requests
+        self.counts = OrderedDict()
+        # requests answered with an HTTP error
+        self.errors = 0
+        self.thread = None
+
+    @property
+    def host(self):
+        """URL of the server."""
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def record(self, method, path, status):
+        """Count a request by method and XnatUtils URI template."""
+        key = (method, profiling.get_uri_template(path))
+        with self.counts_lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+            if status >= 400:
+                self.errors += 1
+
+    def reset_counts(self):
+        """
+        Reset the counts of the requests.
+
+        :return: tuple (OrderedDict {'METHOD template': count}, number of
+                 errors) before the reset
+        """
+        with self.counts_lock:
+            counts = OrderedDict(('%s %s' % key, count)
+                                 for key, count in sorted(self.counts.items()))
+            errors = self.errors
+            self.counts = OrderedDict()
+            self.errors = 0
+        return counts, errors
+
+    def start(self):
+        """Serve in a daemon thread."""
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving."""
+        self.shutdown()
+        self.server_close()
+        if self.thread:
+            self.thread.join()
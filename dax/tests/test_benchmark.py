@@ -0,0 +1,51 @@
+""" Offline benchmark of dax against a fake XNAT (see benchmark.py).
+
+The scenarios run at the small scale and are compared to the baseline in
+benchmark_baseline.json: a scenario making more REST calls or errors than
+the baseline fails. The time and the memory depend on the machine, they are
+compared by python -m dax.tests.benchmark only. The tests are skipped if
+dax can not use the installed pyxnat (e.g: pyxnat 1.6 without pandas).
+"""
+
+from unittest import SkipTest, TestCase
+
+from dax.tests import benchmark
+from dax.tests.fake_xnat import FakeXnatServer
+
+
+class TestBenchmark(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        server = FakeXnatServer().start()
+        try:
+            error = benchmark.check_dependencies(server.host)
+        finally:
+            server.stop()
+        if error:
+            raise SkipTest('dax does not support the installed pyxnat or \
+PyYAML: %s' % error)
+        cls.results = benchmark.run_benchmarks(benchmark.SCALES['small'])
+        cls.baseline = benchmark.load_baseline('small', 0.0)
+
+    def check_scenario(self, scenario):
+        result = self.results[scenario]
+        self.assertEqual(benchmark.check_regressions(
+            {scenario: result}, self.baseline, resources=False), [])
+
+    def test_list_sessions(self):
+        self.check_scenario('list_sessions')
+
+    def test_list_project_assessors(self):
+        self.check_scenario('list_project_assessors')
+
+    def test_build(self):
+        self.check_scenario('build')
+
+    def test_update(self):
+        self.check_scenario('update')
+
+    def test_launch(self):
+        self.check_scenario('launch')
+
+    def test_upload(self):
+        self.check_scenario('upload')
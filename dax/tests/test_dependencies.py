@@ -0,0 +1,91 @@
+""" Tests of the dependency graph between processors (dependencies.py) """
+
+from unittest import TestCase
+
+from dax.dependencies import ProcessorGraph, get_assessor_inputs
+from dax.errors import DaxLauncherError
+
+
+class FakeProcessor(object):
+    """Processor with the YAML inputs of its assessors."""
+    def __init__(self, name, assessors=None):
+        self.name = name
+        self.xnat_inputs = {'assessors': assessors or list()}
+
+
+def get_assessor(proctype, procstatus, qcstatus='Needs QA',
+                 session='Sess1'):
+    """Assessor info as listed by XnatUtils."""
+    label = '-x-'.join(['Proj', 'Subj1', session, proctype])
+    return {'label': label, 'subject_label': 'Subj1',
+            'session_label': session, 'proctype': proctype,
+            'procstatus': procstatus, 'qcstatus': qcstatus}
+
+
+def get_processors():
+    """fMRIQA and dtiQA depend on FS, Connectome on both of them."""
+    return [
+        FakeProcessor('Connectome_v1', [
+            {'proctypes': 'fMRIQA_v1, dtiQA_v1', 'needs_qc': False}]),
+        FakeProcessor('fMRIQA_v1', [{'proctypes': 'FS_v1'}]),
+        FakeProcessor('dtiQA_v1', [
+            {'proctypes': 'FS_v1', 'needs_qc': False}]),
+        FakeProcessor('FS_v1')]
+
+
+class TestProcessorGraph(TestCase):
+    def test_assessor_inputs(self):
+        proc = FakeProcessor('Proc_v1', [
+            {'proctypes': 'A_v1, B_v1'}, {'proctypes': ''},
+            {'proctypes': 'C_v1', 'needs_qc': False}])
+        self.assertEqual(get_assessor_inputs(proc), [
+            {'proctypes': ['A_v1', 'B_v1'], 'needs_qc': True},
+            {'proctypes': ['C_v1'], 'needs_qc': False}])
+        self.assertEqual(get_assessor_inputs(object()), [])
+
+    def test_graph(self):
+        graph = ProcessorGraph(get_processors())
+        self.assertEqual(graph.order, ['FS_v1', 'dtiQA_v1', 'fMRIQA_v1',
+                                       'Connectome_v1'])
+        self.assertEqual(graph.get_upstream('Connectome_v1'),
+                         ['dtiQA_v1', 'fMRIQA_v1'])
+        self.assertEqual(graph.get_downstream('FS_v1'),
+                         ['dtiQA_v1', 'fMRIQA_v1'])
+        self.assertFalse(graph.has_upstream('FS_v1'))
+        self.assertTrue(graph.has_upstream('fMRIQA_v1'))
+        self.assertTrue(graph.needs_qc('fMRIQA_v1', 'FS_v1'))
+        self.assertFalse(graph.needs_qc('dtiQA_v1', 'FS_v1'))
+
+    def test_wildcard(self):
+        graph = ProcessorGraph([
+            FakeProcessor('Stats_v1', [{'proctypes': 'FS_v*'}]),
+            FakeProcessor('FS_v1'), FakeProcessor('FS_v2')])
+        self.assertEqual(graph.get_upstream('Stats_v1'), ['FS_v1', 'FS_v2'])
+
+    def test_self_reference(self):
+        graph = ProcessorGraph([
+            FakeProcessor('Long_v1', [{'proctypes': 'Long_v1'}])])
+        self.assertEqual(graph.order, ['Long_v1'])
+        self.assertFalse(graph.has_upstream('Long_v1'))
+
+    def test_cycle(self):
+        with self.assertRaises(DaxLauncherError):
+            ProcessorGraph([FakeProcessor('A_v1', [{'proctypes': 'B_v1'}]),
+                            FakeProcessor('B_v1', [{'proctypes': 'C_v1'}]),
+                            FakeProcessor('C_v1', [{'proctypes': 'A_v1'}])])
+
+    def test_sessions_ready(self):
+        graph = ProcessorGraph(get_processors())
+        assr_list = [
+            get_assessor('FS_v1', 'COMPLETE', 'Needs QA'),
+            get_assessor('fMRIQA_v1', 'NEED_INPUTS'),
+            get_assessor('dtiQA_v1', 'NEED_INPUTS'),
+            get_assessor('FS_v1', 'COMPLETE', 'Passed', 'Sess2'),
+            get_assessor('fMRIQA_v1', 'NEED_INPUTS', session='Sess2'),
+            get_assessor('FS_v1', 'COMPLETE', 'Failed', 'Sess3'),
+            get_assessor('fMRIQA_v1', 'NEED_INPUTS', session='Sess3'),
+            get_assessor('FS_v1', 'JOB_RUNNING', session='Sess4'),
+            get_assessor('fMRIQA_v1', 'NEED_INPUTS', session='Sess4')]
+        self.assertEqual(graph.get_sessions_ready(assr_list), {
+            ('Subj1', 'Sess1'): set(['dtiQA_v1']),
+            ('Subj1', 'Sess2'): set(['fMRIQA_v1'])})
@@ -0,0 +1,68 @@
+""" Import-time regression benchmark for dax.
+
+Each check runs in a fresh python process so that the modules already
+imported by the test runner do not hide a regression. The time limit can
+be changed with the environment variable DAX_IMPORT_TIME_LIMIT (seconds).
+"""
+
+import json
+import os
+import subprocess
+import sys
+from unittest import TestCase
+
+
+# Dependencies that must only be imported by the functions using them
+HEAVY_MODULES = ['matplotlib', 'nibabel', 'numpy', 'scipy', 'dicom', 'xlrd',
+                 'redcap']
+IMPORT_TIME_LIMIT = float(os.environ.get('DAX_IMPORT_TIME_LIMIT', 5.0))
+RESULT_MARKER = 'DAX_IMPORT_RESULT:'
+IMPORT_SCRIPT = """
+import json
+import sys
+import time
+start = time.time()
+{statement}
+duration = time.time() - start
+heavy = [mod for mod in {heavy!r} if mod in sys.modules]
+result = json.dumps({{'time': duration, 'heavy': heavy}})
+sys.stdout.write('\\n%s%s\\n' % ({marker!r}, result))
+"""
+
+
+def time_import(statement):
+    """Run the import statement in a new process.
+
+    :param statement: python import statement
+    :return: dictionary with the import time and heavy modules imported
+    """
+    script = IMPORT_SCRIPT.format(statement=statement, heavy=HEAVY_MODULES,
+                                  marker=RESULT_MARKER)
+    with open(os.devnull, 'w') as devnull:
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         stderr=devnull)
+    result = output.decode().rsplit(RESULT_MARKER, 1)[1]
+    return json.loads(result.strip())
+
+
+class TestImportTime(TestCase):
+    def check_import(self, statement):
+        result = time_import(statement)
+        print('%s: %.3fs' % (statement, result['time']))
+        self.assertEqual(result['heavy'], [])
+        self.assertLess(result['time'], IMPORT_TIME_LIMIT)
+
+    def test_import_dax(self):
+        self.check_import('import dax')
+
+    def test_import_settings(self):
+        self.check_import('from dax import DAX_Settings')
+
+    def test_import_tools(self):
+        self.check_import('from dax import dax_tools_utils')
+
+    def test_import_spiders(self):
+        self.check_import('from dax import spiders, XnatUtils')
+
+    def test_submodule_attribute(self):
+        self.check_import('import dax; dax.processors')
@@ -0,0 +1,113 @@
+""" Tests of the order of the launches (scheduler.py) """
+
+from datetime import datetime
+from unittest import TestCase
+
+from dax.scheduler import LaunchScheduler, get_age_days
+
+
+def get_tasks(project, proctype, number, age=0.0):
+    """Tuples (task, project, proctype, age) as given by launch_tasks."""
+    return [('%s-%s-%d' % (project, proctype, index), project, proctype, age)
+            for index in range(number)]
+
+
+def get_order(scheduler, tasks, running=None, limit=None):
+    """Names of the tasks in the order of the scheduler."""
+    order = list()
+    for task_name, _ in scheduler.order(tasks, running):
+        order.append(task_name)
+        if limit is not None and len(order) == limit:
+            break
+    return order
+
+
+def count_projects(order):
+    """Number of tasks by project in an order."""
+    counts = dict()
+    for task_name in order:
+        project = task_name.split('-')[0]
+        counts[project] = counts.get(project, 0) + 1
+    return counts
+
+
+class TestLaunchScheduler(TestCase):
+    def test_fair_share(self):
+        scheduler = LaunchScheduler()
+        tasks = get_tasks('A', 'proc', 10) + get_tasks('B', 'proc', 10)
+        order = get_order(scheduler, tasks, limit=6)
+        self.assertEqual(count_projects(order), {'A': 3, 'B': 3})
+
+    def test_fair_share_weights(self):
+        scheduler = LaunchScheduler(project_weights={'A': 3})
+        tasks = get_tasks('A', 'proc', 20) + get_tasks('B', 'proc', 20)
+        order = get_order(scheduler, tasks, limit=8)
+        self.assertEqual(count_projects(order), {'A': 6, 'B': 2})
+
+    def test_fair_share_running(self):
+        scheduler = LaunchScheduler()
+        tasks = get_tasks('A', 'proc', 10) + get_tasks('B', 'proc', 10)
+        order = get_order(scheduler, tasks, running={('A', 'proc'): 4},
+                          limit=6)
+        self.assertEqual(count_projects(order), {'A': 1, 'B': 5})
+
+    def test_project_limit(self):
+        scheduler = LaunchScheduler(project_limits={'A': 3})
+        tasks = get_tasks('A', 'proc', 10) + get_tasks('B', 'proc', 2)
+        order = get_order(scheduler, tasks, running={('A', 'proc'): 1})
+        self.assertEqual(count_projects(order), {'A': 2, 'B': 2})
+
+    def test_proctype_limit(self):
+        scheduler = LaunchScheduler(proctype_limits={'slow': 2})
+        tasks = get_tasks('A', 'slow', 5) + get_tasks('A', 'fast', 3) + \
+            get_tasks('B', 'slow', 5)
+        order = get_order(scheduler, tasks)
+        slow = [name for name in order if '-slow-' in name]
+        self.assertEqual(len(slow), 2)
+        self.assertEqual(len(order), 5)
+
+    def test_limit_reached(self):
+        scheduler = LaunchScheduler(project_limits={'A': 2})
+        tasks = get_tasks('A', 'proc', 3)
+        self.assertEqual(get_order(scheduler, tasks,
+                                   running={('A', 'proc'): 2}), [])
+
+    def test_age(self):
+        scheduler = LaunchScheduler(age_weight=1.0)
+        tasks = get_tasks('A', 'proc', 5) + get_tasks('B', 'proc', 1, 10.0)
+        order = get_order(scheduler, tasks, running={('B', 'proc'): 5},
+                          limit=1)
+        self.assertEqual(order, ['B-proc-0'])
+
+    def test_age_ignored(self):
+        scheduler = LaunchScheduler(age_weight=0.0)
+        tasks = get_tasks('A', 'proc', 5) + get_tasks('B', 'proc', 1, 10.0)
+        order = get_order(scheduler, tasks, running={('B', 'proc'): 5},
+                          limit=1)
+        self.assertEqual(count_projects(order), {'A': 1})
+
+    def test_oldest_first(self):
+        scheduler = LaunchScheduler()
+        tasks = [('new', 'A', 'proc', 1.0), ('old', 'A', 'proc', 5.0)]
+        self.assertEqual(get_order(scheduler, tasks), ['old', 'new'])
+
+    def test_priorities(self):
+        scheduler = LaunchScheduler(priorities={'B': 1, 'urgent': 2})
+        tasks = get_tasks('A', 'proc', 2) + get_tasks('B', 'proc', 2) + \
+            get_tasks('A', 'urgent', 1)
+        order = get_order(scheduler, tasks)
+        self.assertEqual(order[0], 'A-urgent-0')
+        self.assertEqual(order[1:3], ['B-proc-1', 'B-proc-0'])
+
+    def test_priority_project(self):
+        scheduler = LaunchScheduler(priority_project=['B', 'A'])
+        tasks = get_tasks('A', 'proc', 1) + get_tasks('B', 'proc', 1)
+        self.assertEqual(get_order(scheduler, tasks), ['B-proc-0', 'A-proc-0'])
+
+    def test_age_days(self):
+        now = datetime(2020, 1, 11)
+        self.assertEqual(get_age_days('2020-01-01', now), 10.0)
+        self.assertEqual(get_age_days('2020-01-01 10:00:00', now), 10.0)
+        self.assertEqual(get_age_days('2020-02-01', now), 0.0)
+        self.assertEqual(get_age_days('', now), 0.0)
+        self.assertEqual(get_age_days('not a date', now), 0.0)
@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" upload_watcher.py
+
+Event-driven detection of the assessors ready to upload in RESULTS_DIR.
+
+The watcher keeps in memory the set of assessor folders ready to upload
+(READY_TO_UPLOAD.txt/JOB_FAILED.txt/READY_TO_COMPLETE.txt written by the
+spiders) from the inotify events of RESULTS_DIR and of each assessor folder
+instead of listing RESULTS_DIR and probing the flag files of every folder.
+
+inotify only sees the changes made by the local host: when RESULTS_DIR is on
+a network filesystem (NFS, Lustre, GPFS, ...) written by the compute nodes,
+or when inotify is not available, the watcher polls RESULTS_DIR and only
+checks the folders whose modification time changed.
+"""
+
+from builtins import object
+
+from collections import OrderedDict
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+
+__copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
+# inotify constants (linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+RESULTS_DIR_MASK = IN_CREATE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE | \
+    IN_ONLYDIR
+ASSESSOR_DIR_MASK = IN_CLOSE_WRITE | IN_CREATE | IN_MOVED_TO | IN_DELETE | \
+    IN_MOVED_FROM | IN_DELETE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')
+# Filesystems where the changes from other hosts are not notified
+NETWORK_FILESYSTEMS = ['nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'lustre',
+                       'gpfs', 'beegfs', 'panfs', 'ceph', 'glusterfs',
+                       'fuse.sshfs', 'afs']
+POLL_INTERVAL = 10  # seconds
+# Delay before checking again an assessor that failed to upload
+RETRY_DELAY = 15 * 60  # seconds
+# Logger to print logs
+LOGGER = logging.getLogger('dax')
+
+
+def get_filesystem_type(path):
+    """
+    Get the type of the filesystem of a path from /proc/mounts.
+
+    :param path: path to a file or folder
+    :return: filesystem type (e.g: ext4, nfs4), None if unknown
+    """
+    path = os.path.realpath(path)
+    fstype = None
+    mount_len = -1
+    try:
+        with open('/proc/mounts', 'r') as f_obj:
+            for line in f_obj:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace('\\040', ' ')
+                if (path == mount_point or
+                    path.startswith(mount_point.rstrip('/') + '/')) and \
+                   len(mount_point) > mount_len:
+                    fstype = fields[2]
+                    mount_len = len(mount_point)
+    except (IOError, OSError):
+        return None
+    return fstype
+
+
+def is_network_filesystem(path):
+    """
+    Check if a path is on a network filesystem.
+
+    :param path: path to a folder
+    :return: True if the filesystem is in NETWORK_FILESYSTEMS
+    """
+    return get_filesystem_type(path) in NETWORK_FILESYSTEMS
+
+
+class Inotify(object):
+    """ Minimal inotify wrapper on top of the C library (Linux only) """
+    def __init__(self):
+        """
+        Entry point for the Inotify class.
+
+        :raises: OSError if inotify is not available
+        :return: None
+        """
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError(errno.ENOSYS, 'C library not found')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify not available')
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask):
+        """
+        Watch a path.
+
+        :param path: path to a folder
+        :param mask: events to watch
+        :raises: OSError if the watch can not be added (e.g: ENOSPC when
+                 fs.inotify.max_user_watches is reached)
+        :return: watch descriptor
+        """
+        wd = self.libc.inotify_add_watch(self.fd, path.encode('utf-8'),
+                                         ctypes.c_uint32(mask))
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, '%s: %s' % (os.strerror(err), path))
+        return wd
+
+    def read_events(self, timeout):
+        """
+        Wait for events.
+
+        :param timeout: seconds to wait
+        :return: list of (wd, mask, name)
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return list()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as err:
+            if err.errno == errno.EAGAIN:
+                return list()
+            raise
+        events = list()
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, name.decode('utf-8', 'replace')))
+        return events
+
+    def close(self):
+        """Close the inotify file descriptor."""
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class UploadWatcher(object):
+    """ Class keeping the set of assessors ready to upload in RESULTS_DIR """
+    def __init__(self, results_dir, is_ready, skip_list=None, poll=None,
+                 poll_interval=POLL_INTERVAL):
+        """
+        Entry point for the UploadWatcher class.
+
+        :param results_dir: folder where the spiders write the assessors
+        :param is_ready: function(assessor_label) checking the flag files
+        :param skip_list: folders of results_dir that are not assessors
+        :param poll: True to poll, False to use inotify, None to use inotify
+                     only on a local filesystem
+        :param poll_interval: seconds between two polls
+        :return: None
+        """
+        self.results_dir = results_dir
+        self.is_ready = is_ready
+        self.skip_list = skip_list or list()
+        self.poll_interval = poll_interval
+        # label -> time when it can be uploaded
+        self.ready = OrderedDict()
+        # polling: label -> mtime of the folder when last checked
+        self.mtimes = dict()
+        self.last_poll = 0
+        # inotify: wd -> label ('' for results_dir)
+        self.watches = dict()
+        self.inotify = None
+
+        if poll is None:
+            poll = is_network_filesystem(results_dir)
+            if poll:
+                LOGGER.info('upload watcher: %s is on a network filesystem, \
+polling every %ss' % (results_dir, poll_interval))
+        if not poll:
+            try:
+                self.inotify = Inotify()
+                self.watches[self.inotify.add_watch(
+                    results_dir, RESULTS_DIR_MASK)] = ''
+            except OSError as err:
+                LOGGER.warn('upload watcher: inotify not available (%s), \
+polling every %ss' % (err, poll_interval))
+                self.close()
+        self.rescan()
+
+    @property
+    def mode(self):
+        """inotify or poll."""
+        return 'inotify' if self.inotify else 'poll'
+
+    def close(self):
+        """Stop watching."""
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
+        self.watches = dict()
+
+    def is_assessor_dir(self, label):
+        """True if label is an assessor folder in results_dir."""
+        return label and label not in self.skip_list and \
+            not label.startswith('.') and \
+            os.path.isdir(os.path.join(self.results_dir, label))
+
+    def check(self, label):
+        """
+        Check the flag files of an assessor folder and update the ready set.
+
+        :param label: assessor label
+        :return: True if the assessor is ready to upload
+        """
+        if self.is_assessor_dir(label) and self.is_ready(label):
+            if label not in self.ready:
+                LOGGER.debug('upload watcher: %s ready' % label)
+                self.ready[label] = time.time()
+            return True
+        self.ready.pop(label, None)
+        return False
+
+    def watch_assessor(self, label):
+        """Watch the flag files created in an assessor folder."""
+        if self.inotify is None or label in list(self.watches.values()):
+            return
+        try:
+            wd = self.inotify.add_watch(
+                os.path.join(self.results_dir, label), ASSESSOR_DIR_MASK)
+            self.watches[wd] = label
+        except OSError as err:
+            if err.errno == errno.ENOENT:
+                return
+            # e.g: ENOSPC, too many watches
+            LOGGER.warn('upload watcher: cannot watch %s (%s), switching to \
+polling' % (label, err))
+            self.close()
+
+    def rescan(self):
+        """List results_dir once (start, queue overflow or polling)."""
+        labels = [label for label in os.listdir(self.results_dir)
+                  if self.is_assessor_dir(label)]
+        for label in list(self.ready.keys()):
+            if label not in labels:
+                del self.ready[label]
+        for label in list(self.mtimes.keys()):
+            if label not in labels:
+                del self.mtimes[label]
+
+        for label in labels:
+            if self.inotify is not None:
+                self.watch_assessor(label)
+                self.check(label)
+                continue
+            # polling: only the folders modified since the last poll
+            try:
+                mtime = os.path.getmtime(os.path.join(self.results_dir,
+                                                      label))
+            except OSError:
+                continue
+            if self.mtimes.get(label) != mtime:
+                self.mtimes[label] = mtime
+                self.check(label)
+        self.last_poll = time.time()
+
+    def process_events(self, timeout):
+        """Read the inotify events for up to timeout seconds."""
+        try:
+            events = self.inotify.read_events(timeout)
+        except (IOError, OSError) as err:
+            LOGGER.warn('upload watcher: inotify error (%s), switching to \
+polling' % err)
+            self.close()
+            return
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                LOGGER.info('upload watcher: event queue overflow, rescan')
+                self.rescan()
+                continue
+            label = self.watches.get(wd)
+            if label is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                continue
+            if label == '':
+                # event in results_dir on an assessor folder
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # the flags can be there before the watch is added
+                    self.watch_assessor(name)
+                    self.check(name)
+                else:
+                    self.ready.pop(name, None)
+            elif mask & IN_DELETE_SELF:
+                self.ready.pop(label, None)
+            else:
+                self.check(label)
+
+    def wait(self, timeout):
+        """
+        Wait for assessors ready to upload.
+
+        :param timeout: maximum number of seconds to wait
+        :return: list of assessor labels ready (oldest first)
+        """
+        end = time.time() + timeout
+        while True:
+            ready = self.get_ready()
+            remaining = end - time.time()
+            if ready or remaining <= 0:
+                return ready
+            if self.inotify is not None:
+                self.process_events(min(remaining, 1.0))
+            else:
+                wait = self.last_poll + self.poll_interval - time.time()
+                if wait > 0:
+                    time.sleep(min(wait, remaining, 1.0))
+                else:
+                    self.rescan()
+
+    def get_ready(self):
+        """
+        Get the assessors ready to upload now.
+
+        :return: list of assessor labels (oldest first)
+        """
+        now = time.time()
+        return [label for label, ready_time in list(self.ready.items())
+                if ready_time <= now]
+
+    def done(self, labels):
+        """
+        Check the assessors after an upload: the ones still ready (upload
+        failed) are retried after RETRY_DELAY.
+
+        :param labels: list of assessor labels uploaded
+        :return: None
+        """
+        for label in labels:
+            if self.check(label):
+                self.ready[label] = time.time() + RETRY_DELAY
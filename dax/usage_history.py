@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" usage_history.py
+
+Local history of the resources used by the assessors (memused/walltimeused
+set by dax upload) keyed by proctype and version.
+
+The history gives percentile statistics per proctype and, when right_size
+is enabled in the cluster section of ~/.dax_settings.ini, the memory and
+walltime requested in the job files (cluster.PBS.write) are set to
+right_size_factor times the 95th percentile of the past usage instead of
+the static values of the processor (never more than the static values).
+An assessor whose last job failed (killed for exceeding its request) is
+launched again with the static values.
+"""
+
+from builtins import object
+
+import logging
+import os
+import re
+import sqlite3
+import time
+
+from .dax_settings import DAX_Settings
+
+
+__copyright__ = 'Copyright 2013 Vanderbilt University. All Rights Reserved'
+DAX_SETTINGS = DAX_Settings()
+LOGGER = logging.getLogger('dax')
+DEFAULT_USAGE_DB = os.path.join(os.path.expanduser('~'), '.dax_usage.db')
+RIGHT_SIZE_PERCENTILE = 95
+# Do not request less than that whatever the history says
+MIN_MEMORY_MB = 256
+MIN_WALLTIME = 15 * 60  # seconds
+# Only the jobs finishing are used for the statistics
+USAGE_STATUSES = ['COMPLETE', 'READY_TO_COMPLETE']
+# Recorded even without usage: the next job uses the static values
+FAILED_STATUS = 'JOB_FAILED'
+MEMORY_UNITS = {'': 1, 'k': 1, 'kb': 1, 'm': 1024, 'mb': 1024,
+                'g': 1024 ** 2, 'gb': 1024 ** 2}
+USAGE_TABLE = '''CREATE TABLE IF NOT EXISTS usage (
+    assessor TEXT PRIMARY KEY,
+    proctype TEXT NOT NULL,
+    version TEXT,
+    status TEXT,
+    memory_mb REAL,
+    walltime REAL,
+    jobnode TEXT,
+    date REAL)'''
+USAGE_INDEX = '''CREATE INDEX IF NOT EXISTS usage_proctype
+    ON usage (proctype, version)'''
+
+
+def parse_memory_mb(memused):
+    """
+    Parse the memory used from the scheduler/spider (kB by default).
+
+    :param memused: string (e.g: 123456, 123456K, 120mb, 1.2G)
+    :return: memory in MB, None if unknown
+    """
+    if memused is None:
+        return None
+    match = re.match(r'^\s*([0-9.]+)\s*([a-zA-Z]*)\s*$', str(memused))
+    if not match or match.group(2).lower() not in MEMORY_UNITS:
+        return None
+    try:
+        kbytes = float(match.group(1)) * MEMORY_UNITS[match.group(2).lower()]
+    except ValueError:
+        return None
+    return kbytes / 1024.0
+
+
+def parse_walltime(walltime):
+    """
+    Parse a walltime string ([D-]HH:MM:SS, MM:SS or seconds).
+
+    :param walltime: string
+    :return: walltime in seconds, None if unknown
+    """
+    if walltime is None:
+        return None
+    match = re.match(r'^\s*(?:(\d+)-)?(\d+(?::\d+){0,2})(?:\.\d+)?\s*$',
+                     str(walltime))
+    if not match:
+        return None
+    seconds = 0
+    for value in match.group(2).split(':'):
+        seconds = seconds * 60 + int(value)
+    if match.group(1):
+        seconds += int(match.group(1)) * 24 * 3600
+    return float(seconds)
+
+
+def format_walltime(seconds):
+    """
+    Format a walltime in seconds for the job file (HH:MM:SS).
+
+    :param seconds: walltime in seconds
+    :return: string
+    """
+    seconds = int(round(seconds))
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60,
+                               seconds % 60)
+
+
+def percentile(values, percent):
+    """
+    Percentile of values with linear interpolation (like numpy).
+
+    :param values: list of numbers
+    :param percent: percentile between 0 and 100
+    :return: value, None if no value
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    rank = (len(values) - 1) * percent / 100.0
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def get_usage_history():
+    """
+    Get the usage history set in the settings (usage_db).
+
+    :return: UsageHistory object
+    """
+    return UsageHistory(DAX_SETTINGS.get_usage_db() or DEFAULT_USAGE_DB)
+
+
+class UsageHistory(object):
+    """ Class for the local database of the resources used by the jobs """
+    def __init__(self, db_path=DEFAULT_USAGE_DB):
+        """
+        Entry point for the UsageHistory class.
+
+        :param db_path: path to the sqlite database
+        :return: None
+        """
+        self.db_path = db_path
+        self.connection = sqlite3.connect(db_path, timeout=60)
+        self.connection.execute(USAGE_TABLE)
+        self.connection.execute(USAGE_INDEX)
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the database."""
+        self.connection.close()
+
+    def add(self, assessor, proctype, version, status, memused, walltime,
+            jobnode=None):
+        """
+        Add (or replace) the usage of an assessor.
+
+        :param assessor: assessor label
+        :param proctype: proctype of the assessor
+        :param version: version of the spider
+        :param status: procstatus of the assessor
+        :param memused: memory used (string in kB or with a unit)
+        :param walltime: walltime used (string HH:MM:SS)
+        :param jobnode: node where the job ran
+        :return: True if added, False if the usage is unknown
+        """
+        memory_mb = parse_memory_mb(memused)
+        walltime_s = parse_walltime(walltime)
+        if memory_mb is None and walltime_s is None and \
+           status != FAILED_STATUS:
+            return False
+        self.connection.execute(
+            'INSERT OR REPLACE INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (assessor, proctype, version, status, memory_mb, walltime_s,
+             jobnode, time.time()))
+        self.connection.commit()
+        return True
+
+    def get_usage(self, proctype, version=None):
+        """
+        Get the usage of the finished jobs for a proctype.
+
+        :param proctype: proctype
+        :param version: version of the spider (all versions if None)
+        :return: (list of memory in MB, list of walltime in seconds)
+        """
+        query = 'SELECT memory_mb, walltime FROM usage WHERE proctype = ? \
+AND status IN (%s)' % ', '.join('?' * len(USAGE_STATUSES))
+        args = [proctype] + USAGE_STATUSES
+        if version:
+            query += ' AND version = ?'
+            args.append(version)
+        rows = self.connection.execute(query, args).fetchall()
+        return ([row[0] for row in rows if row[0] is not None],
+                [row[1] for row in rows if row[1] is not None])
+
+    def get_status(self, assessor):
+        """
+        Get the status of the last job of an assessor in the history.
+
+        :param assessor: assessor label
+        :return: procstatus recorded, None if not in the history
+        """
+        row = self.connection.execute(
+            'SELECT status FROM usage WHERE assessor = ?',
+            (assessor,)).fetchone()
+        return row[0] if row else None
+
+    def get_proctypes(self):
+        """
+        Get the proctypes and versions in the history.
+
+        :return: list of (proctype, version)
+        """
+        query = 'SELECT DISTINCT proctype, version FROM usage \
+ORDER BY proctype, version'
+        return self.connection.execute(query).fetchall()
+
+    def get_stats(self, proctype, version=None,
+                  percentiles=(50, 90, RIGHT_SIZE_PERCENTILE, 100)):
+        """
+        Get percentile statistics of the usage of a proctype.
+
+        :param proctype: proctype
+        :param version: version of the spider (all versions if None)
+        :param percentiles: percentiles to compute
+        :return: dictionary {'count', 'memory_mb', 'walltime'}, the last two
+                 being dictionaries {percentile: value}
+        """
+        memory, walltime = self.get_usage(proctype, version)
+        return {
+            'count': max(len(memory), len(walltime)),
+            'memory_mb': dict((pct, percentile(memory, pct))
+                              for pct in percentiles),
+            'walltime': dict((pct, percentile(walltime, pct))
+                             for pct in percentiles)}
+
+    def get_right_size(self, proctype, version=None,
+                       factor=None, min_jobs=None):
+        """
+        Get the memory/walltime to request for a proctype from its history.
+
+        The history of the version is used when it has enough jobs, the
+        history of all the versions of the proctype otherwise.
+
+        :param proctype: proctype
+        :param version: version of the spider
+        :param factor: safety factor applied on the 95th percentile
+        :param min_jobs: minimum number of jobs in the history
+        :return: (memory in MB, walltime in seconds), None if not enough jobs
+        """
+        if factor is None:
+            factor = DAX_SETTINGS.get_right_size_factor()
+        if min_jobs is None:
+            min_jobs = DAX_SETTINGS.get_right_size_min_jobs()
+        for _version in ([version, None] if version else [None]):
+            memory, walltime = self.get_usage(proctype, _version)
+            if len(memory) >= min_jobs and len(walltime) >= min_jobs:
+                break
+        else:
+            return None
+        memory_mb = max(MIN_MEMORY_MB,
+                        factor * percentile(memory, RIGHT_SIZE_PERCENTILE))
+        walltime_s = max(MIN_WALLTIME,
+                         factor * percentile(walltime, RIGHT_SIZE_PERCENTILE))
+        return int(round(memory_mb)), walltime_s
+
+
+def record_usage(assessor_label, version, status, memused, walltime,
+                 jobnode=None):
+    """
+    Add the usage of a finished assessor to the history (errors are logged).
+
+    :param assessor_label: assessor label (the proctype is the last part)
+    :param version: version of the spider
+    :param status: procstatus of the assessor
+    :param memused: memory used (string in kB or with a unit)
+    :param walltime: walltime used (string HH:MM:SS)
+    :param jobnode: node where the job ran
+    :return: None
+    """
+    proctype = assessor_label.split('-x-')[-1]
+    try:
+        with get_usage_history() as history:
+            history.add(assessor_label, proctype, version, status, memused,
+                        walltime, jobnode)
+    except sqlite3.Error as err:
+        LOGGER.warn('cannot add %s to the usage history: %s'
+                    % (assessor_label, err))
+
+
+def right_size(proctype, version, mem_mb, walltime_str, assessor=None):
+    """
+    Get the memory/walltime to request for a job (right_size option).
+
+    The values are only decreased: the static values of the processor are
+    kept when they are lower, when the history is too short or when the
+    previous job of the assessor failed.
+
+    :param proctype: proctype of the job
+    :param version: version of the spider
+    :param mem_mb: memory in MB set by the processor
+    :param walltime_str: walltime set by the processor
+    :param assessor: assessor label of the job
+    :return: (mem_mb, walltime_str) to request
+    """
+    try:
+        with get_usage_history() as history:
+            if assessor and history.get_status(assessor) == FAILED_STATUS:
+                LOGGER.info('previous job of %s failed: no right size'
+                            % assessor)
+                return mem_mb, walltime_str
+            sizes = history.get_right_size(proctype, version)
+    except sqlite3.Error as err:
+        LOGGER.warn('cannot read the usage history: %s' % err)
+        return mem_mb, walltime_str
+    if not sizes:
+        return mem_mb, walltime_str
+
+    memory, walltime = sizes
+    try:
+        if memory < int(mem_mb):
+            mem_mb = memory
+    except (TypeError, ValueError):
+        pass
+    static_walltime = parse_walltime(walltime_str)
+    if static_walltime is not None and walltime < static_walltime:
+        walltime_str = format_walltime(walltime)
+    return mem_mb, walltime_str
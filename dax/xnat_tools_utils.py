@@ -20,6 +20,7 @@ import logging
 import os
 import sys
 
+from . import profiling
 from .errors import XnatToolsError, XnatToolsUserError
 
 
@@ -129,6 +130,7 @@ def parse_args(name, description, add_tools_arguments, purpose,
                         help='Host for XNAT. Default: env XNAT_HOST.')
     parser.add_argument('-u', '--username', dest='username', default=None,
                         help='Username for XNAT.')
+    profiling.add_profile_arguments(parser)
     parser = add_tools_arguments(parser)
     main_display(name, purpose, extra_display)
     args = parser.parse_args()
@@ -192,7 +194,9 @@ def run_tool(script, description, add_tools_arguments, purpose, run_tool_fct,
     """
     args = parse_args(script, description, add_tools_arguments, purpose,
                       extra_display)
-    run_tool_fct(args)
+    with profiling.profile(script, getattr(args, 'logfile', None),
+                           args.profile, args.cprofile):
+        run_tool_fct(args)
 
 
 def setup_info_logger(name, log_file=None):